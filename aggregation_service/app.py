@@ -1,115 +1,337 @@
 import os
-import json
 import pika
 import redis
 import random
 import sys
-from otel import tracer
+import uuid
+from telemetry import serve_metrics, tracer
 from opentelemetry.trace import SpanKind, Status, StatusCode
 import time
+from join import JoinStore
+from checkpoint import Checkpointer
+from sharding import ShardMembership, shard_name
+from messaging.rabbit import jump_hash
+from messaging.codec import CONTENT_TYPE, content_type_of, decode, encode
+from messaging.tracing import PRODUCED_AT, carried, context_of, message_headers, now_us, publish_properties, receive_attributes, span_context_of
+from opentelemetry.trace import Link
+from messaging.metrics import elapsed_ms, process_duration, record_received, record_sent, watch_queues
+from messaging.store import get_redis, set_last_message
+
+AGGREGATION_PREFETCH = int(os.getenv("AGGREGATION_PREFETCH", "100"))
+AGGREGATION_WINDOW_SECONDS = float(os.getenv("AGGREGATION_WINDOW_SECONDS", "5.0"))
+AGGREGATION_SWEEP_INTERVAL = float(os.getenv("AGGREGATION_SWEEP_INTERVAL", "0.5"))
+AGGREGATION_MAX_KEYS = int(os.getenv("AGGREGATION_MAX_KEYS", "500000"))
+AGGREGATION_MAX_BYTES = int(os.getenv("AGGREGATION_MAX_BYTES", str(256 * 1024 * 1024)))
+# "join" pairs one schedule, ticket and passenger per key; "batch" collects every
+# ticket and passenger for a train into one aggregate per size/linger bound.
+AGGREGATION_MODE = os.getenv("AGGREGATION_MODE", "join")
+AGGREGATION_BATCH_SIZE = int(os.getenv("AGGREGATION_BATCH_SIZE", "500"))
+AGGREGATION_LINGER_SECONDS = float(os.getenv("AGGREGATION_LINGER_SECONDS", "1.0"))
+AGGREGATION_JOIN_KEYS = os.getenv(
+    "AGGREGATION_JOIN_KEYS",
+    "train_id,conversation_id" if AGGREGATION_MODE == "batch" else "conversation_id,train_id",
+).split(",")
+# Seconds between checkpoints of open join windows to Redis; 0 acks inputs only when their aggregate is published
+AGGREGATION_CHECKPOINT_INTERVAL = float(os.getenv("AGGREGATION_CHECKPOINT_INTERVAL", "1.0"))
+AGGREGATION_CHECKPOINT_KEY = os.getenv("AGGREGATION_CHECKPOINT_KEY", "aggregation_join_state")
+# Unacked inputs on the channel that trigger a checkpoint before the interval is up. Inputs are acked only
+# by checkpoints, so without this a consumer would stall at its prefetch limit until the next tick.
+AGGREGATION_CHECKPOINT_MAX_UNACKED = int(os.getenv("AGGREGATION_CHECKPOINT_MAX_UNACKED", str(max(1, AGGREGATION_PREFETCH * 3 // 4))))
+# Number of per-shard input queues ("ScheduleQueue.0" ...); must match the producers. 0 consumes the unsharded queues.
+AGGREGATION_SHARDS = int(os.getenv("AGGREGATION_SHARDS", "0"))
+AGGREGATION_REBALANCE_INTERVAL = float(os.getenv("AGGREGATION_REBALANCE_INTERVAL", "2.0"))
+AGGREGATION_MEMBER_TTL = float(os.getenv("AGGREGATION_MEMBER_TTL", "10.0"))
+INPUT_QUEUES = ['ScheduleQueue', 'TicketQueue', 'PassengerQueue']
+
+def join_key(message):
+    # First configured field present in the message
+    for field in AGGREGATION_JOIN_KEYS:
+        value = message.get(field)
+        if value:
+            return str(value)
+    return None
+
+def make_store(track_dirty):
+    if AGGREGATION_MODE == "batch":
+        # Tickets and passengers accumulate; a second schedule for the train starts a new batch
+        return JoinStore(
+            len(INPUT_QUEUES), AGGREGATION_LINGER_SECONDS, AGGREGATION_MAX_KEYS, AGGREGATION_MAX_BYTES,
+            batch_slots=(1, 2), batch_size=AGGREGATION_BATCH_SIZE, track_dirty=track_dirty,
+        )
+    return JoinStore(len(INPUT_QUEUES), AGGREGATION_WINDOW_SECONDS, AGGREGATION_MAX_KEYS, AGGREGATION_MAX_BYTES, track_dirty=track_dirty)
+
+def deliveries(part):
+    if part is None:
+        return []
+    return part if isinstance(part, list) else [part]
 
 def main():
     rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
     rabbit_port = int(os.getenv("RABBITMQ_PORT", "5672"))
     redis_host = os.getenv("REDIS_HOST", "redis")
-    redis_port = int(os.getenv("REDIS_PORT", "6379"))
+    redis_client = get_redis()
+    checkpointing = AGGREGATION_CHECKPOINT_INTERVAL > 0
+    serve_metrics()
+    membership = None
+    if AGGREGATION_SHARDS > 0:
+        membership = ShardMembership(redis_client, AGGREGATION_SHARDS, AGGREGATION_MEMBER_TTL)
+        print(f"AggregationService: Joining shard group as {membership.member_id}", flush=True)
 
     while True:
         try:
-            with tracer.start_as_current_span(
-                "aggregate_poll_cycle",
-                kind=SpanKind.SERVER,
-                attributes={
-                    "messaging.system": "rabbitmq",
-                    "messaging.destination.name": "AggregationQueues",
-                    "server.address": rabbit_host,
-                },
-            ) as poll_span:
-                connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host, port=rabbit_port, credentials=pika.PlainCredentials("admin", "password")))
-                channel = connection.channel()
-                for q in ['ScheduleQueue', 'TicketQueue', 'PassengerQueue', 'AggregationQueue']:
-                    channel.queue_declare(queue=q, durable=True)
-
-                # otel_logger.info("AggregationService: Attempting to aggregate messages...")
-
-                schedule_method, schedule_props, schedule_body = channel.basic_get(queue='ScheduleQueue')
-                ticket_method, ticket_props, ticket_body = channel.basic_get(queue='TicketQueue')
-                passenger_method, passenger_props, passenger_body = channel.basic_get(queue='PassengerQueue')
-
-                if schedule_body or ticket_body or passenger_body:
-                    with tracer.start_as_current_span(
-                        "aggregate_messages",
-                        kind=SpanKind.INTERNAL,
-                        attributes={
-                            "aggregation.has_schedule": bool(schedule_body),
-                            "aggregation.has_ticket": bool(ticket_body),
-                            "aggregation.has_passenger": bool(passenger_body),
-                        },
-                    ) as agg_span:
-                        try:
-                            # Random error injection for aggregation
-                            if random.random() < 0.001:
-                                raise RuntimeError("Simulated aggregation error")
-                            schedule = json.loads(schedule_body) if schedule_body else {}
-                            ticket = json.loads(ticket_body) if ticket_body else {}
-                            passenger = json.loads(passenger_body) if passenger_body else {}
-                            aggregated = {
-                                "train_id": "123",
-                                "schedule": schedule,
-                                "tickets": [ticket] if ticket else [],
-                                "passengers": [passenger] if passenger else []
-                            }
-                            with tracer.start_as_current_span(
-                                "publish_aggregated_message",
-                                kind=SpanKind.PRODUCER,
-                                attributes={
-                                    "messaging.operation": "send",
-                                    "messaging.destination.name": "AggregationQueue",
-                                    "server.address": rabbit_host,
-                                },
-                            ) as send_span:
-                                channel.basic_publish(exchange='', routing_key='AggregationQueue', body=json.dumps(aggregated))
-                                # otel_logger.info("AggregationService: Sent aggregated message.")
-                                send_span.set_status(Status(StatusCode.OK))
-                            if schedule_method:
-                                channel.basic_ack(schedule_method.delivery_tag)
-                            if ticket_method:
-                                channel.basic_ack(ticket_method.delivery_tag)
-                            if passenger_method:
-                                channel.basic_ack(passenger_method.delivery_tag)
-                            # Redis operation
-                            with tracer.start_as_current_span(
-                                "redis_set_last_message",
-                                kind=SpanKind.CLIENT,
-                                attributes={
-                                    "db.system": "redis",
-                                    "db.operation.name": "SET",
-                                    "db.query.text": "SET aggregation_last_message ...",
-                                    "network.peer.address": redis_host,
-                                    "db.namespace": "0"
-                                },
-                            ) as db_span:
-                                try:
-                                    r = redis.Redis(host=redis_host, port=redis_port, password="password")
-                                    r.set("aggregation_last_message", json.dumps(aggregated))
-                                    db_span.set_status(Status(StatusCode.OK))
-                                except Exception as exc:
-                                    db_span.set_status(Status(StatusCode.ERROR, str(exc)))
-                                    db_span.set_attribute("error.type", type(exc).__name__)
-                                    # otel_logger.error(f"Error saving to Redis: {exc}", attributes={"error.type": type(exc).__name__})
-                                    raise
-                            agg_span.set_status(Status(StatusCode.OK))
-                        except Exception as exc:
-                            agg_span.set_status(Status(StatusCode.ERROR, str(exc)))
-                            agg_span.set_attribute("error.type", type(exc).__name__)
-                            # otel_logger.error(f"Error during aggregation: {exc}", attributes={"error.type": type(exc).__name__})
-                            raise
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host, port=rabbit_port, credentials=pika.PlainCredentials("admin", "password")))
+            channel = connection.channel()
+            channel.queue_declare(queue='AggregationQueue', durable=True)
+            channel.basic_qos(prefetch_count=AGGREGATION_PREFETCH)
+            # Aggregates go out on a channel in confirm mode: basic_publish returns once the broker has the
+            # aggregate and raises if it is nacked or unroutable, so no input is acked before its aggregate is safe
+            out_channel = connection.channel()
+            out_channel.confirm_delivery()
+
+            # Per owned shard (None when unsharded): open join windows keyed by join_key(), each part
+            # is (delivery_tag, body, trace headers, queue wait ms), plus the shard's checkpointer and consumer tags
+            stores = {}
+            checkpointers = {}
+            consumers = {}
+            # Highest delivery tag received and acked on this channel, and whether the last checkpoint failed
+            tags = {"delivered": 0, "acked": 0, "failing": False}
+            misrouted = {"warned": False}
+
+            def aggregate(store, window):
+                schedule_deliveries, ticket_deliveries, passenger_deliveries = (deliveries(part) for part in window.parts)
+                inputs = schedule_deliveries + ticket_deliveries + passenger_deliveries
+                # The aggregate continues the first input's trace and links to the others
+                headers = [item[2] for item in inputs if item[2]]
+                links = [Link(span_context) for span_context in map(span_context_of, headers[1:]) if span_context is not None]
+                produced = [h[PRODUCED_AT] for h in headers if isinstance(h.get(PRODUCED_AT), int)]
+                produced_at = min(produced) if produced else None
+                waits = [item[3] for item in inputs if item[3] is not None]
+                # Longest input queue wait, time the window was open, and age of the oldest input
+                timings = {"aggregation.window_ms": round((store.clock() - window.opened_at) * 1000, 3)}
+                if waits:
+                    timings["messaging.queue_wait_ms"] = max(waits)
+                if produced_at is not None:
+                    timings["messaging.end_to_end_ms"] = max(0, now_us() - produced_at) / 1000
+                with tracer.start_as_current_span(
+                    "aggregate_messages",
+                    context=context_of(headers[0] if headers else None),
+                    links=links,
+                    kind=SpanKind.INTERNAL,
+                    attributes={
+                        "aggregation.key": window.key,
+                        "aggregation.complete": window.complete,
+                        "aggregation.open_keys": len(store),
+                        "aggregation.has_schedule": bool(schedule_deliveries),
+                        "aggregation.has_ticket": bool(ticket_deliveries),
+                        "aggregation.has_passenger": bool(passenger_deliveries),
+                        "aggregation.ticket_count": len(ticket_deliveries),
+                        "aggregation.passenger_count": len(passenger_deliveries),
+                        **timings,
+                    },
+                ) as agg_span:
+                    try:
+                        # Random error injection for aggregation
+                        if random.random() < 0.001:
+                            raise RuntimeError("Simulated aggregation error")
+                        # Stored parts are always in this service's CONTENT_TYPE (see on_message)
+                        schedule = decode(schedule_deliveries[0][1], CONTENT_TYPE) if schedule_deliveries else {}
+                        tickets = [decode(item[1], CONTENT_TYPE) for item in ticket_deliveries]
+                        passengers = [decode(item[1], CONTENT_TYPE) for item in passenger_deliveries]
+                        aggregated = {
+                            "train_id": schedule.get("train_id") or (tickets[0].get("train_id") if tickets else None) or "unknown",
+                            "join_key": window.key,
+                            "complete": window.complete,
+                            "schedule": schedule,
+                            "tickets": tickets,
+                            "passengers": passengers
+                        }
+                        out_body = encode(aggregated)
+                        with tracer.start_as_current_span(
+                            "publish_aggregated_message",
+                            kind=SpanKind.PRODUCER,
+                            attributes={
+                                "messaging.operation": "send",
+                                "messaging.destination.name": "AggregationQueue",
+                                "server.address": rabbit_host,
+                            },
+                        ) as send_span:
+                            out_properties = publish_properties(
+                                CONTENT_TYPE, message_headers(produced_at),
+                                message_id=f"agg-{uuid.uuid4().hex[:12]}", correlation_id=schedule.get("conversation_id"),
+                            )
+                            publish_started = time.perf_counter()
+                            out_channel.basic_publish(exchange='', routing_key='AggregationQueue', body=out_body, properties=out_properties, mandatory=True)
+                            record_sent('AggregationQueue', 1, elapsed_ms(publish_started))
+                            # otel_logger.info("AggregationService: Sent aggregated message.")
+                            send_span.set_status(Status(StatusCode.OK))
+                        if not checkpointing:
+                            for item in inputs:
+                                if item[0] is not None:
+                                    channel.basic_ack(item[0])
+                        # Redis operation
+                        with tracer.start_as_current_span(
+                            "redis_set_last_message",
+                            kind=SpanKind.CLIENT,
+                            attributes={
+                                "db.system": "redis",
+                                "db.operation.name": "SET",
+                                "db.query.text": "SET aggregation_last_message ...",
+                                "network.peer.address": redis_host,
+                                "db.namespace": "0"
+                            },
+                        ) as db_span:
+                            try:
+                                set_last_message("aggregation_last_message", out_body)
+                                db_span.set_status(Status(StatusCode.OK))
+                            except Exception as exc:
+                                db_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                                db_span.set_attribute("error.type", type(exc).__name__)
+                                # otel_logger.error(f"Error saving to Redis: {exc}", attributes={"error.type": type(exc).__name__})
+                                raise
+                        agg_span.set_status(Status(StatusCode.OK))
+                    except Exception as exc:
+                        agg_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                        agg_span.set_attribute("error.type", type(exc).__name__)
+                        # otel_logger.error(f"Error during aggregation: {exc}", attributes={"error.type": type(exc).__name__})
+                        raise
+
+            def on_message(shard, slot, method, properties, body):
+                started = time.perf_counter()
+                queue = shard_name(INPUT_QUEUES[slot], shard)
+                record_received(queue, properties)
+                tags["delivered"] = method.delivery_tag
+                content_type = content_type_of(properties)
+                message = decode(body, content_type)
+                if content_type != CONTENT_TYPE:
+                    # Producers mid-rollout may still send another codec; keep the store uniform
+                    body = encode(message)
+                key = join_key(message)
+                if key is None:
+                    key = f"unkeyed-{uuid.uuid4().hex}"
+                elif shard is not None and not misrouted["warned"] and jump_hash(key, AGGREGATION_SHARDS) != shard:
+                    # Its other parts are on another shard, so this join can never complete
+                    misrouted["warned"] = True
+                    print(f"AggregationService: Input with join key {key!r} arrived on {queue}, not shard "
+                          f"{jump_hash(key, AGGREGATION_SHARDS)}; set AGGREGATION_MODE and AGGREGATION_JOIN_KEYS "
+                          f"the same on every service", flush=True, file=sys.stdout)
+                store = stores[shard]
+                item = (method.delivery_tag, body, carried(properties), receive_attributes(properties).get("messaging.queue_wait_ms"))
+                for window in store.add(key, slot, item, len(body)):
+                    aggregate(store, window)
+                process_duration.record(elapsed_ms(started), {"messaging.destination.name": queue})
+                # Delivery tags count up per channel, so this is the number of unacked inputs. After a
+                # failure, retries wait for the timer rather than running on every delivery.
+                if checkpointing and not tags["failing"] and tags["delivered"] - tags["acked"] >= AGGREGATION_CHECKPOINT_MAX_UNACKED:
+                    checkpoint()
+
+            def sweep():
+                # Windows that timed out are emitted as partial aggregates
+                for store in list(stores.values()):
+                    for window in store.expire():
+                        aggregate(store, window)
+                connection.call_later(AGGREGATION_SWEEP_INTERVAL, sweep)
+
+            def checkpoint():
+                # Every input delivered so far is either in an open window written below or in an
+                # aggregate the broker has confirmed, so one multiple=True ack covers all of them.
+                delivered = tags["delivered"]
+                with tracer.start_as_current_span(
+                    "checkpoint_join_state",
+                    kind=SpanKind.CLIENT,
+                    attributes={
+                        "db.system": "redis",
+                        "db.operation.name": "PIPELINE",
+                        "db.query.text": f"HSET/HDEL {AGGREGATION_CHECKPOINT_KEY} ...",
+                        "network.peer.address": redis_host,
+                        "db.namespace": "0",
+                        "aggregation.dirty_keys": sum(len(store.dirty) for store in stores.values()),
+                        "aggregation.open_keys": sum(len(store) for store in stores.values()),
+                    },
+                ) as cp_span:
+                    try:
+                        for shard, store in stores.items():
+                            if store.dirty:
+                                checkpointers[shard].save(store)
+                        if delivered > tags["acked"]:
+                            channel.basic_ack(delivered, multiple=True)
+                            tags["acked"] = delivered
+                        cp_span.set_status(Status(StatusCode.OK))
+                        tags["failing"] = False
+                        return True
+                    except redis.RedisError as exc:
+                        # Inputs stay unacked; prefetch applies backpressure until Redis is back
+                        cp_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                        cp_span.set_attribute("error.type", type(exc).__name__)
+                        print(f"AggregationService: Checkpoint failed: {exc}", flush=True, file=sys.stdout)
+                        tags["failing"] = True
+                        return False
+
+            def periodic_checkpoint():
+                checkpoint()
+                connection.call_later(AGGREGATION_CHECKPOINT_INTERVAL, periodic_checkpoint)
+
+            def acquire(shard):
+                store = make_store(track_dirty=checkpointing)
+                if checkpointing:
+                    # Anything not in the snapshot is unacked and will be redelivered to us
+                    checkpointers[shard] = Checkpointer(redis_client, shard_name(AGGREGATION_CHECKPOINT_KEY, shard))
+                    restored = checkpointers[shard].load(store)
+                    print(f"AggregationService: Restored {restored} open join windows for shard {shard} from checkpoint", flush=True)
+                stores[shard] = store
+                consumers[shard] = []
+                watch_queues([shard_name(q, shard) for q in INPUT_QUEUES])
+                for slot, q in enumerate(INPUT_QUEUES):
+                    queue = shard_name(q, shard)
+                    channel.queue_declare(queue=queue, durable=True)
+                    consumers[shard].append(channel.basic_consume(
+                        queue=queue,
+                        on_message_callback=lambda ch, method, properties, body, shard=shard, slot=slot: on_message(shard, slot, method, properties, body),
+                    ))
+
+            def release(shard):
+                # pika requeues deliveries still buffered for the cancelled consumers
+                for consumer_tag in consumers.pop(shard, []):
+                    channel.basic_cancel(consumer_tag)
+                store = stores[shard]
+                if checkpointing:
+                    if not checkpoint():
+                        return  # Keep the lock and retry on the next rebalance
                 else:
-                    # otel_logger.info("AggregationService: No messages available to aggregate.")
-                    time.sleep(5)  # Sleep before retrying if no messages
-                connection.close()
+                    for window in store.expire(now=float("inf")):
+                        aggregate(store, window)
+                del stores[shard]
+                checkpointers.pop(shard, None)
+                membership.release(shard)
+                print(f"AggregationService: Released shard {shard}", flush=True)
+
+            def rebalance():
+                try:
+                    wanted = membership.assigned(membership.heartbeat())
+                    for shard in list(stores):
+                        # claim() also refreshes the lock on shards we keep
+                        if shard not in consumers or shard not in wanted or not membership.claim(shard):
+                            release(shard)
+                    for shard in sorted(wanted - set(stores)):
+                        if membership.claim(shard):
+                            acquire(shard)
+                            print(f"AggregationService: Acquired shard {shard}", flush=True)
+                except redis.RedisError as exc:
+                    print(f"AggregationService: Rebalance failed: {exc}", flush=True, file=sys.stdout)
+                connection.call_later(AGGREGATION_REBALANCE_INTERVAL, rebalance)
+
+            if membership is None:
+                acquire(None)
+            else:
+                rebalance()
+            connection.call_later(AGGREGATION_SWEEP_INTERVAL, sweep)
+            if checkpointing:
+                connection.call_later(AGGREGATION_CHECKPOINT_INTERVAL, periodic_checkpoint)
+            print("AggregationService: Consumer started, waiting for messages...", flush=True)
+            channel.start_consuming()
         except KeyboardInterrupt:
             print("AggregationService: Shutting down...", flush=True)
+            if membership is not None:
+                membership.leave()
             break
         except Exception as e:
             # otel_logger.error(f"AggregationService: Error occurred: {e}", attributes={"error.type": type(e).__name__})
@@ -0,0 +1,127 @@
+import time
+from collections import OrderedDict
+
+
+class Window:
+    """Parts collected for one join key.
+
+    One slot per input, ``None`` until it arrives. Batch slots hold a list of
+    every item received for the key instead of a single item.
+    """
+
+    __slots__ = ("key", "opened_at", "parts", "filled", "count", "size")
+
+    def __init__(self, key, opened_at, width):
+        self.key = key
+        self.opened_at = opened_at
+        self.parts = [None] * width
+        self.filled = 0
+        self.count = 0
+        self.size = 0
+
+    @property
+    def complete(self):
+        return self.filled == len(self.parts)
+
+
+class JoinStore:
+    """In-memory keyed join with per-key time windows.
+
+    Windows are kept in an OrderedDict in opening order. Every window has the same
+    length, so opening order is also expiry order: lookups are O(1) by key and
+    expiry/eviction only ever touches the oldest entries.
+
+    ``add`` and ``expire`` return the windows they closed; the caller emits them.
+    A window closes when all parts have arrived, when it has been open for
+    ``window_seconds``, when a part arrives for a slot that is already filled, or
+    when ``max_keys``/``max_bytes`` is exceeded (oldest windows first).
+
+    With ``batch_slots`` the store micro-batches instead: those slots accumulate
+    every item for the key, and a window stays open until it holds ``batch_size``
+    items or ``window_seconds`` (the linger time) has passed, complete or not.
+
+    With ``track_dirty`` every key opened, changed or closed is recorded in
+    ``dirty`` so that a checkpoint can write only what changed.
+    """
+
+    def __init__(self, width, window_seconds, max_keys=0, max_bytes=0, batch_slots=(), batch_size=0, track_dirty=False, clock=time.monotonic):
+        self.width = width
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.batch_slots = frozenset(batch_slots)
+        self.batch_size = batch_size
+        self.clock = clock
+        self.windows = OrderedDict()
+        self.dirty = set() if track_dirty else None
+        self.bytes = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.windows)
+
+    def _close(self, key):
+        window = self.windows.pop(key)
+        self.bytes -= window.size
+        if self.dirty is not None:
+            self.dirty.add(key)
+        return window
+
+    def restore(self, key, opened_at, parts, size=0):
+        """Re-open a window from a checkpoint. Callers restore in ``opened_at`` order."""
+        window = Window(key, opened_at, self.width)
+        window.parts = list(parts)
+        window.filled = sum(part is not None for part in parts)
+        window.count = sum(len(part) if isinstance(part, list) else 1 for part in parts if part is not None)
+        window.size = size
+        self.windows[key] = window
+        self.bytes += size
+        return window
+
+    def add(self, key, slot, item, size=0):
+        closed = []
+        batched = slot in self.batch_slots
+        window = self.windows.get(key)
+        if window is not None and not batched and window.parts[slot] is not None:
+            closed.append(self._close(key))
+            window = None
+        if window is None:
+            window = Window(key, self.clock(), self.width)
+            self.windows[key] = window
+        if window.parts[slot] is None:
+            window.parts[slot] = [item] if batched else item
+            window.filled += 1
+        else:
+            window.parts[slot].append(item)
+        window.count += 1
+        window.size += size
+        self.bytes += size
+        if self.dirty is not None:
+            self.dirty.add(key)
+        if self.batch_slots:
+            if self.batch_size and window.count >= self.batch_size:
+                closed.append(self._close(key))
+        elif window.complete:
+            closed.append(self._close(key))
+        while self.windows and (
+            (self.max_keys and len(self.windows) > self.max_keys)
+            or (self.max_bytes and self.bytes > self.max_bytes)
+        ):
+            closed.append(self._close(next(iter(self.windows))))
+            self.evicted += 1
+        return closed
+
+    def expire(self, now=None):
+        if now is None:
+            now = self.clock()
+        deadline = now - self.window_seconds
+        closed = []
+        while self.windows:
+            key = next(iter(self.windows))
+            if self.windows[key].opened_at > deadline:
+                break
+            closed.append(self._close(key))
+        return closed
+
+
+__all__ = ["JoinStore", "Window"]
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import time
+import uuid
+
+
+# Claims the shard lock for this member or refreshes it if already held.
+_CLAIM = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# Releases the shard lock only if this member still holds it.
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def shard_name(name, shard):
+    return name if shard is None else f"{name}.{shard}"
+
+
+class ShardMembership:
+    """Assigns aggregation shards to live replicas through Redis.
+
+    Every replica heartbeats into a sorted set scored by time; members that miss
+    ``ttl`` seconds of heartbeats drop out. Each shard's target owner is picked by
+    rendezvous hashing over the live members, so a member joining or leaving only
+    moves the shards it wins or loses. Ownership itself is a per-shard lock with
+    the same TTL: a replica consumes a shard only while it holds that lock, and a
+    new owner can claim it only once the previous owner has released it (after its
+    final checkpoint) or stopped refreshing it.
+    """
+
+    def __init__(self, client, shards, ttl, prefix="aggregation_shards", member_id=None):
+        self.client = client
+        self.shards = shards
+        self.ttl = ttl
+        self.prefix = prefix
+        self.member_id = member_id or f"{os.getenv('HOSTNAME', 'aggregation')}-{uuid.uuid4().hex[:8]}"
+        self._claim = client.register_script(_CLAIM)
+        self._release = client.register_script(_RELEASE)
+
+    def _lock(self, shard):
+        return f"{self.prefix}:owner:{shard}"
+
+    def heartbeat(self):
+        now = time.time()
+        members_key = f"{self.prefix}:members"
+        pipe = self.client.pipeline()
+        pipe.zadd(members_key, {self.member_id: now})
+        pipe.zremrangebyscore(members_key, "-inf", now - self.ttl)
+        pipe.zrange(members_key, 0, -1)
+        return [member.decode() for member in pipe.execute()[-1]]
+
+    def assigned(self, members):
+        return {
+            shard for shard in range(self.shards)
+            if max(members, key=lambda member: _hash64(f"{member}:{shard}")) == self.member_id
+        }
+
+    def claim(self, shard):
+        return bool(self._claim(keys=[self._lock(shard)], args=[self.member_id, int(self.ttl * 1000)]))
+
+    def release(self, shard):
+        self._release(keys=[self._lock(shard)], args=[self.member_id])
+
+    def leave(self):
+        self.client.zrem(f"{self.prefix}:members", self.member_id)
+
+
+__all__ = ["ShardMembership", "shard_name"]
@@ -0,0 +1,86 @@
+"""Bytes and CPU per message for each message codec.
+
+    python benchmarks/codec_bench.py [--iterations 20000]
+
+Uses the services' shared codec module; MessagePack needs ``pip install msgpack``.
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from messaging.codec import JSON, MSGPACK, decode, encode, msgpack  # noqa: E402
+
+
+def payloads():
+    # Same shapes as the producers' build_message()
+    conversation_id = f"conv-{uuid.uuid4().hex[:8]}"
+    schedule = {
+        "train_id": "123",
+        "departure_time": "2025-04-15T10:00:00",
+        "arrival_time": "2025-04-15T14:00:00",
+        "route": ["StationA", "StationB", "StationC"],
+        "message_id": "msg-1000",
+        "conversation_id": conversation_id,
+    }
+    ticket = {
+        "ticket_id": "456",
+        "train_id": "123",
+        "passenger_id": "789",
+        "seat_number": "12A",
+        "departure_time": "2025-04-15T10:00:00",
+        "message_id": "msg-1001",
+        "conversation_id": conversation_id,
+    }
+    passenger = {
+        "passenger_id": "789",
+        "name": "John Doe",
+        "contact_info": "john.doe@example.com",
+        "message_id": "msg-1002",
+        "conversation_id": conversation_id,
+    }
+    aggregated = {
+        "train_id": "123",
+        "join_key": "123",
+        "complete": True,
+        "schedule": schedule,
+        "tickets": [ticket] * 50,
+        "passengers": [passenger] * 50,
+    }
+    return {"schedule": schedule, "ticket": ticket, "passenger": passenger, "aggregated (50+50)": aggregated}
+
+
+def measure(content_type, payload, iterations):
+    body = encode(payload, content_type)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        encode(payload, content_type)
+    encode_us = (time.perf_counter() - started) / iterations * 1e6
+    started = time.perf_counter()
+    for _ in range(iterations):
+        decode(body, content_type)
+    decode_us = (time.perf_counter() - started) / iterations * 1e6
+    return len(body), encode_us, decode_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    codecs = [JSON] + ([MSGPACK] if msgpack is not None else [])
+    if msgpack is None:
+        print("msgpack is not installed; benchmarking JSON only", file=sys.stderr)
+    print(f"{'payload':<20} {'codec':<20} {'bytes/msg':>10} {'encode us':>10} {'decode us':>10}")
+    for name, payload in payloads().items():
+        iterations = max(1, args.iterations // 50) if name.startswith("aggregated") else args.iterations
+        for content_type in codecs:
+            size, encode_us, decode_us = measure(content_type, payload, iterations)
+            print(f"{name:<20} {content_type:<20} {size:>10} {encode_us:>10.2f} {decode_us:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
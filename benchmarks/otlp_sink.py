@@ -0,0 +1,144 @@
+"""A local OTLP/HTTP stand-in that counts what the services export and can simulate outages.
+
+    python benchmarks/otlp_sink.py [--port 4318] [--delay-ms 0] [--outage 30:60 ...]
+
+Point a service at it with DT_ENDPOINT=http://<host>:4318/v1/traces. It
+accepts span and metric exports (gzipped or not), counts requests, spans and
+bytes per path, and prints the totals every ``--report-interval`` seconds.
+During an outage it answers ``--outage-status`` (503 by default), as an
+overloaded or restarting collector would. Outages are scheduled from startup
+with ``--outage START:DURATION``, or started at runtime with
+``POST /outage?seconds=N``. ``GET /stats`` returns the totals as JSON.
+Decoding span counts needs opentelemetry-proto, which ships with the
+services' OTLP exporter.
+"""
+import argparse
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+except ImportError:  # Counts requests and bytes only
+    ExportTraceServiceRequest = None
+
+
+class OtlpSink(ThreadingHTTPServer):
+    """The server: totals per path, plus the outage schedule."""
+
+    daemon_threads = True
+
+    def __init__(self, address, delay_ms=0, outage_status=503, outages=()):
+        super().__init__(address, OtlpHandler)
+        self.delay_ms = delay_ms
+        self.outage_status = outage_status
+        self.started = time.monotonic()
+        self.outages = [(self.started + start, self.started + start + duration) for start, duration in outages]
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def down(self):
+        now = time.monotonic()
+        return any(start <= now < end for start, end in self.outages)
+
+    def add_outage(self, seconds):
+        now = time.monotonic()
+        with self.lock:
+            self.outages.append((now, now + seconds))
+
+    def count(self, path, key, value=1):
+        with self.lock:
+            totals = self.totals.setdefault(path, {"requests": 0, "rejected": 0, "spans": 0, "bytes": 0, "raw_bytes": 0})
+            totals[key] += value
+
+    def stats(self):
+        with self.lock:
+            return {path: dict(totals) for path, totals in self.totals.items()}
+
+
+class OtlpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body=b"", content_type="application/x-protobuf"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/stats":
+            self._reply(200, json.dumps(self.server.stats()).encode(), "application/json")
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if url.path == "/outage":
+            seconds = float(parse_qs(url.query).get("seconds", ["30"])[0])
+            self.server.add_outage(seconds)
+            self._reply(200, json.dumps({"down_for": seconds}).encode(), "application/json")
+            return
+        sink = self.server
+        if sink.delay_ms:
+            time.sleep(sink.delay_ms / 1000)
+        if sink.down():
+            sink.count(url.path, "rejected")
+            self._reply(sink.outage_status)
+            return
+        raw = gzip.decompress(body) if self.headers.get("Content-Encoding") == "gzip" else body
+        sink.count(url.path, "requests")
+        sink.count(url.path, "bytes", len(body))
+        sink.count(url.path, "raw_bytes", len(raw))
+        if url.path.endswith("/v1/traces") and ExportTraceServiceRequest is not None:
+            request = ExportTraceServiceRequest.FromString(raw)
+            sink.count(url.path, "spans", sum(
+                len(scope.spans) for resource in request.resource_spans for scope in resource.scope_spans))
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, host="127.0.0.1", **kwargs):
+    """Start a sink on a background thread; returns it (its port is ``server_address[1]``)."""
+    sink = OtlpSink((host, port), **kwargs)
+    threading.Thread(target=sink.serve_forever, name="otlp-sink", daemon=True).start()
+    return sink
+
+
+def outage(text):
+    start_at, _, duration = text.partition(":")
+    return float(start_at), float(duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--delay-ms", type=float, default=0, help="added to every export, as a slow collector")
+    parser.add_argument("--outage", type=outage, action="append", default=[], metavar="START:DURATION",
+                        help="seconds after startup and for how long exports are refused; repeatable")
+    parser.add_argument("--outage-status", type=int, default=503)
+    parser.add_argument("--report-interval", type=float, default=10)
+    args = parser.parse_args()
+
+    sink = start(args.port, args.host, delay_ms=args.delay_ms, outage_status=args.outage_status, outages=args.outage)
+    print(f"OTLP sink listening on {args.host}:{sink.server_address[1]}", flush=True)
+    try:
+        while True:
+            time.sleep(args.report_interval)
+            state = "down" if sink.down() else "up"
+            print(f"[{time.monotonic() - sink.started:7.1f}s {state}] {json.dumps(sink.stats(), sort_keys=True)}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.shutdown()
+
+
+if __name__ == "__main__":
+    main()
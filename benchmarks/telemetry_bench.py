@@ -0,0 +1,111 @@
+"""Import, setup and per-message cost of the services' telemetry, with tracing off and on.
+
+    python benchmarks/telemetry_bench.py [--iterations 20000] [--repeat 3]
+
+Each mode runs in a fresh interpreter on the services' shared ``telemetry``
+package and ``messaging.tracing``. Modes that export send OTLP/HTTP to a local sink started
+by this script (``otlp_sink.py``), so spans are serialized, compressed
+and posted as in production but nothing leaves the host. Needs the services' requirements installed.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import otlp_sink
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Environment per mode, on top of the caller's; "off" is the no-op fast path
+MODES = {
+    "off": {"TRACE_EXPORTER": "none"},
+    "on": {"TRACE_EXPORTER": "otlp"},
+    "head 10%": {"TRACE_EXPORTER": "otlp", "TRACE_SAMPLER": "ratio", "TRACE_SAMPLE_RATIO": "0.1"},
+    "tail 10%": {"TRACE_EXPORTER": "otlp", "TRACE_TAIL_SAMPLING": "1", "TRACE_TAIL_KEEP_RATIO": "0.1"},
+}
+
+
+def child(iterations):
+    """Runs in the fresh interpreter: time the import, setup and a consumer-shaped hot loop."""
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    from telemetry import otel
+    import_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    otel.setup()
+    setup_ms = (time.perf_counter() - started) * 1000
+
+    from opentelemetry.trace import SpanKind
+    from messaging.tracing import context_of, message_headers
+
+    tracer = otel.tracer
+    # What a consumer receives from sampled producers, one trace per message
+    rng = random.Random(1)
+    incoming = [{"traceparent": f"00-{rng.getrandbits(128):032x}-{rng.getrandbits(64):016x}-01"} for _ in range(1024)]
+    attributes = {"messaging.system": "rabbitmq", "messaging.destination.name": "AggregationQueue",
+                  "messaging.operation.type": "receive"}
+
+    def handle(i):
+        # Receive span continuing the sender's trace, a process span, and headers for the next hop
+        with tracer.start_as_current_span("receive", context=context_of(incoming[i % 1024]), kind=SpanKind.CONSUMER,
+                                          attributes=attributes) as span:
+            span.set_attribute("messaging.message.id", i)
+            with tracer.start_as_current_span("process", kind=SpanKind.INTERNAL):
+                return message_headers()
+
+    for i in range(min(1000, iterations)):
+        handle(i)
+    started = time.perf_counter()
+    for i in range(iterations):
+        handle(i)
+    message_us = (time.perf_counter() - started) / iterations * 1e6
+
+    if otel.tracer_provider is not None:
+        otel.tracer_provider.shutdown()
+    print(json.dumps({"import_ms": import_ms, "setup_ms": setup_ms, "message_us": message_us}))
+
+
+def run(mode, iterations, endpoint):
+    env = dict(os.environ, **MODES[mode], METRICS_PORT="0", DT_API_TOKEN="bench", TRACE_SPOOL_DIR="")
+    env.pop("DT_METRICS_ENDPOINT", None)
+    if env["TRACE_EXPORTER"] == "none":
+        env.pop("DT_ENDPOINT", None)
+    else:
+        env["DT_ENDPOINT"] = endpoint
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "--iterations", str(iterations)],
+                         env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per mode; medians are reported")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.iterations)
+        return
+
+    sink = otlp_sink.start()
+    endpoint = f"http://127.0.0.1:{sink.server_address[1]}/v1/traces"
+
+    print(f"{'mode':<10} {'import ms':>10} {'setup ms':>10} {'us/message':>11} {'spans':>8} {'export KB':>10}")
+    for mode in MODES:
+        before = sink.stats().get("/v1/traces", {})
+        results = [run(mode, args.iterations, endpoint) for _ in range(args.repeat)]
+        median = {key: statistics.median(r[key] for r in results) for key in results[0]}
+        after = sink.stats().get("/v1/traces", {})
+        spans = (after.get("spans", 0) - before.get("spans", 0)) // args.repeat
+        sent = (after.get("bytes", 0) - before.get("bytes", 0)) / args.repeat
+        print(f"{mode:<10} {median['import_ms']:>10.1f} {median['setup_ms']:>10.1f} {median['message_us']:>11.2f} "
+              f"{spans:>8} {sent / 1024:>10.1f}")
+    sink.shutdown()
+
+
+if __name__ == "__main__":
+    main()
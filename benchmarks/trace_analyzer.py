@@ -0,0 +1,334 @@
+"""Per-stage latency and critical-path breakdown from span files, without an APM backend.
+
+    python benchmarks/trace_analyzer.py PATH [PATH ...] [--by name|service] [--memory-mb 512] [--json]
+
+Reads OTLP/JSON lines as written by TRACE_EXPORTER=file (``spanfile.py``) or
+the OpenTelemetry Collector's file exporter, plain or gzipped. PATH may be a
+file or a directory, searched for ``*.jsonl`` and ``*.jsonl.gz``. Spans of all
+services are analyzed together, so point it at every service's files.
+
+Two passes keep memory bounded for dumps of any size:
+
+1. Stream every line once. Record each span's duration in its stage's
+   histogram, and append a compact record of the span to one of N partition
+   files chosen by trace ID. N is picked so that one partition fits in
+   ``--memory-mb``.
+2. Load one partition at a time, rebuild its traces and walk each trace's
+   critical path.
+
+The critical path starts at the end of the trace's latest span and walks
+backward. At each point it follows the span that finished last, and charges
+the time to that span's stage. The span's own time that no child covers is
+charged to the span itself. Where a message waited in a queue (the gap
+between a publish span ending and the consumer's span starting), the time
+is charged to ``wait > <consumer stage>``. Traces with missing spans (head
+or tail sampling, spans still in flight) are walked from every local root,
+and gaps between roots count as ``(untraced)``.
+"""
+import argparse
+import gzip
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy"))
+
+from histogram import Histogram  # noqa: E402
+
+PERCENTILES = (("p50", 50), ("p90", 90), ("p99", 99))
+UNTRACED = "(untraced)"
+# Rough bytes of memory per byte of input once a partition's spans are loaded, and input growth when gunzipped
+MEMORY_PER_INPUT_BYTE = 0.6
+GZIP_RATIO = 8
+
+
+def input_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.endswith((".jsonl", ".jsonl.gz")):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        yield from f
+
+
+def service_of(resource):
+    for attribute in resource.get("attributes", ()):
+        if attribute.get("key") == "service.name":
+            return attribute.get("value", {}).get("stringValue", "")
+    return ""
+
+
+def spans_of(request):
+    """(service, span) for every span of one ExportTraceServiceRequest."""
+    for resource_spans in request.get("resourceSpans", ()):
+        service = service_of(resource_spans.get("resource", {}))
+        for scope_spans in resource_spans.get("scopeSpans", ()):
+            for span in scope_spans.get("spans", ()):
+                yield service, span
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "stage", "start", "end", "subtree_end", "children")
+
+    def __init__(self, span_id, parent_id, stage, start, end):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.stage = stage
+        self.start = start
+        self.end = end
+        self.subtree_end = end
+        self.children = []
+
+
+class Analysis:
+    def __init__(self, by="name"):
+        self.by = by
+        self.stages = {}  # stage -> Histogram of span durations (us)
+        self.errors = {}  # stage -> spans with error status
+        self.critical = {}  # stage -> Histogram of critical-path time per trace where the stage is on it (us)
+        self.end_to_end = Histogram()  # us per trace
+        self.spans = 0
+        self.traces = 0
+        self.lines = 0
+        self.bad_lines = 0
+
+    def stage_of(self, service, span):
+        name = span.get("name", "")
+        return f"{service}/{name}" if self.by == "service" and service else name
+
+    # Pass 1
+
+    def scan(self, paths, partitions, directory):
+        files = [open(os.path.join(directory, f"{index:04d}.tsv"), "w", encoding="utf-8") for index in range(partitions)]
+        try:
+            for path in input_files(paths):
+                for line in read_lines(path):
+                    self.lines += 1
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash or a copy still being written
+                        self.bad_lines += 1
+                        continue
+                    for service, span in spans_of(request):
+                        self._record(service, span, files)
+        finally:
+            for f in files:
+                f.close()
+        return [f.name for f in files]
+
+    def _record(self, service, span, files):
+        stage = self.stage_of(service, span).replace("\t", " ").replace("\n", " ")
+        start = int(span.get("startTimeUnixNano", 0))
+        end = int(span.get("endTimeUnixNano", 0))
+        error = span.get("status", {}).get("code") == 2
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+            self.errors[stage] = 0
+        histogram.record(max(0, end - start) // 1000)
+        self.errors[stage] += error
+        self.spans += 1
+        trace_id = span.get("traceId", "")
+        partition = zlib.crc32(trace_id.encode()) % len(files)
+        files[partition].write(f"{trace_id}\t{span.get('spanId', '')}\t{span.get('parentSpanId', '')}\t{start}\t{end}\t{stage}\n")
+
+    # Pass 2
+
+    def analyze(self, partition_files):
+        for path in partition_files:
+            traces = {}
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    trace_id, span_id, parent_id, start, end, stage = line.rstrip("\n").split("\t", 5)
+                    traces.setdefault(trace_id, {})[span_id] = Span(span_id, parent_id, stage, int(start), int(end))
+            os.remove(path)
+            for spans in traces.values():
+                self._trace(spans)
+
+    def _trace(self, spans):
+        roots = []
+        for span in spans.values():
+            parent = spans.get(span.parent_id) if span.parent_id else None
+            if parent is None or parent is span:
+                roots.append(span)
+            else:
+                parent.children.append(span)
+        visited = set()
+        for root in roots:
+            _subtree_end(root, visited)
+        if len(visited) < len(spans):
+            # Parent cycles in corrupt input: walk what is reachable and treat the rest as roots
+            for span in spans.values():
+                if span.span_id not in visited:
+                    span.children = []
+                    roots.append(span)
+                    _subtree_end(span, visited)
+
+        start = min(root.start for root in roots)
+        end = max(root.subtree_end for root in roots)
+        path = {}
+        # A virtual span over the whole trace, with the local roots as children, walks all of them at once
+        top = Span(None, None, UNTRACED, start, start)
+        top.children = roots
+        top.subtree_end = end
+        _walk(top, end, path, None)
+        self.traces += 1
+        self.end_to_end.record((end - start) // 1000)
+        for stage, ns in path.items():
+            if ns > 0:
+                histogram = self.critical.get(stage)
+                if histogram is None:
+                    histogram = self.critical[stage] = Histogram()
+                histogram.record(ns // 1000)
+
+    # Report
+
+    def report(self):
+        def ms(us):
+            return None if us is None else round(us / 1000, 3)
+
+        def summary(histogram):
+            out = {"count": histogram.count, "mean_ms": ms(histogram.mean())}
+            out.update({f"{name}_ms": ms(histogram.percentile(p)) for name, p in PERCENTILES})
+            out["max_ms"] = ms(histogram.max)
+            return out
+
+        total_e2e = self.end_to_end.total or 1
+        return {
+            "spans": self.spans,
+            "traces": self.traces,
+            "lines": self.lines,
+            "unreadable_lines": self.bad_lines,
+            "end_to_end": summary(self.end_to_end),
+            "stages": {stage: {**summary(h), "errors": self.errors[stage]} for stage, h in self.stages.items()},
+            "critical_path": {
+                stage: {
+                    "share": round(h.total / total_e2e, 4),
+                    "traces": h.count,
+                    "per_trace_ms": ms(h.total / self.traces) if self.traces else None,
+                    **{f"{name}_ms": ms(h.percentile(p)) for name, p in PERCENTILES},
+                }
+                for stage, h in self.critical.items()
+            },
+        }
+
+
+def _subtree_end(span, visited):
+    # Iterative post-order: traces can be deep enough to hit the recursion limit
+    stack = [(span, False)]
+    while stack:
+        node, done = stack.pop()
+        if done:
+            for child in node.children:
+                node.subtree_end = max(node.subtree_end, child.subtree_end)
+            continue
+        if node.span_id in visited:
+            continue
+        visited.add(node.span_id)
+        stack.append((node, True))
+        stack.extend((child, False) for child in node.children if child.span_id not in visited)
+
+
+def _charge(span, start, end, path, next_stage):
+    """Charge [start, end) on the critical path: to ``span`` while it runs, to waiting for ``next_stage`` after."""
+    if end <= start:
+        return
+    own = max(0, min(end, span.end) - max(start, span.start))
+    if own:
+        path[span.stage] = path.get(span.stage, 0) + own
+    waited = (end - start) - own
+    if waited:
+        stage = UNTRACED if span.span_id is None else f"wait > {next_stage or span.stage}"
+        path[stage] = path.get(stage, 0) + waited
+
+
+def _walk(span, until, path, next_stage):
+    """Charge [span.start, until) of the critical path, latest first (iteratively, for deep traces)."""
+    stack = [(span, until, next_stage)]
+    while stack:
+        node, cursor, after = stack.pop()
+        pending = []
+        for child in sorted(node.children, key=lambda c: c.subtree_end, reverse=True):
+            if child.start >= cursor or cursor <= node.start:
+                continue
+            child_end = min(child.subtree_end, cursor)
+            _charge(node, child_end, cursor, path, after)
+            pending.append((child, child_end, after))
+            after = child.stage
+            cursor = max(child.start, node.start)
+        _charge(node, node.start, cursor, path, after)
+        stack.extend(pending)
+
+
+def partitions_for(paths, memory_mb):
+    size = 0
+    for path in input_files(paths):
+        size += os.path.getsize(path) * (GZIP_RATIO if path.endswith(".gz") else 1)
+    return max(1, math.ceil(size * MEMORY_PER_INPUT_BYTE / (memory_mb * 1024 * 1024)))
+
+
+def print_report(report, top):
+    def row(values, widths):
+        return "  ".join(str(v if v is not None else "-").rjust(w) if i else str(v).ljust(w) for i, (v, w) in enumerate(zip(values, widths)))
+
+    e2e = report["end_to_end"]
+    unreadable = f" ({report['unreadable_lines']} unreadable)" if report["unreadable_lines"] else ""
+    print(f"{report['traces']} traces, {report['spans']} spans from {report['lines']} lines{unreadable}")
+    print(f"end to end: mean {e2e['mean_ms']} ms, p50 {e2e['p50_ms']} ms, p90 {e2e['p90_ms']} ms, p99 {e2e['p99_ms']} ms, max {e2e['max_ms']} ms")
+
+    stages = sorted(report["stages"].items(), key=lambda item: item[1]["count"] * (item[1]["mean_ms"] or 0), reverse=True)[:top]
+    width = max([len("stage")] + [len(stage) for stage, _ in stages])
+    widths = (width, 9, 7, 10, 10, 10, 10, 10)
+    print()
+    print(row(("stage", "spans", "errors", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms"), widths))
+    for stage, s in stages:
+        print(row((stage, s["count"], s["errors"], s["mean_ms"], s["p50_ms"], s["p90_ms"], s["p99_ms"], s["max_ms"]), widths))
+
+    path = sorted(report["critical_path"].items(), key=lambda item: item[1]["share"], reverse=True)[:top]
+    width = max([len("critical path")] + [len(stage) for stage, _ in path])
+    widths = (width, 7, 9, 12, 10, 10, 10)
+    print()
+    print(row(("critical path", "share", "traces", "ms/trace", "p50 ms", "p90 ms", "p99 ms"), widths))
+    for stage, s in path:
+        print(row((stage, f"{s['share'] * 100:.1f}%", s["traces"], s["per_trace_ms"], s["p50_ms"], s["p90_ms"], s["p99_ms"]), widths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="span files or directories of them")
+    parser.add_argument("--by", choices=("name", "service"), default="name",
+                        help="stage is the span name, or service and span name (redis_set_last_message is in every service)")
+    parser.add_argument("--memory-mb", type=float, default=512, help="memory budget for one partition of traces")
+    parser.add_argument("--tmpdir", help="where partition files go (about a third of the input size); default: system temp")
+    parser.add_argument("--top", type=int, default=30, help="rows per table")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    analysis = Analysis(by=args.by)
+    partitions = partitions_for(args.paths, args.memory_mb)
+    with tempfile.TemporaryDirectory(prefix="trace-analyzer-", dir=args.tmpdir) as directory:
+        analysis.analyze(analysis.scan(args.paths, partitions, directory))
+    report = analysis.report()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report, args.top)
+        print(f"\nanalyzed in {time.monotonic() - started:.1f} s using {partitions} partition(s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:  # JSON keeps working without it
+    msgpack = None
+
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+_CODECS = {"json": JSON, "msgpack": MSGPACK}
+MESSAGE_CODEC = os.getenv("MESSAGE_CODEC", "json")
+if MESSAGE_CODEC not in _CODECS:
+    raise ValueError(f"Unknown MESSAGE_CODEC {MESSAGE_CODEC!r}; expected one of {sorted(_CODECS)}")
+# Content type this service publishes with
+CONTENT_TYPE = _CODECS[MESSAGE_CODEC]
+if CONTENT_TYPE == MSGPACK and msgpack is None:
+    raise ImportError("MESSAGE_CODEC=msgpack requires the msgpack package")
+
+
+def encode(obj, content_type=CONTENT_TYPE):
+    """Serialize ``obj`` once; the bytes can be reused for every queue and Redis write."""
+    if content_type == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj).encode()
+
+
+def decode(body, content_type=None):
+    """Decode a body by its AMQP content type. Messages without one are JSON (older producers)."""
+    if content_type == MSGPACK:
+        if msgpack is None:
+            raise ImportError("Received an application/msgpack message but msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def content_type_of(properties):
+    return getattr(properties, "content_type", None) or JSON
+
+
+__all__ = ["CONTENT_TYPE", "JSON", "MSGPACK", "content_type_of", "decode", "encode"]
@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+import time
+
+import pika
+from opentelemetry.metrics import Observation
+from pika.exceptions import AMQPChannelError, AMQPConnectionError, ChannelClosedByBroker
+
+from telemetry import meter
+from .tracing import receive_attributes
+
+
+# Seconds between polls of queue depths from the broker; 0 disables the queue gauges
+METRICS_QUEUE_POLL_INTERVAL = float(os.getenv("METRICS_QUEUE_POLL_INTERVAL", "15"))
+
+DESTINATION = "messaging.destination.name"
+
+messages_received = meter.create_counter(
+    "messaging.client.consumed.messages", unit="{message}", description="Messages delivered to this service, per queue")
+messages_sent = meter.create_counter(
+    "messaging.client.sent.messages", unit="{message}", description="Messages published by this service, per queue")
+process_duration = meter.create_histogram(
+    "messaging.process.duration", unit="ms", description="Time to handle one delivery")
+publish_duration = meter.create_histogram(
+    "messaging.publish.duration", unit="ms", description="Time to publish one message or batch")
+queue_wait = meter.create_histogram(
+    "messaging.queue.wait.duration", unit="ms", description="Time messages spent in the queue before delivery")
+
+# Queue wait of the latest delivery per queue, for the consumer lag gauge
+_last_wait = {}
+
+
+def record_received(queue, properties, received_at=None):
+    """Count a delivery from ``queue`` and record its queue wait, when the sender stamped one."""
+    attributes = {DESTINATION: queue}
+    messages_received.add(1, attributes)
+    wait = receive_attributes(properties, received_at).get("messaging.queue_wait_ms")
+    if wait is not None:
+        queue_wait.record(wait, attributes)
+        _last_wait[queue] = wait
+
+
+def record_sent(queue, count=1, elapsed_ms=None, operation="publish"):
+    attributes = {DESTINATION: queue}
+    if count:
+        messages_sent.add(count, attributes)
+    if elapsed_ms is not None:
+        publish_duration.record(elapsed_ms, {**attributes, "messaging.operation.name": operation})
+
+
+def elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+class QueueWatcher:
+    """Message and consumer counts of a set of queues, polled from RabbitMQ in one pass.
+
+    A background thread passively declares every watched queue on one channel
+    each ``interval`` seconds and caches the counts, so metric collections
+    (Prometheus scrapes, OTLP exports) read the cache and never wait on the
+    broker. A queue that does not exist yet is skipped until it does.
+    """
+
+    def __init__(self, queues=(), interval=METRICS_QUEUE_POLL_INTERVAL):
+        self.params = pika.ConnectionParameters(
+            host=os.getenv("RABBITMQ_HOST", "rabbitmq"),
+            port=int(os.getenv("RABBITMQ_PORT", "5672")),
+            credentials=pika.PlainCredentials("admin", "password"),
+        )
+        self.interval = interval
+        self.queues = set(queues)
+        self.counts = {}  # queue -> (ready messages, consumers)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="queue-watcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, queues):
+        with self._lock:
+            self.queues.update(queues)
+
+    def _poll(self, connection, channel):
+        with self._lock:
+            queues = sorted(self.queues)
+        counts = {}
+        for queue in queues:
+            try:
+                frame = channel.queue_declare(queue=queue, passive=True)
+                counts[queue] = (frame.method.message_count, frame.method.consumer_count)
+            except ChannelClosedByBroker:
+                # 404: not declared yet; the broker closed the channel
+                channel = connection.channel()
+        self.counts = counts
+        return channel
+
+    def _run(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(self.params)
+                channel = connection.channel()
+                while True:
+                    channel = self._poll(connection, channel)
+                    # Services heartbeats while waiting
+                    connection.sleep(self.interval)
+            except (AMQPConnectionError, AMQPChannelError, OSError) as exc:
+                print(f"QueueWatcher: {type(exc).__name__}: {exc}; reconnecting", flush=True, file=sys.stdout)
+                self.counts = {}
+                time.sleep(self.interval)
+
+
+_watcher = None
+_watcher_pid = None
+_watcher_lock = threading.Lock()
+
+
+def watch_queues(queues):
+    """Add ``queues`` to this process's queue gauges, starting the poller on first use."""
+    global _watcher, _watcher_pid
+    if METRICS_QUEUE_POLL_INTERVAL <= 0:
+        return
+    with _watcher_lock:
+        if _watcher is None or _watcher_pid != os.getpid():
+            _watcher = QueueWatcher(queues).start()
+            _watcher_pid = os.getpid()
+        else:
+            _watcher.add(queues)
+
+
+def _observe(index):
+    def callback(options):
+        counts = _watcher.counts if _watcher is not None else {}
+        return [Observation(values[index], {DESTINATION: queue}) for queue, values in counts.items()]
+    return callback
+
+
+meter.create_observable_gauge(
+    "rabbitmq.queue.messages", callbacks=[_observe(0)], unit="{message}", description="Messages ready in the queue")
+meter.create_observable_gauge(
+    "rabbitmq.queue.consumers", callbacks=[_observe(1)], unit="{consumer}", description="Consumers attached to the queue")
+meter.create_observable_gauge(
+    "messaging.consumer.lag", callbacks=[lambda options: [Observation(wait, {DESTINATION: queue}) for queue, wait in list(_last_wait.items())]],
+    unit="ms", description="Queue wait of the latest delivery from the queue")
+
+
+__all__ = ["elapsed_ms", "process_duration", "record_received", "record_sent", "watch_queues"]
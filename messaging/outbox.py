@@ -0,0 +1,398 @@
+import collections
+import json
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+import time
+
+import pika
+import redis
+from pika.spec import Basic
+
+from .metrics import elapsed_ms, record_sent
+from .rabbit import RABBITMQ_HEARTBEAT, RABBITMQ_HOST, RABBITMQ_PORT
+from .store import get_redis
+from .tracing import publish_properties
+
+
+# Route single-message publishes through the outbox; 0 publishes synchronously through the channel pool
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1") == "1"
+# Record every outbox entry in Redis until it is confirmed, so it survives a restart of this process
+OUTBOX_DURABLE = os.getenv("OUTBOX_DURABLE", "1") == "1"
+OUTBOX_KEY = os.getenv("OUTBOX_KEY")
+# Entries pending plus in flight before new publishes are refused
+OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", "100000"))
+# Unconfirmed publishes allowed on the channel at once
+OUTBOX_MAX_IN_FLIGHT = int(os.getenv("OUTBOX_MAX_IN_FLIGHT", "1000"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "0.1"))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "30.0"))
+# Seconds an outbox's Redis record stays owned without a lease refresh; after that a live replica adopts it
+OUTBOX_LEASE_TTL = float(os.getenv("OUTBOX_LEASE_TTL", "30"))
+# Seconds between deletes of confirmed entries from the Redis record
+OUTBOX_DELETE_INTERVAL = 0.1
+
+
+# Deletes a lease only if this owner still holds it
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def backoff(attempt):
+    """Full-jitter exponential backoff for the ``attempt``-th retry."""
+    return random.uniform(0, min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** attempt))
+
+
+class OutboxEntry:
+    __slots__ = ("id", "routing_key", "body", "content_type", "headers", "correlation_id", "destination", "attempts", "started")
+
+    def __init__(self, id, routing_key, body, content_type=None, headers=None, correlation_id=None, destination=None, attempts=0):
+        self.id = id
+        self.routing_key = routing_key
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers
+        self.correlation_id = correlation_id
+        self.destination = destination
+        self.attempts = attempts
+        # Not recorded in Redis: a recovered entry is counted as sent without a publish duration
+        self.started = None
+
+    def dump(self):
+        # Bodies may be MessagePack, so they round-trip through JSON as latin-1 text
+        return json.dumps({"r": self.routing_key, "b": self.body.decode("latin-1"), "c": self.content_type, "h": self.headers, "i": self.correlation_id, "d": self.destination})
+
+    @classmethod
+    def load(cls, id, value):
+        state = json.loads(value)
+        return cls(id, state["r"], state["b"].encode("latin-1"), state["c"], state.get("h"), state.get("i"), state.get("d"))
+
+
+class Outbox:
+    """Asynchronous, confirmed publishing for one producer process.
+
+    Callers hand entries over with ``submit`` and return without waiting for the
+    broker. A background thread runs a pika SelectConnection with publisher
+    confirms and publishes up to ``max_in_flight`` entries ahead of their
+    confirms, tracking each by delivery tag. An ack (single or ``multiple``)
+    completes an entry. A nack, or a ``mandatory`` publish the broker returned as
+    unroutable, schedules a retry with jittered exponential backoff. Entries
+    still in flight when the connection drops are published again after
+    reconnecting, so delivery is at least once and each entry's ``id`` is sent
+    as the AMQP ``message_id`` for consumers that deduplicate.
+
+    With a Redis ``client`` the outbox is durable. ``stage`` adds the entry to a
+    pipeline so that it commits together with the caller's own Redis writes, and
+    confirmed entries are deleted in batches. On start, entries left in ``key``
+    by a previous run of this process are published again.
+
+    Hostnames change when a pod is rescheduled, so a durable outbox also holds a
+    lease on its record (``<key>:lease``), refreshed every third of
+    ``lease_ttl``. Every ``lease_ttl`` it scans for other records under
+    ``prefix`` whose lease has expired, claims each with ``SET NX``, moves its
+    entries into ``key`` and publishes them. Entries left by a dead replica are
+    therefore published by a live one, and none stay in Redis for good.
+    """
+
+    def __init__(self, queues=(), client=None, key=None, prefix=None, lease_ttl=OUTBOX_LEASE_TTL,
+                 max_pending=OUTBOX_MAX_PENDING, max_in_flight=OUTBOX_MAX_IN_FLIGHT):
+        self.params = pika.ConnectionParameters(
+            host=RABBITMQ_HOST,
+            port=RABBITMQ_PORT,
+            credentials=pika.PlainCredentials("admin", "password"),
+            heartbeat=RABBITMQ_HEARTBEAT,
+        )
+        self.queues = tuple(queues)
+        self.client = client
+        self.key = key
+        self.prefix = prefix
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{os.urandom(4).hex()}"
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self._pending = collections.deque()
+        self._in_flight = collections.OrderedDict()  # delivery tag -> entry, in publish order
+        self._returned = set()
+        self._confirmed_ids = []
+        self._delayed = {}  # entry id -> entry waiting out its retry backoff
+        self._next_tag = 0
+        self._connection = None
+        self._channel = None
+        self._wake_scheduled = threading.Event()
+        self._delete_scheduled = False
+        self._reconnect_delay = 1.0
+        self._lock = threading.Lock()
+        self.counts = {"submitted": 0, "published": 0, "confirmed": 0, "nacked": 0, "returned": 0, "retried": 0, "recovered": 0, "adopted": 0}
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._lease_thread = threading.Thread(target=self._hold_lease, name="outbox-lease", daemon=True)
+
+    def start(self):
+        if self.client is not None:
+            self._release = self.client.register_script(_RELEASE)
+            self.client.set(f"{self.key}:lease", self.owner, px=int(self.lease_ttl * 1000))
+            for id, value in sorted(self.client.hscan_iter(self.key, count=1000)):
+                self._pending.append(OutboxEntry.load(id.decode(), value))
+                self.counts["recovered"] += 1
+            self._lease_thread.start()
+        self._thread.start()
+        return self
+
+    def depth(self):
+        return len(self._pending) + len(self._delayed) + len(self._in_flight)
+
+    def entry(self, routing_key, body, content_type=None, headers=None, correlation_id=None, destination=None):
+        """A new entry for ``body``; raises queue.Full when the outbox is at ``max_pending``.
+
+        ``headers`` (e.g. ``tracing.message_headers()``) are captured now, on the
+        caller's span, and sent with every publish of the entry. The entry is
+        counted as sent to ``destination`` (the routing key by default) once the
+        broker confirms it, with the time from now to that confirm as its
+        publish duration.
+        """
+        if self.depth() >= self.max_pending:
+            raise queue.Full(f"Outbox holds {self.depth()} unconfirmed messages (OUTBOX_MAX_PENDING={self.max_pending})")
+        # Sortable ids so that recovered entries go out roughly in their original order
+        entry = OutboxEntry(f"{time.time_ns():016x}{os.urandom(4).hex()}", routing_key, body, content_type, headers, correlation_id, destination)
+        entry.started = time.perf_counter()
+        return entry
+
+    def stage(self, pipe, entry):
+        if self.client is not None:
+            pipe.hset(self.key, entry.id, entry.dump())
+
+    def submit(self, entry):
+        with self._lock:
+            self.counts["submitted"] += 1
+        self._pending.append(entry)
+        self._wake()
+
+    def stats(self):
+        return {
+            "pending": len(self._pending) + len(self._delayed),
+            "in_flight": len(self._in_flight),
+            "connected": self._channel is not None,
+            **self.counts,
+        }
+
+    def _hold_lease(self):
+        # Runs on its own thread, so that the lease outlives RabbitMQ outages
+        adopt_at = time.monotonic() + self.lease_ttl
+        while True:
+            time.sleep(self.lease_ttl / 3)
+            try:
+                self.client.set(f"{self.key}:lease", self.owner, px=int(self.lease_ttl * 1000))
+                if self.prefix and time.monotonic() >= adopt_at:
+                    adopt_at = time.monotonic() + self.lease_ttl
+                    for key in self._orphans():
+                        self._adopt(key)
+            except redis.RedisError as exc:
+                print(f"Outbox: Failed to refresh lease or adopt records: {exc}", flush=True, file=sys.stdout)
+
+    def _orphans(self):
+        keys = [key.decode() for key in self.client.scan_iter(match=f"{self.prefix}:*", count=1000)]
+        records = [key for key in keys if key != self.key and not key.endswith(":lease")]
+        leased = set(key for key in keys if key.endswith(":lease"))
+        return [key for key in records if f"{key}:lease" not in leased and self.client.type(key) == b"hash"]
+
+    def _adopt(self, key):
+        lease = f"{key}:lease"
+        if not self.client.set(lease, self.owner, nx=True, px=int(self.lease_ttl * 1000)):
+            return  # Its owner is back, or another replica is adopting it
+        adopted = []
+        cursor = 0
+        try:
+            while True:
+                # Each chunk moves to our record in one MULTI, so no entry is ever in neither record
+                cursor, chunk = self.client.hscan(key, cursor, count=1000)
+                if chunk:
+                    pipe = self.client.pipeline(transaction=True)
+                    pipe.hset(self.key, mapping=chunk)
+                    pipe.hdel(key, *chunk)
+                    pipe.execute()
+                    adopted.extend(OutboxEntry.load(id.decode(), value) for id, value in chunk.items())
+                if cursor == 0:
+                    break
+        finally:
+            self._release(keys=[lease], args=[self.owner])
+            if adopted:
+                adopted.sort(key=lambda entry: entry.id)
+                with self._lock:
+                    self.counts["adopted"] += len(adopted)
+                self._pending.extend(adopted)
+                print(f"Outbox: Adopted {len(adopted)} unconfirmed entries from {key}", flush=True, file=sys.stdout)
+                self._wake()
+
+    def _wake(self):
+        if self._wake_scheduled.is_set():
+            return
+        self._wake_scheduled.set()
+        connection = self._connection
+        try:
+            if connection is not None:
+                connection.ioloop.add_callback_threadsafe(self._flush)
+                return
+        except Exception:
+            pass
+        # Not connected: the channel flushes on open
+        self._wake_scheduled.clear()
+
+    # Everything below runs on the outbox thread.
+
+    def _run(self):
+        while True:
+            self._connection = pika.SelectConnection(
+                self.params,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_closed,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+            self._connection = None
+            time.sleep(self._reconnect_delay)
+            self._reconnect_delay = min(self._reconnect_delay * 2, OUTBOX_RETRY_MAX)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, connection, reason):
+        print(f"Outbox: RabbitMQ connection closed: {reason}", flush=True, file=sys.stdout)
+        self._requeue_in_flight()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        remaining = [len(self.queues)]
+
+        def declared(_frame=None):
+            remaining[0] -= 1
+            if remaining[0] <= 0:
+                channel.confirm_delivery(self._on_confirm, callback=lambda _frame: self._on_ready(channel))
+
+        for q in self.queues:
+            channel.queue_declare(queue=q, durable=True, callback=declared)
+        if not self.queues:
+            declared()
+
+    def _on_ready(self, channel):
+        self._channel = channel
+        self._next_tag = 0
+        self._reconnect_delay = 1.0
+        self._flush()
+
+    def _on_channel_closed(self, channel, reason):
+        print(f"Outbox: channel closed: {reason}", flush=True, file=sys.stdout)
+        self._channel = None
+        self._requeue_in_flight()
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _requeue_in_flight(self):
+        # Their confirms are lost with the channel; publishing again may duplicate.
+        # Retry timers die with the ioloop, so entries waiting on one go back too.
+        self._channel = None
+        self._pending.extendleft(reversed(list(self._in_flight.values())))
+        self._pending.extend(self._delayed.values())
+        self._in_flight.clear()
+        self._delayed.clear()
+        self._returned.clear()
+
+    def _flush(self):
+        self._wake_scheduled.clear()
+        channel = self._channel
+        while channel is not None and self._pending and len(self._in_flight) < self.max_in_flight:
+            entry = self._pending.popleft()
+            self._next_tag += 1
+            self._in_flight[self._next_tag] = entry
+            channel.basic_publish(
+                exchange="",
+                routing_key=entry.routing_key,
+                body=entry.body,
+                # Stamped per attempt, so the consumer's queue wait excludes time spent here
+                properties=publish_properties(entry.content_type, entry.headers or {}, message_id=entry.id, correlation_id=entry.correlation_id),
+                mandatory=True,
+            )
+            self.counts["published"] += 1
+
+    def _on_return(self, channel, method, properties, body):
+        # Basic.Return precedes the ack of the same publish
+        self._returned.add(properties.message_id)
+        self.counts["returned"] += 1
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self._in_flight if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._in_flight else []
+        for tag in tags:
+            entry = self._in_flight.pop(tag)
+            if acked and entry.id not in self._returned:
+                self.counts["confirmed"] += 1
+                self._confirmed_ids.append(entry.id)
+                record_sent(entry.destination or entry.routing_key, 1, None if entry.started is None else elapsed_ms(entry.started))
+            else:
+                self._returned.discard(entry.id)
+                if not acked:
+                    self.counts["nacked"] += 1
+                self._retry(entry)
+        if self._confirmed_ids and self.client is not None and not self._delete_scheduled:
+            self._delete_scheduled = True
+            self._connection.ioloop.call_later(OUTBOX_DELETE_INTERVAL, self._delete_confirmed)
+        elif self.client is None:
+            self._confirmed_ids.clear()
+        self._flush()
+
+    def _retry(self, entry):
+        delay = backoff(entry.attempts)
+        entry.attempts += 1
+        self.counts["retried"] += 1
+        self._delayed[entry.id] = entry
+
+        def requeue():
+            if self._delayed.pop(entry.id, None) is not None:
+                self._pending.append(entry)
+                self._flush()
+
+        self._connection.ioloop.call_later(delay, requeue)
+
+    def _delete_confirmed(self):
+        self._delete_scheduled = False
+        ids, self._confirmed_ids = self._confirmed_ids, []
+        if not ids:
+            return
+        try:
+            self.client.hdel(self.key, *ids)
+        except redis.RedisError as exc:
+            # The entries are delivered; at worst they are published again after a restart
+            print(f"Outbox: Failed to delete {len(ids)} confirmed entries: {exc}", flush=True, file=sys.stdout)
+
+
+_outbox = None
+_outbox_pid = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox(name, queues=()):
+    """Return this process's outbox, starting it (and replaying its Redis record) on first use."""
+    global _outbox, _outbox_pid
+    if _outbox is None or _outbox_pid != os.getpid():
+        with _outbox_lock:
+            if _outbox is None or _outbox_pid != os.getpid():
+                client = get_redis() if OUTBOX_DURABLE else None
+                # Keyed by host so that a restarted pod with a stable name picks up its own entries at once;
+                # records of hosts that are gone are adopted by a live replica once their lease expires
+                key = OUTBOX_KEY or f"outbox:{name}:{socket.gethostname()}"
+                _outbox = Outbox(queues=queues, client=client, key=key, prefix=f"outbox:{name}").start()
+                _outbox_pid = os.getpid()
+    return _outbox
+
+
+__all__ = ["OUTBOX_ENABLED", "Outbox", "OutboxEntry", "get_outbox"]
@@ -0,0 +1,489 @@
+import hashlib
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+from pika.spec import Basic
+
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
+RABBITMQ_POOL_SIZE = int(os.getenv("RABBITMQ_POOL_SIZE", "4"))
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", "60"))
+# Messages published per batch before waiting for the broker to confirm them
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "500"))
+# Submissions (a single message or a whole batch each) waiting for the publisher thread
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", "10000"))
+# How long submit() waits for room in a full queue before raising queue.Full
+PUBLISH_ENQUEUE_TIMEOUT = float(os.getenv("PUBLISH_ENQUEUE_TIMEOUT", "1.0"))
+# Seconds a caller waits for its messages to be confirmed
+PUBLISH_TIMEOUT = float(os.getenv("PUBLISH_TIMEOUT", "30"))
+# Aggregation input shards; must match AggregationService. 0 publishes to the unsharded queues.
+AGGREGATION_SHARDS = int(os.getenv("AGGREGATION_SHARDS", "0"))
+# Messages are sharded by AggregationService's join key, so these must match its settings
+AGGREGATION_MODE = os.getenv("AGGREGATION_MODE", "join")
+AGGREGATION_JOIN_KEYS = os.getenv(
+    "AGGREGATION_JOIN_KEYS",
+    "train_id,conversation_id" if AGGREGATION_MODE == "batch" else "conversation_id,train_id",
+).split(",")
+
+# Errors after which a pooled connection is discarded and rebuilt.
+RECONNECT_ERRORS = (AMQPConnectionError, AMQPChannelError, ConnectionError, OSError)
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash: growing ``buckets`` by one moves only 1/buckets of the keys."""
+    k = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        k = (k * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((k >> 33) + 1)))
+    return b
+
+
+def shard_index(message):
+    """Aggregation shard of a message, or None when sharding is off.
+
+    Every part of a join must land on the same shard, so the key is the join key:
+    the first of AGGREGATION_JOIN_KEYS present, as AggregationService picks it.
+    """
+    if AGGREGATION_SHARDS <= 0:
+        return None
+    key = next((str(message[field]) for field in AGGREGATION_JOIN_KEYS if message.get(field)), "")
+    return jump_hash(key, AGGREGATION_SHARDS)
+
+
+def shard_queue(queue_name, message):
+    """Route an aggregation input to its shard queue, e.g. ``ScheduleQueue.3``."""
+    shard = shard_index(message)
+    return queue_name if shard is None else f"{queue_name}.{shard}"
+
+
+def shard_queues(queue_name):
+    if AGGREGATION_SHARDS <= 0:
+        return [queue_name]
+    return [f"{queue_name}.{shard}" for shard in range(AGGREGATION_SHARDS)]
+
+
+class _PooledChannel:
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def healthy(self):
+        if not (self.connection.is_open and self.channel.is_open):
+            return False
+        try:
+            # Services heartbeats and surfaces a broker-side close while idle.
+            self.connection.process_data_events(time_limit=0)
+        except RECONNECT_ERRORS:
+            return False
+        return self.connection.is_open and self.channel.is_open
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+
+
+class ChannelPool:
+    """Long-lived RabbitMQ channels shared by the request threads of one process.
+
+    pika's BlockingConnection is not thread-safe, so every pooled connection owns
+    exactly one channel and is checked out by a single thread at a time.
+    """
+
+    def __init__(self, host=RABBITMQ_HOST, port=RABBITMQ_PORT, size=RABBITMQ_POOL_SIZE, queues=()):
+        self.params = pika.ConnectionParameters(
+            host=host,
+            port=port,
+            credentials=pika.PlainCredentials("admin", "password"),
+            heartbeat=RABBITMQ_HEARTBEAT,
+        )
+        self.queues = tuple(queues)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._declared = False
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    def _connect(self):
+        connection = pika.BlockingConnection(self.params)
+        try:
+            channel = connection.channel()
+            with self._lock:
+                if not self._declared:
+                    for q in self.queues:
+                        channel.queue_declare(queue=q, durable=True)
+                    self._declared = True
+        except Exception:
+            connection.close()
+            raise
+        self.connects += 1
+        return _PooledChannel(connection, channel)
+
+    def _checkout(self):
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if pooled.healthy():
+                return pooled
+            pooled.close()
+
+    @contextmanager
+    def checkout(self):
+        self._slots.acquire()
+        pooled = None
+        try:
+            pooled = self._checkout()
+            yield pooled
+        except RECONNECT_ERRORS:
+            if pooled is not None:
+                pooled.close()
+                pooled = None
+            raise
+        finally:
+            if pooled is not None:
+                self._idle.put(pooled)
+            self._slots.release()
+
+    @contextmanager
+    def channel(self):
+        with self.checkout() as pooled:
+            yield pooled.channel
+
+    def publish(self, routing_key, body, properties=None, exchange=""):
+        # One transparent retry covers a connection the broker dropped while idle.
+        try:
+            with self.channel() as channel:
+                channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        except RECONNECT_ERRORS:
+            with self.channel() as channel:
+                channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class _Submission:
+    __slots__ = ("messages", "properties", "exchange", "future", "offset", "published", "failed", "batches", "started")
+
+    def __init__(self, messages, properties, exchange):
+        self.messages = messages
+        self.properties = properties
+        self.exchange = exchange
+        self.future = Future()
+        self.offset = 0
+        self.published = 0
+        self.failed = 0
+        self.batches = []
+        self.started = time.perf_counter()
+
+    def resolve(self):
+        if not self.future.set_running_or_notify_cancel():
+            return  # The caller gave up on it
+        elapsed = time.perf_counter() - self.started
+        self.future.set_result({
+            "published": self.published,
+            "failed": self.failed,
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "messages_per_s": round(self.published / elapsed, 1) if elapsed > 0 else None,
+            "batches": self.batches,
+        })
+
+
+class _Part:
+    # The messages [start, end) of one submission within the batch in flight
+    __slots__ = ("submission", "start", "end", "failed")
+
+    def __init__(self, submission, start, end):
+        self.submission = submission
+        self.start = start
+        self.end = end
+        self.failed = 0
+
+
+class BatchPublisher:
+    """Publishes batches of messages with publisher confirms collected per batch.
+
+    A background thread runs a pika SelectConnection with a channel in confirm
+    mode. Other threads ``submit`` messages to a bounded queue and wait on the
+    returned future. The thread publishes up to ``batch_size`` queued messages
+    back to back, as ``mandatory``, and takes the next batch once the broker
+    has confirmed all of them, usually with a few ``multiple`` acks. A batch
+    therefore costs one broker round trip however many messages it holds.
+    Nacked and unroutable messages, and those in flight when the connection
+    drops, count as failed; they are not retried. A future resolves once all
+    of its messages are confirmed or failed, with overall and per-batch
+    counts and throughput. Cancelling it withdraws the messages that have not
+    been published yet, so a caller that gives up does not have them
+    published behind its back.
+    """
+
+    def __init__(self, queues=(), name="publisher", batch_size=PUBLISH_BATCH_SIZE, queue_size=PUBLISH_QUEUE_SIZE):
+        self.params = pika.ConnectionParameters(
+            host=RABBITMQ_HOST,
+            port=RABBITMQ_PORT,
+            credentials=pika.PlainCredentials("admin", "password"),
+            heartbeat=RABBITMQ_HEARTBEAT,
+        )
+        self.queues = tuple(queues)
+        self.name = name
+        self.batch_size = batch_size
+        self.submissions = queue.Queue(maxsize=queue_size)
+        self._connection = None
+        self._channel = None
+        self._current = None
+        self._batch = []
+        self._batch_started = None
+        self._in_flight = {}  # delivery tag -> (part, routing key, body), in publish order
+        self._returned = set()
+        self._next_tag = 0
+        self._wake_scheduled = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, messages, properties=None, exchange="", timeout=PUBLISH_ENQUEUE_TIMEOUT):
+        """Queue ``(routing_key, body)`` pairs for publishing; returns a future of the publish summary.
+
+        A message may be ``(routing_key, body, properties)`` to override
+        ``properties``, e.g. to give it its own ``message_id``. Raises
+        queue.Full when the queue stays full for ``timeout`` seconds.
+        Cancel the future to withdraw the messages not published yet.
+        """
+        submission = _Submission(list(messages), properties, exchange)
+        if not submission.messages:
+            submission.resolve()
+            return submission.future
+        self.submissions.put(submission, timeout=timeout)
+        self._wake()
+        return submission.future
+
+    def publish_batch(self, messages, properties=None, exchange="", timeout=PUBLISH_TIMEOUT):
+        """``submit`` and wait up to ``timeout`` seconds for the summary.
+
+        On timeout the messages not published yet are withdrawn, so a retry
+        after the error does not duplicate them. Those already sent may still
+        arrive.
+        """
+        future = self.submit(messages, properties, exchange)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def depth(self):
+        return self.submissions.qsize()
+
+    def _wake(self):
+        if self._wake_scheduled.is_set():
+            return
+        self._wake_scheduled.set()
+        connection = self._connection
+        try:
+            if connection is not None:
+                connection.ioloop.add_callback_threadsafe(self._drain)
+                return
+        except Exception:
+            pass
+        # Not connected: the channel drains the queue once it is ready
+        self._wake_scheduled.clear()
+
+    # Everything below runs on the publisher thread.
+
+    def _run(self):
+        while True:
+            self._connection = pika.SelectConnection(
+                self.params,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_closed,
+                on_close_callback=self._on_connection_closed,
+            )
+            try:
+                self._connection.ioloop.start()
+            except Exception as exc:
+                # Raised by a callback; close the connection so that unacked deliveries go back to their queues
+                print(f"{self.name}: Error occurred: {exc}", flush=True, file=sys.stdout)
+                if self._connection.is_open:
+                    self._connection.close()
+                if not self._connection.is_closed:
+                    self._connection.ioloop.start()
+            self._connection = None
+            time.sleep(5)  # Sleep before reconnecting
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, connection, reason):
+        print(f"{self.name}: RabbitMQ connection closed: {reason}", flush=True, file=sys.stdout)
+        self._fail_in_flight()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        remaining = [len(self.queues)]
+
+        def declared(_frame=None):
+            remaining[0] -= 1
+            if remaining[0] <= 0:
+                channel.confirm_delivery(self._on_confirm, callback=lambda _frame: self._on_ready(channel))
+
+        for q in self.queues:
+            channel.queue_declare(queue=q, durable=True, callback=declared)
+        if not self.queues:
+            declared()
+
+    def _on_ready(self, channel):
+        self._channel = channel
+        self._next_tag = 0
+        self._drain()
+
+    def _on_channel_closed(self, channel, reason):
+        print(f"{self.name}: channel closed: {reason}", flush=True, file=sys.stdout)
+        self._fail_in_flight()
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _take(self):
+        # Up to batch_size messages from the head of the queue, possibly part of a large submission
+        parts = []
+        room = self.batch_size
+        while room:
+            if self._current is None:
+                try:
+                    self._current = self.submissions.get_nowait()
+                except queue.Empty:
+                    break
+            submission = self._current
+            if submission.future.cancelled():
+                # Abandoned by its caller: publish no more of it
+                self._current = None
+                continue
+            count = min(room, len(submission.messages) - submission.offset)
+            parts.append(_Part(submission, submission.offset, submission.offset + count))
+            submission.offset += count
+            room -= count
+            if submission.offset == len(submission.messages):
+                self._current = None
+        return parts
+
+    def _drain(self):
+        self._wake_scheduled.clear()
+        channel = self._channel
+        if channel is None or self._batch:
+            # The batch in flight takes the next one when its last confirm arrives
+            return
+        self._batch = self._take()
+        self._batch_started = time.perf_counter()
+        for part in self._batch:
+            submission = part.submission
+            for routing_key, body, *own in submission.messages[part.start:part.end]:
+                self._next_tag += 1
+                self._in_flight[self._next_tag] = (part, routing_key, body)
+                channel.basic_publish(exchange=submission.exchange, routing_key=routing_key, body=body,
+                                      properties=own[0] if own else submission.properties, mandatory=True)
+
+    def _on_return(self, channel, method, properties, body):
+        # Basic.Return precedes the ack of the same publish; match it to the oldest such publish
+        for tag, (_, routing_key, sent) in self._in_flight.items():
+            if tag not in self._returned and routing_key == method.routing_key and sent == body:
+                self._returned.add(tag)
+                break
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self._in_flight if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._in_flight else []
+        for tag in tags:
+            part, _, _ = self._in_flight.pop(tag)
+            if not acked or tag in self._returned:
+                part.failed += 1
+            self._returned.discard(tag)
+        if self._batch and not self._in_flight:
+            self._finish_batch()
+            self._drain()
+
+    def _fail_in_flight(self):
+        # Their confirms are lost with the channel
+        self._channel = None
+        for part, _, _ in self._in_flight.values():
+            part.failed += 1
+        self._in_flight.clear()
+        self._returned.clear()
+        if self._batch:
+            self._finish_batch()
+
+    def _finish_batch(self):
+        elapsed = time.perf_counter() - self._batch_started
+        batch, self._batch = self._batch, []
+        for part in batch:
+            submission = part.submission
+            count = part.end - part.start
+            submission.published += count - part.failed
+            submission.failed += part.failed
+            submission.batches.append({
+                "size": count,
+                "failed": part.failed,
+                "elapsed_ms": round(elapsed * 1000, 3),
+                "messages_per_s": round(count / elapsed, 1) if elapsed > 0 else None,
+            })
+            if submission.offset == len(submission.messages) and submission is not self._current:
+                submission.resolve()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(queues=()):
+    """Return this process's pool, rebuilding it after a fork."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ChannelPool(queues=queues)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher(queues=()):
+    """Return this process's batch publisher, starting its thread on first use."""
+    global _publisher, _publisher_pid
+    if _publisher is None or _publisher_pid != os.getpid():
+        with _publisher_lock:
+            if _publisher is None or _publisher_pid != os.getpid():
+                _publisher = BatchPublisher(queues=queues).start()
+                _publisher_pid = os.getpid()
+    return _publisher
+
+
+__all__ = ["BatchPublisher", "ChannelPool", "get_pool", "get_publisher", "shard_index", "shard_queue", "shard_queues"]
@@ -0,0 +1,202 @@
+import atexit
+import os
+import sys
+import threading
+import time
+
+import redis
+from opentelemetry.metrics import Observation
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+from telemetry import meter, tracer
+
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Connections per process, shared by every thread; callers beyond it wait for one to come free
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "16"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+# "write-behind" buffers last-message writes and flushes them in one pipeline; "sync" writes each one through
+LAST_MESSAGE_WRITES = os.getenv("LAST_MESSAGE_WRITES", "write-behind")
+# A flush happens this long after the first buffered write, or as soon as this many keys are buffered
+LAST_MESSAGE_FLUSH_INTERVAL = float(os.getenv("LAST_MESSAGE_FLUSH_INTERVAL", "0.5"))
+LAST_MESSAGE_FLUSH_KEYS = int(os.getenv("LAST_MESSAGE_FLUSH_KEYS", "256"))
+
+WRITE_MODES = ("write-behind", "sync")
+if LAST_MESSAGE_WRITES not in WRITE_MODES:
+    raise ValueError(f"Unknown LAST_MESSAGE_WRITES {LAST_MESSAGE_WRITES!r}; expected one of {WRITE_MODES}")
+
+buffered_sets = meter.create_counter(
+    "redis.write_behind.sets", unit="{write}", description="Writes handed to the write-behind buffer")
+flushed_writes = meter.create_counter(
+    "redis.write_behind.writes", unit="{write}", description="Keys written to Redis by write-behind flushes, by outcome")
+flush_duration = meter.create_histogram(
+    "redis.write_behind.flush.duration", unit="ms", description="Time per write-behind pipeline flush")
+
+_redis = None
+_redis_pid = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    """Return this process's Redis client, whose connection pool every caller shares.
+
+    Connections are opened (and authenticated) once and reused, instead of a
+    new TCP connection and AUTH per message. The pool is bounded at
+    ``REDIS_POOL_SIZE`` and blocks for up to ``REDIS_POOL_TIMEOUT`` seconds
+    when every connection is busy, rather than opening more.
+    """
+    global _redis, _redis_pid
+    if _redis is None or _redis_pid != os.getpid():
+        with _redis_lock:
+            if _redis is None or _redis_pid != os.getpid():
+                pool = redis.BlockingConnectionPool(
+                    host=REDIS_HOST,
+                    port=REDIS_PORT,
+                    password="password",
+                    max_connections=REDIS_POOL_SIZE,
+                    timeout=REDIS_POOL_TIMEOUT,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+                    socket_keepalive=True,
+                    health_check_interval=30,
+                )
+                _redis = redis.Redis(connection_pool=pool)
+                _redis_pid = os.getpid()
+    return _redis
+
+
+class WriteBehind:
+    """Buffers SETs and writes them to Redis in one pipeline per flush.
+
+    Writes to the same key coalesce: only the latest value is kept, so a key
+    written on every message costs one SET per flush, not one per message.
+    A background thread flushes ``interval`` seconds after the first buffered
+    write, or as soon as ``max_keys`` distinct keys are buffered. A flush
+    that fails keeps its values for the next one, unless a key has been
+    written again meanwhile. Values written in the last interval before the
+    process dies are lost. That is fine for state like the last message, but
+    not for anything that must survive a crash.
+    """
+
+    def __init__(self, client, interval=LAST_MESSAGE_FLUSH_INTERVAL, max_keys=LAST_MESSAGE_FLUSH_KEYS):
+        self.client = client
+        self.interval = interval
+        self.max_keys = max_keys
+        self._dirty = {}
+        self._first_at = None
+        self._condition = threading.Condition(threading.Lock())
+        # Held while a pipeline is in flight, so discard() cannot race a flush of the same key
+        self._flushing = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="redis-write-behind", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.flush)
+        return self
+
+    def set(self, key, value):
+        with self._condition:
+            if not self._dirty:
+                self._first_at = time.monotonic()
+            self._dirty[key] = value
+            if len(self._dirty) == 1 or len(self._dirty) >= self.max_keys:
+                self._condition.notify()
+        buffered_sets.add(1)
+
+    def discard(self, key):
+        """Forget a buffered write to ``key``, before the caller writes it directly."""
+        with self._flushing:
+            with self._condition:
+                self._dirty.pop(key, None)
+
+    def pending(self):
+        return len(self._dirty)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._dirty:
+                    self._condition.wait()
+                while len(self._dirty) < self.max_keys:
+                    remaining = self._first_at + self.interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        with self._flushing:
+            with self._condition:
+                batch, self._dirty = self._dirty, {}
+            if not batch:
+                return
+            started = time.perf_counter()
+            with tracer.start_as_current_span(
+                "redis_flush_write_behind",
+                kind=SpanKind.CLIENT,
+                attributes={
+                    "db.system": "redis",
+                    "db.operation.name": "SET",
+                    "db.operation.batch.size": len(batch),
+                    "network.peer.address": REDIS_HOST,
+                    "db.namespace": "0",
+                },
+            ) as span:
+                try:
+                    pipe = self.client.pipeline(transaction=False)
+                    for key, value in batch.items():
+                        pipe.set(key, value)
+                    pipe.execute()
+                    flushed_writes.add(len(batch), {"outcome": "ok"})
+                    span.set_status(Status(StatusCode.OK))
+                except redis.RedisError as exc:
+                    with self._condition:
+                        for key, value in batch.items():
+                            self._dirty.setdefault(key, value)
+                        # Retry after a full interval rather than spinning on a Redis that is down
+                        self._first_at = time.monotonic()
+                    flushed_writes.add(len(batch), {"outcome": "error"})
+                    span.set_status(Status(StatusCode.ERROR, str(exc)))
+                    span.set_attribute("error.type", type(exc).__name__)
+                    print(f"WriteBehind: Failed to flush {len(batch)} keys, retrying: {exc}", flush=True, file=sys.stdout)
+            flush_duration.record((time.perf_counter() - started) * 1000)
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return this process's write-behind buffer on the shared client, starting its flusher on first use."""
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer_pid != os.getpid():
+                _writer = WriteBehind(get_redis()).start()
+                _writer_pid = os.getpid()
+    return _writer
+
+
+meter.create_observable_gauge(
+    "redis.write_behind.pending", callbacks=[lambda options: [Observation(_writer.pending())] if _writer is not None else []],
+    unit="{key}", description="Keys buffered for the next write-behind flush")
+
+
+def set_last_message(key, value):
+    """Record ``value`` as the latest message under ``key``: buffered, or written through with LAST_MESSAGE_WRITES=sync."""
+    if LAST_MESSAGE_WRITES == "write-behind":
+        get_writer().set(key, value)
+    else:
+        get_redis().set(key, value)
+
+
+def discard_last_message(key):
+    """Drop a buffered write to ``key``, for a caller about to write it in its own transaction."""
+    if LAST_MESSAGE_WRITES == "write-behind" and _writer is not None and _writer_pid == os.getpid():
+        _writer.discard(key)
+
+
+__all__ = ["LAST_MESSAGE_WRITES", "WriteBehind", "discard_last_message", "get_redis", "get_writer", "set_last_message"]
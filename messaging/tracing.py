@@ -0,0 +1,93 @@
+import time
+
+import pika
+from opentelemetry import propagate, trace
+
+
+# Set by the first producer and carried unchanged through every stage, for end-to-end latency
+PRODUCED_AT = "x-produced-at-us"
+# Set on every publish, for the queue wait of the next hop
+PUBLISHED_AT = "x-published-at-us"
+# W3C trace context (traceparent, tracestate) plus PRODUCED_AT: what a stage passes downstream
+CARRIED = ("traceparent", "tracestate", PRODUCED_AT)
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+def message_headers(produced_at=None):
+    """Headers for a message sent from the current span.
+
+    ``produced_at`` is the inherited produce time (microseconds since the epoch)
+    of the message being forwarded; a new message is produced now.
+    """
+    headers = {}
+    propagate.inject(headers)
+    headers[PRODUCED_AT] = produced_at if produced_at is not None else now_us()
+    return headers
+
+
+def publish_properties(content_type, headers=None, message_id=None, correlation_id=None):
+    """AMQP properties for one publish, stamped with its publish time.
+
+    ``headers`` defaults to ``message_headers()``; pass the stored ones when a
+    message is published later, or again, from another thread.
+    """
+    headers = dict(headers) if headers is not None else message_headers()
+    now = now_us()
+    headers[PUBLISHED_AT] = now
+    return pika.BasicProperties(
+        content_type=content_type,
+        message_id=message_id,
+        correlation_id=correlation_id,
+        timestamp=now // 1_000_000,
+        headers=headers,
+    )
+
+
+def carried(properties):
+    """The headers of a received message that its successors inherit; JSON-serializable."""
+    headers = getattr(properties, "headers", None) or {}
+    out = {}
+    for name in CARRIED:
+        value = headers.get(name)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        if value is not None:
+            out[name] = value
+    return out
+
+
+def context_of(headers):
+    """The trace context a received message (or its ``carried`` headers) was sent from."""
+    return propagate.extract(headers or {})
+
+
+def span_context_of(headers):
+    """The sender's span context, for linking to it; None when the message carried none."""
+    span_context = trace.get_current_span(context_of(headers)).get_span_context()
+    return span_context if span_context.is_valid else None
+
+
+def receive_attributes(properties, received_at=None):
+    """Span attributes for a delivery: queue wait on this hop and age since first produced.
+
+    Both come from wall clocks on different hosts, so they are only as exact as
+    the clocks are in sync. Messages from producers that predate the headers get
+    neither.
+    """
+    headers = getattr(properties, "headers", None) or {}
+    received_at = received_at if received_at is not None else now_us()
+    attributes = {}
+    if isinstance(headers.get(PUBLISHED_AT), int):
+        attributes["messaging.queue_wait_ms"] = max(0, received_at - headers[PUBLISHED_AT]) / 1000
+    if isinstance(headers.get(PRODUCED_AT), int):
+        attributes["messaging.end_to_end_ms"] = max(0, received_at - headers[PRODUCED_AT]) / 1000
+    return attributes
+
+
+__all__ = [
+    "PRODUCED_AT", "PUBLISHED_AT", "carried", "context_of", "message_headers", "now_us", "publish_properties",
+    "receive_attributes", "span_context_of",
+]
@@ -1,18 +1,27 @@
 import os
-import json
 import pika
-import redis
 import random
 import sys
 import time
-from otel import tracer
+from telemetry import serve_metrics, tracer
+from messaging.codec import content_type_of, decode
+from messaging.tracing import carried, context_of, now_us, receive_attributes
+from messaging.metrics import elapsed_ms, process_duration, record_received, watch_queues
+from messaging.store import set_last_message
 from opentelemetry.trace import SpanKind, Status, StatusCode
 
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "200"))
+# Deliveries handled per chunk: one multiple=True ack and one Redis write per chunk
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "50"))
+# Seconds before a partially filled chunk is flushed anyway
+CONSUMER_BATCH_TIMEOUT = float(os.getenv("CONSUMER_BATCH_TIMEOUT", "0.2"))
+
 def main():
     rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
     rabbit_port = int(os.getenv("RABBITMQ_PORT", "5672"))
     redis_host = os.getenv("REDIS_HOST", "redis")
-    redis_port = int(os.getenv("REDIS_PORT", "6379"))
+    serve_metrics()
+    watch_queues(['NotificationQueue'])
 
     while True:
         try:
@@ -20,9 +29,13 @@ def main():
             channel = connection.channel()
             channel.queue_declare(queue='NotificationQueue', durable=True)
 
-            def callback(ch, method, properties, body):
+            def process(properties, body, received_at):
+                started = time.perf_counter()
+                inherited = carried(properties)
+                # Continues the sender's trace; queue wait goes on the receive span, processing is the process span
                 with tracer.start_as_current_span(
                     "receive_notification_message",
+                    context=context_of(inherited),
                     kind=SpanKind.CLIENT,
                     attributes={
                         "messaging.operation": "receive",
@@ -30,6 +43,7 @@ def main():
                         "messaging.message.id": getattr(properties, "message_id", None) or "unknown",
                         "server.address": rabbit_host,
                         "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
+                        **receive_attributes(properties, received_at),
                     },
                 ) as recv_span:
                     try:
@@ -44,39 +58,83 @@ def main():
                                 "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
                             },
                         ) as process_span:
-                            notification = json.loads(body)
+                            # Raises ValueError for a body no retry can fix; the body itself is stored as received
+                            notification = decode(body, content_type_of(properties))
+                            if not isinstance(notification, dict) or not notification.get("passenger_id"):
+                                raise ValueError("Notification without a passenger_id")
+                            process_span.set_attribute("notification.passenger_id", str(notification["passenger_id"]))
                             # Random error injection for notification processing
                             if random.random() < 0.001:
                                 raise RuntimeError("Simulated notification processing error")
-                            ch.basic_ack(delivery_tag=method.delivery_tag)
-                            # Redis operation
-                            with tracer.start_as_current_span(
-                                "redis_set_last_message",
-                                kind=SpanKind.CLIENT,
-                                attributes={
-                                    "db.system": "redis",
-                                    "db.operation.name": "SET",
-                                    "db.query.text": "SET notification_last_message ...",
-                                    "network.peer.address": redis_host,
-                                    "db.namespace": "0"
-                                },
-                            ) as db_span:
-                                try:
-                                    r = redis.Redis(host=redis_host, port=redis_port, password="password")
-                                    r.set("notification_last_message", json.dumps(notification))
-                                    db_span.set_status(Status(StatusCode.OK))
-                                except Exception as exc:
-                                    db_span.set_status(Status(StatusCode.ERROR, str(exc)))
-                                    db_span.set_attribute("error.type", type(exc).__name__)
-                                    raise
                             process_span.set_status(Status(StatusCode.OK))
                         recv_span.set_status(Status(StatusCode.OK))
+                        process_duration.record(elapsed_ms(started), {"messaging.destination.name": 'NotificationQueue'})
+                        return body
                     except Exception as exc:
                         recv_span.set_status(Status(StatusCode.ERROR, str(exc)))
                         recv_span.set_attribute("error.type", type(exc).__name__)
                         raise
 
-            channel.basic_consume(queue='NotificationQueue', on_message_callback=callback)
+            pending = []
+
+            def flush():
+                if not pending:
+                    return
+                chunk = pending[:]
+                del pending[:]
+                last_ok = None
+                last_message = None
+                for method, properties, body, received_at in chunk:
+                    try:
+                        last_message = process(properties, body, received_at)
+                        last_ok = method.delivery_tag
+                    except ValueError as exc:
+                        # Malformed: it would fail the same way on every redelivery, so drop it
+                        print(f"NotificationService: Dropping malformed message: {exc}", flush=True, file=sys.stdout)
+                        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                    except Exception as exc:
+                        print(f"NotificationService: Error processing message: {exc}", flush=True, file=sys.stdout)
+                        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                if last_ok is None:
+                    return
+                # Failed deliveries were nacked above, so this acks exactly the successful ones
+                channel.basic_ack(delivery_tag=last_ok, multiple=True)
+                # Only the newest message of the chunk matters for the last-message key
+                with tracer.start_as_current_span(
+                    "redis_set_last_message",
+                    kind=SpanKind.CLIENT,
+                    attributes={
+                        "db.system": "redis",
+                        "db.operation.name": "SET",
+                        "db.query.text": "SET notification_last_message ...",
+                        "network.peer.address": redis_host,
+                        "db.namespace": "0",
+                        "messaging.batch.message_count": len(chunk),
+                    },
+                ) as db_span:
+                    try:
+                        set_last_message("notification_last_message", last_message)
+                        db_span.set_status(Status(StatusCode.OK))
+                    except Exception as exc:
+                        db_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                        db_span.set_attribute("error.type", type(exc).__name__)
+                        raise
+
+            def on_message(ch, method, properties, body):
+                # Stamped on arrival: time waiting in the chunk is processing, not queue wait
+                received_at = now_us()
+                record_received('NotificationQueue', properties, received_at)
+                pending.append((method, properties, body, received_at))
+                if len(pending) >= CONSUMER_BATCH_SIZE:
+                    flush()
+
+            def periodic_flush():
+                flush()
+                connection.call_later(CONSUMER_BATCH_TIMEOUT, periodic_flush)
+
+            channel.basic_qos(prefetch_count=max(CONSUMER_PREFETCH, CONSUMER_BATCH_SIZE))
+            channel.basic_consume(queue='NotificationQueue', on_message_callback=on_message)
+            connection.call_later(CONSUMER_BATCH_TIMEOUT, periodic_flush)
             print("NotificationService: Waiting for notification messages...", flush=True)
             channel.start_consuming()
         except KeyboardInterrupt:
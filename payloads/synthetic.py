@@ -0,0 +1,173 @@
+import os
+import random
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+
+# "fixed" publishes the demo's constant IDs; "synthetic" draws them from the generator below
+PAYLOAD_GENERATOR = os.getenv("PAYLOAD_GENERATOR", "fixed")
+# Same seed, same sequence of payloads (per process)
+PAYLOAD_SEED = os.getenv("PAYLOAD_SEED")
+PAYLOAD_TRAINS = int(os.getenv("PAYLOAD_TRAINS", "1000"))
+PAYLOAD_ROUTES = int(os.getenv("PAYLOAD_ROUTES", "200"))
+PAYLOAD_STATIONS = int(os.getenv("PAYLOAD_STATIONS", "500"))
+PAYLOAD_PASSENGERS = int(os.getenv("PAYLOAD_PASSENGERS", "1000000"))
+# Distinct conversation IDs, the default join and shard key
+PAYLOAD_CONVERSATIONS = int(os.getenv("PAYLOAD_CONVERSATIONS", "10000"))
+# Zipf exponents for how bookings spread over trains and passengers; 0 is uniform
+PAYLOAD_TRAIN_SKEW = float(os.getenv("PAYLOAD_TRAIN_SKEW", "1.1"))
+PAYLOAD_PASSENGER_SKEW = float(os.getenv("PAYLOAD_PASSENGER_SKEW", "0"))
+
+GENERATORS = ("fixed", "synthetic")
+if PAYLOAD_GENERATOR not in GENERATORS:
+    raise ValueError(f"Unknown PAYLOAD_GENERATOR {PAYLOAD_GENERATOR!r}; expected one of {GENERATORS}")
+
+FIRST_NAMES = ("Ada", "Ben", "Chloe", "David", "Elena", "Farid", "Grace", "Hiro", "Ines", "Jonas",
+               "Kofi", "Lena", "Mateo", "Nina", "Omar", "Priya", "Quinn", "Rosa", "Sven", "Tara")
+LAST_NAMES = ("Adams", "Bauer", "Costa", "Dubois", "Evans", "Fischer", "Garcia", "Hansen", "Ito", "Jensen",
+              "Kowalski", "Lopez", "Muller", "Novak", "Okafor", "Petrov", "Rossi", "Silva", "Tanaka", "Weber")
+SEAT_LETTERS = "ABCD"
+SERVICE_DATE = datetime(2025, 4, 15)
+
+
+class Zipf:
+    """Draws ranks ``0 .. n-1`` with probability proportional to ``1 / (rank + 1) ** s``.
+
+    The cumulative weights are built once (8 bytes per rank) and each draw is a
+    binary search, so sampling a million passengers costs one ``random()`` and
+    about 20 comparisons. ``s == 0`` is uniform and needs no table.
+    """
+
+    def __init__(self, n, s, rng):
+        if n < 1:
+            raise ValueError("Zipf needs at least one rank")
+        self.n = n
+        self.rng = rng
+        self._cumulative = array("d", accumulate(1.0 / (rank + 1) ** s for rank in range(n))) if s > 0 else None
+
+    def __call__(self):
+        if self._cumulative is None:
+            return self.rng.randrange(self.n)
+        return min(bisect_left(self._cumulative, self.rng.random() * self._cumulative[-1]), self.n - 1)
+
+
+class PayloadGenerator:
+    """Seeded schedule, ticket and passenger payloads with production-like key spread.
+
+    Trains, routes and passengers are fixed populations: train ``i`` always
+    runs route ``i % routes`` at the same time of day, and passenger ``p``
+    always has the same name and contact, so the same IDs recur with
+    consistent fields as they would in real traffic. Which train a message is
+    about follows a Zipf distribution (a few hot trains take most bookings),
+    and so, optionally, does which passenger. Rank 0 is the hottest.
+    Conversation IDs are drawn uniformly from their own population.
+
+    One generator is shared by a process's request threads. Each draw holds a
+    lock, so a seeded generator hands out the same sequence of payloads no
+    matter how the threads interleave.
+    """
+
+    def __init__(self, seed=PAYLOAD_SEED, trains=PAYLOAD_TRAINS, routes=PAYLOAD_ROUTES, stations=PAYLOAD_STATIONS,
+                 passengers=PAYLOAD_PASSENGERS, train_skew=PAYLOAD_TRAIN_SKEW, passenger_skew=PAYLOAD_PASSENGER_SKEW,
+                 conversations=PAYLOAD_CONVERSATIONS):
+        self.seed = seed
+        self.trains = trains
+        self.routes = routes
+        self.stations = stations
+        self.passengers = passengers
+        self.conversations = conversations
+        self.rng = random.Random(seed)
+        self._train = Zipf(trains, train_skew, self.rng)
+        self._passenger = Zipf(passengers, passenger_skew, self.rng)
+        self._conversation = Zipf(conversations, 0, self.rng)
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def _route(self, index):
+        route = self._routes.get(index)
+        if route is None:
+            # Derived from the seed and index only, so every process agrees on a route's stops
+            rng = random.Random(f"{self.seed}:route:{index}")
+            stops = rng.randint(2, min(8, max(2, self.stations)))
+            route = self._routes[index] = [f"Station{s:04d}" for s in rng.sample(range(self.stations), min(stops, self.stations))]
+        return route
+
+    def _times(self, train):
+        # Departures spread over the service day, journeys of 30 minutes per stop
+        departure = SERVICE_DATE + timedelta(minutes=(train * 37) % (24 * 60))
+        arrival = departure + timedelta(minutes=30 * (len(self._route(train % self.routes)) - 1))
+        return departure.isoformat(), arrival.isoformat()
+
+    def conversation_id(self):
+        with self._lock:
+            return f"conv-{self._conversation():06d}"
+
+    def schedule(self):
+        with self._lock:
+            train = self._train()
+            departure, arrival = self._times(train)
+            route = list(self._route(train % self.routes))
+        return {
+            "train_id": f"T{train:05d}",
+            "departure_time": departure,
+            "arrival_time": arrival,
+            "route": route,
+        }
+
+    def ticket(self):
+        with self._lock:
+            train = self._train()
+            passenger = self._passenger()
+            ticket = self.rng.getrandbits(48)
+            seat = f"{self.rng.randint(1, 40)}{self.rng.choice(SEAT_LETTERS)}"
+            departure = self._times(train)[0]
+        return {
+            "ticket_id": f"K{ticket:012x}",
+            "train_id": f"T{train:05d}",
+            "passenger_id": f"P{passenger:07d}",
+            "seat_number": seat,
+            "departure_time": departure,
+        }
+
+    def passenger(self):
+        # The train the passenger travels on, so batch aggregation can group passengers with the train
+        with self._lock:
+            train = self._train()
+            passenger = self._passenger()
+        first = FIRST_NAMES[passenger % len(FIRST_NAMES)]
+        last = LAST_NAMES[(passenger // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        return {
+            "passenger_id": f"P{passenger:07d}",
+            "train_id": f"T{train:05d}",
+            "name": f"{first} {last}",
+            "contact_info": f"{first.lower()}.{last.lower()}.{passenger}@example.com",
+        }
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+def get_generator():
+    """Return this process's payload generator, building it (and its Zipf tables) on first use."""
+    global _generator, _generator_pid
+    if _generator is None or _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator is None or _generator_pid != os.getpid():
+                _generator = PayloadGenerator()
+                _generator_pid = os.getpid()
+    return _generator
+
+
+def new_conversation_id():
+    """A conversation ID from the generator's population, or one of the demo's ``conv-100`` .. ``conv-999``."""
+    if PAYLOAD_GENERATOR == "synthetic":
+        return get_generator().conversation_id()
+    return f"conv-{random.randint(100, 999)}"
+
+
+__all__ = ["PAYLOAD_GENERATOR", "PayloadGenerator", "Zipf", "get_generator", "new_conversation_id"]
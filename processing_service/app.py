@@ -1,29 +1,65 @@
 import os
-import json
 import pika
-import redis
 import random
 import sys
 import time
-from otel import tracer
+import signal
+import multiprocessing
+from telemetry import serve_metrics, tracer
+from telemetry.otel import METRICS_PORT
+from messaging.codec import CONTENT_TYPE, content_type_of, decode, encode
+from messaging.tracing import PRODUCED_AT, carried, context_of, message_headers, now_us, publish_properties, receive_attributes
+from messaging.metrics import elapsed_ms, process_duration, record_received, record_sent, watch_queues
+from messaging.store import set_last_message
 from opentelemetry.trace import SpanKind, Status, StatusCode
 
-def main():
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "200"))
+# Deliveries handled per chunk: one multiple=True ack and one Redis write per chunk
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "50"))
+# Seconds before a partially filled chunk is flushed anyway
+CONSUMER_BATCH_TIMEOUT = float(os.getenv("CONSUMER_BATCH_TIMEOUT", "0.2"))
+# Worker processes, each with its own connection; 1 runs the consumer in this process
+PROCESSING_WORKERS = int(os.getenv("PROCESSING_WORKERS", "1"))
+PROCESSING_REPORT_INTERVAL = float(os.getenv("PROCESSING_REPORT_INTERVAL", "10"))
+# Seconds workers get to finish their current chunk after SIGTERM before they are killed
+PROCESSING_DRAIN_TIMEOUT = float(os.getenv("PROCESSING_DRAIN_TIMEOUT", "30"))
+# Seconds before a crashed worker is restarted, doubling per crash up to the max; reset once a worker stays up for RESET seconds
+PROCESSING_RESTART_BACKOFF = float(os.getenv("PROCESSING_RESTART_BACKOFF", "1.0"))
+PROCESSING_RESTART_BACKOFF_MAX = float(os.getenv("PROCESSING_RESTART_BACKOFF_MAX", "60"))
+PROCESSING_RESTART_RESET = float(os.getenv("PROCESSING_RESTART_RESET", "60"))
+
+stop_requested = False
+
+def request_stop(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+def main(processed=None, worker=0):
+    # processed: optional shared counter of acked messages, read by the supervisor
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    # Each worker process serves its own metrics, on consecutive ports
+    serve_metrics(METRICS_PORT + worker)
+    if worker == 0:
+        watch_queues(['AggregationQueue'])
     rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
     rabbit_port = int(os.getenv("RABBITMQ_PORT", "5672"))
     redis_host = os.getenv("REDIS_HOST", "redis")
-    redis_port = int(os.getenv("REDIS_PORT", "6379"))
 
-    while True:
+    while not stop_requested:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host, port=rabbit_port, credentials=pika.PlainCredentials("admin", "password")))
             channel = connection.channel()
             channel.queue_declare(queue='AggregationQueue', durable=True)
             channel.queue_declare(queue='NotificationQueue', durable=True)
 
-            def callback(ch, method, properties, body):
+            def process(properties, body, received_at):
+                started = time.perf_counter()
+                inherited = carried(properties)
+                # Continues the sender's trace; queue wait goes on the receive span, processing is the process span
                 with tracer.start_as_current_span(
                     "receive_aggregation_message",
+                    context=context_of(inherited),
                     kind=SpanKind.CLIENT,
                     attributes={
                         "messaging.operation": "receive",
@@ -31,6 +67,7 @@ def main():
                         "messaging.message.id": getattr(properties, "message_id", None) or "unknown",
                         "server.address": rabbit_host,
                         "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
+                        **receive_attributes(properties, received_at),
                     },
                 ) as recv_span:
                     try:
@@ -45,7 +82,7 @@ def main():
                                 "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
                             },
                         ) as process_span:
-                            aggregated = json.loads(body)
+                            aggregated = decode(body, content_type_of(properties))
                             # Random error injection for message processing
                             if random.random() < 0.0001:
                                 raise RuntimeError("Simulated message processing error")
@@ -58,58 +95,182 @@ def main():
                                 "passenger_id": passenger.get("passenger_id", "unknown"),
                                 "message": f"Your train (ID: {aggregated.get('train_id')}) is scheduled to depart at {aggregated.get('schedule', {}).get('departure_time', '')} from {aggregated.get('schedule', {}).get('route', [''])[0]}."
                             }
+                            notification_id = f"notif-{random.randint(1000,9999)}"
                             with tracer.start_as_current_span(
                                 "send_notification_message",
                                 kind=SpanKind.PRODUCER,
                                 attributes={
                                     "messaging.operation": "send",
                                     "messaging.destination.name": "NotificationQueue",
-                                    "messaging.message.id": f"notif-{random.randint(1000,9999)}",
+                                    "messaging.message.id": notification_id,
                                     "server.address": rabbit_host,
                                     "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
                                 },
                             ) as send_span:
-                                channel.basic_publish(exchange='', routing_key='NotificationQueue', body=json.dumps(notification))
+                                out_properties = publish_properties(
+                                    CONTENT_TYPE, message_headers(inherited.get(PRODUCED_AT)),
+                                    message_id=notification_id, correlation_id=getattr(properties, "correlation_id", None),
+                                )
+                                publish_started = time.perf_counter()
+                                channel.basic_publish(exchange='', routing_key='NotificationQueue', body=encode(notification), properties=out_properties)
+                                record_sent('NotificationQueue', 1, elapsed_ms(publish_started))
                                 send_span.set_status(Status(StatusCode.OK))
-                            ch.basic_ack(delivery_tag=method.delivery_tag)
-                            # Redis operation
-                            with tracer.start_as_current_span(
-                                "redis_set_last_message",
-                                kind=SpanKind.CLIENT,
-                                attributes={
-                                    "db.system": "redis",
-                                    "db.operation.name": "SET",
-                                    "db.query.text": "SET processing_last_message ...",
-                                    "network.peer.address": redis_host,
-                                    "db.namespace": "0"
-                                },
-                            ) as db_span:
-                                try:
-                                    r = redis.Redis(host=redis_host, port=redis_port, password="password")
-                                    r.set("processing_last_message", json.dumps(aggregated))
-                                    db_span.set_status(Status(StatusCode.OK))
-                                except Exception as exc:
-                                    db_span.set_status(Status(StatusCode.ERROR, str(exc)))
-                                    db_span.set_attribute("error.type", type(exc).__name__)
-                                    raise
                             process_span.set_status(Status(StatusCode.OK))
                         recv_span.set_status(Status(StatusCode.OK))
+                        process_duration.record(elapsed_ms(started), {"messaging.destination.name": 'AggregationQueue'})
+                        return body
                     except Exception as exc:
                         recv_span.set_status(Status(StatusCode.ERROR, str(exc)))
                         recv_span.set_attribute("error.type", type(exc).__name__)
                         raise
 
-            channel.basic_consume(queue='AggregationQueue', on_message_callback=callback)
+            pending = []
+
+            def flush():
+                if not pending:
+                    return
+                chunk = pending[:]
+                del pending[:]
+                last_ok = None
+                last_message = None
+                succeeded = 0
+                for method, properties, body, received_at in chunk:
+                    try:
+                        last_message = process(properties, body, received_at)
+                        last_ok = method.delivery_tag
+                        succeeded += 1
+                    except Exception as exc:
+                        print(f"ProcessingService: Error processing message: {exc}", flush=True, file=sys.stdout)
+                        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                if last_ok is None:
+                    return
+                # Failed deliveries were nacked above, so this acks exactly the successful ones
+                channel.basic_ack(delivery_tag=last_ok, multiple=True)
+                if processed is not None:
+                    processed.value += succeeded
+                # Only the newest message of the chunk matters for the last-message key
+                with tracer.start_as_current_span(
+                    "redis_set_last_message",
+                    kind=SpanKind.CLIENT,
+                    attributes={
+                        "db.system": "redis",
+                        "db.operation.name": "SET",
+                        "db.query.text": "SET processing_last_message ...",
+                        "network.peer.address": redis_host,
+                        "db.namespace": "0",
+                        "messaging.batch.message_count": len(chunk),
+                    },
+                ) as db_span:
+                    try:
+                        set_last_message("processing_last_message", last_message)
+                        db_span.set_status(Status(StatusCode.OK))
+                    except Exception as exc:
+                        db_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                        db_span.set_attribute("error.type", type(exc).__name__)
+                        raise
+
+            def on_message(ch, method, properties, body):
+                # Stamped on arrival: time waiting in the chunk is processing, not queue wait
+                received_at = now_us()
+                record_received('AggregationQueue', properties, received_at)
+                pending.append((method, properties, body, received_at))
+                if len(pending) >= CONSUMER_BATCH_SIZE:
+                    flush()
+
+            def periodic_flush():
+                flush()
+                if stop_requested:
+                    # Cancels the consumer; pika requeues deliveries not yet handed to on_message
+                    channel.stop_consuming()
+                    return
+                connection.call_later(CONSUMER_BATCH_TIMEOUT, periodic_flush)
+
+            channel.basic_qos(prefetch_count=max(CONSUMER_PREFETCH, CONSUMER_BATCH_SIZE))
+            channel.basic_consume(queue='AggregationQueue', on_message_callback=on_message)
+            connection.call_later(CONSUMER_BATCH_TIMEOUT, periodic_flush)
             print("ProcessingService: Waiting for aggregated messages...", flush=True)
             channel.start_consuming()
-        except KeyboardInterrupt:
-            print("ProcessingService: Shutting down...", flush=True)
-            break
+            flush()
+            connection.close()
+            print("ProcessingService: Drained, shutting down...", flush=True)
         except Exception as e:
             print(f"ProcessingService: Error occurred: {e}", flush=True, file=sys.stdout)
-            time.sleep(5)  # Sleep before retrying after error
+            if not stop_requested:
+                time.sleep(5)  # Sleep before retrying after error
+
+def report(counters, last_counts, elapsed, restarts):
+    rates = []
+    for i, counter in enumerate(counters):
+        count = counter.value
+        rates.append((count - last_counts[i]) / elapsed if elapsed > 0 else 0.0)
+        last_counts[i] = count
+    per_worker = ", ".join(
+        f"worker {i}: {rate:.1f} msg/s ({counters[i].value} total, {restarts[i]} restarts)"
+        for i, rate in enumerate(rates)
+    )
+    print(f"ProcessingService: {sum(rates):.1f} msg/s across {len(counters)} workers; {per_worker}", flush=True)
+
+def supervise(workers):
+    ctx = multiprocessing.get_context("fork")
+    counters = [ctx.RawValue("Q", 0) for _ in range(workers)]
+    processes = [None] * workers
+    restarts = [0] * workers
+    started_at = [0.0] * workers
+    # Per worker: delay before its next restart, and when a crashed one is due to restart
+    backoff = [PROCESSING_RESTART_BACKOFF] * workers
+    restart_at = [None] * workers
+
+    def start(i):
+        processes[i] = ctx.Process(target=main, args=(counters[i], i), name=f"processing-worker-{i}")
+        processes[i].start()
+        started_at[i] = time.monotonic()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    for i in range(workers):
+        start(i)
+    print(f"ProcessingService: Supervising {workers} worker processes", flush=True)
 
+    last_counts = [0] * workers
+    last_report = time.monotonic()
+    while not stop_requested:
+        time.sleep(0.5)
+        now = time.monotonic()
+        for i, process in enumerate(processes):
+            if process.is_alive() or stop_requested:
+                continue
+            if restart_at[i] is None:
+                # A worker that crashes on startup would otherwise be restarted in a tight loop
+                if now - started_at[i] >= PROCESSING_RESTART_RESET:
+                    backoff[i] = PROCESSING_RESTART_BACKOFF
+                restart_at[i] = now + backoff[i]
+                print(f"ProcessingService: Worker {i} (pid {process.pid}) exited with code {process.exitcode}, "
+                      f"restarting in {backoff[i]:.1f}s", flush=True)
+                backoff[i] = min(backoff[i] * 2, PROCESSING_RESTART_BACKOFF_MAX)
+            elif now >= restart_at[i]:
+                restart_at[i] = None
+                restarts[i] += 1
+                start(i)
+        if now - last_report >= PROCESSING_REPORT_INTERVAL:
+            report(counters, last_counts, now - last_report, restarts)
+            last_report = now
 
+    print("ProcessingService: Draining workers...", flush=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + PROCESSING_DRAIN_TIMEOUT
+    for i, process in enumerate(processes):
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"ProcessingService: Worker {i} did not drain in time, killing", flush=True)
+            process.kill()
+            process.join()
+    report(counters, last_counts, time.monotonic() - last_report, restarts)
+    print("ProcessingService: Shutting down...", flush=True)
 
 if __name__ == "__main__":
-    main()
+    if PROCESSING_WORKERS > 1:
+        supervise(PROCESSING_WORKERS)
+    else:
+        main()
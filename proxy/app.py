@@ -1,42 +1,95 @@
-import time
+import os
+import signal
 import sys
-import requests
 import random
-from otel import tracer
+from telemetry import serve_metrics, tracer
 from opentelemetry.trace import SpanKind, Status, StatusCode
+from load import INJECTED, LOAD_DURATION, LOAD_PAYLOADS, LOAD_RPS, LOAD_TARGETS, LoadGenerator, parse_targets
+from report import LoadReport
+from http_pool import SessionPool
+from capture import LOAD_CAPTURE_PATH, LOAD_REPLAY_PATH, LOAD_REPLAY_SPEED, CaptureWriter, read_capture
+from payloads.synthetic import get_generator
+
+# Keep-alive connections per target host, shared by the load workers
+http = SessionPool()
+
+# Share of requests failed on purpose, without sending, to put errors in the traces. Off by default for
+# measured runs (a LOAD_DURATION or a replay), whose reports count injected failures separately anyway.
+PROXY_ERROR_RATE = float(os.getenv("PROXY_ERROR_RATE", "0" if LOAD_DURATION or LOAD_REPLAY_PATH else "0.10"))
+
+def trigger(url, payload=None):
+    # Replayed requests with a payload are POSTed as batch triggers
+    method = "GET" if payload is None else "POST"
+    with tracer.start_as_current_span(
+        "proxy_http_request",
+        kind=SpanKind.CLIENT,
+        attributes={
+            "http.method": method,
+            "http.url": url,
+            "peer.service": url.split('//')[1].split('/')[0],
+        },
+    ) as span:
+        try:
+            # Random error injection for HTTP request
+            if random.random() < PROXY_ERROR_RATE:
+                span.set_status(Status(StatusCode.ERROR, "Simulated proxy HTTP error"))
+                span.set_attribute("error.type", "RuntimeError")
+                return INJECTED
+            response = http.get(url) if payload is None else http.post(url, json=payload)
+            # otel_logger.info(f"Triggered {url}: Status {response.status_code}", attributes={"http.status_code": response.status_code})
+            span.set_attribute("http.status_code", response.status_code)
+            span.set_status(Status(StatusCode.OK))
+            return response.ok
+        except Exception as e:
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            span.set_attribute("error.type", type(e).__name__)
+            # otel_logger.error(f"Error triggering {url}: {e}", attributes={"error.type": type(e).__name__})
+            print(f"Error triggering {url}: {e}", flush=True, file=sys.stdout)
+            return False
+
+def synthetic_payload(url):
+    # Ticket and passenger services get their own shapes; the train services take schedules
+    generator = get_generator()
+    host = url.split('//')[-1].split('/')[0]
+    make = generator.ticket if "ticket" in host else generator.passenger if "passenger" in host else generator.schedule
+    return [make() for _ in range(LOAD_PAYLOADS)]
 
 def generate_load():
-    services = [
-        "http://train-service/trigger",
-        "http://ticket-service/trigger",
-        "http://passenger-service/trigger",
-        "http://train-management-service/trigger"
-    ]
-    while True:
-        for url in services:
-            with tracer.start_as_current_span(
-                "proxy_http_request",
-                kind=SpanKind.CLIENT,
-                attributes={
-                    "http.method": "GET",
-                    "http.url": url,
-                    "peer.service": url.split('//')[1].split('/')[0],
-                },
-            ) as span:
-                try:
-                    # Random error injection for HTTP request
-                    if random.random() < 0.10:
-                        raise RuntimeError("Simulated proxy HTTP error")
-                    response = requests.get(url)
-                    # otel_logger.info(f"Triggered {url}: Status {response.status_code}", attributes={"http.status_code": response.status_code})
-                    span.set_attribute("http.status_code", response.status_code)
-                    span.set_status(Status(StatusCode.OK))
-                except Exception as e:
-                    span.set_status(Status(StatusCode.ERROR, str(e)))
-                    span.set_attribute("error.type", type(e).__name__)
-                    # otel_logger.error(f"Error triggering {url}: {e}", attributes={"error.type": type(e).__name__})
-                    print(f"Error triggering {url}: {e}", flush=True, file=sys.stdout)
-        time.sleep(2)
+    targets = parse_targets(LOAD_TARGETS, LOAD_RPS)
+    replay = read_capture(LOAD_REPLAY_PATH, LOAD_REPLAY_SPEED) if LOAD_REPLAY_PATH else None
+    capture = CaptureWriter(LOAD_CAPTURE_PATH) if LOAD_CAPTURE_PATH else None
+    report = LoadReport()
+    generator = LoadGenerator(targets, trigger, record=report.record, replay=replay, capture=capture.write if capture else None,
+                              payload=synthetic_payload if LOAD_PAYLOADS > 0 else None)
+    report.config = {
+        "targets": targets if replay is None else None,
+        "profile": generator.profile if replay is None else "replay",
+        "replay_path": LOAD_REPLAY_PATH,
+        "replay_speed": LOAD_REPLAY_SPEED if replay is not None else None,
+        "duration_s": generator.duration,
+        "concurrency": generator.concurrency,
+        "max_backlog": generator.max_backlog,
+        "seed": generator.seed,
+        "payloads_per_request": LOAD_PAYLOADS,
+        "injected_error_rate": PROXY_ERROR_RATE,
+        "http_pool_size": http.pool_size,
+        "http_timeout_s": list(http.timeout),
+        "http_retries": http.retries,
+    }
+    # Kubernetes stops the pod with SIGTERM; finish the run so the report is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: generator.stop())
+    if replay is None:
+        print(f"Proxy: {generator.profile} load on {len(targets)} targets: {targets}", flush=True)
+    else:
+        print(f"Proxy: Replaying {LOAD_REPLAY_PATH} at {LOAD_REPLAY_SPEED}x", flush=True)
+    report.start()
+    generator.run()
+    if capture is not None:
+        capture.close()
+        print(f"Proxy: Captured {capture.written} requests to {LOAD_CAPTURE_PATH}", flush=True)
+    report.finish(extra={"http_pool": http.stats()})
+    http.close()
 
 if __name__ == "__main__":
+    serve_metrics()
     generate_load()
@@ -0,0 +1,67 @@
+import gzip
+import json
+import os
+import threading
+
+
+# JSONL file of requests to replay instead of generating load; ".gz" files are read compressed
+LOAD_REPLAY_PATH = os.getenv("LOAD_REPLAY_PATH")
+# Replay time compression: 10 replays an hour of traffic in 6 minutes
+LOAD_REPLAY_SPEED = float(os.getenv("LOAD_REPLAY_SPEED", "1.0"))
+# Append every request the proxy sends to this JSONL file (".gz" to compress)
+LOAD_CAPTURE_PATH = os.getenv("LOAD_CAPTURE_PATH")
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_capture(path, speed=1.0):
+    """Stream ``(offset, endpoint, payload)`` from a capture file, one line at a time.
+
+    Each line is ``{"timestamp": <unix seconds>, "endpoint": <url>, "payload": <JSON or null>}``.
+    ``offset`` is the seconds since the first request, divided by ``speed``. Lines
+    are read only as the replay reaches them, so memory stays constant however
+    large the file is. Blank and unparseable lines are skipped.
+    """
+    if speed <= 0:
+        raise ValueError("LOAD_REPLAY_SPEED must be positive")
+    first = None
+    with _open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                timestamp = float(entry["timestamp"])
+                endpoint = entry["endpoint"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            if first is None:
+                first = timestamp
+            yield (timestamp - first) / speed, endpoint, entry.get("payload")
+
+
+class CaptureWriter:
+    """Appends sent requests to a capture file in the format ``read_capture`` replays."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = _open(path, "a")
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def write(self, timestamp, endpoint, payload=None):
+        line = json.dumps({"timestamp": round(timestamp, 6), "endpoint": endpoint, "payload": payload}) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.written += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+__all__ = ["CaptureWriter", "read_capture"]
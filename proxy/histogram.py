@@ -0,0 +1,73 @@
+class Histogram:
+    """HDR-style log-linear histogram of non-negative integers (e.g. microseconds).
+
+    Values below ``2**sub_bucket_bits`` are counted exactly. Above that, every
+    power-of-two range is split into ``2**(sub_bucket_bits - 1)`` equal buckets, so
+    a reported value is within ``2**-(sub_bucket_bits - 1)`` of the true one
+    (under 0.8% with the default 8 bits) at any magnitude. Memory grows with the
+    number of distinct buckets hit, not with the number of values recorded.
+    """
+
+    __slots__ = ("sub_bucket_bits", "counts", "count", "total", "min", "max")
+
+    def __init__(self, sub_bucket_bits=8):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        half = 1 << (self.sub_bucket_bits - 1)
+        return (1 << self.sub_bucket_bits) + (shift - 1) * half + ((value >> shift) - half)
+
+    def _highest_equivalent(self, index):
+        size = 1 << self.sub_bucket_bits
+        if index < size:
+            return index
+        half = size >> 1
+        shift = (index - size) // half + 1
+        top = (index - size) % half + half
+        return ((top + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """Smallest bucket value that at least ``percentile``% of recorded values do not exceed."""
+        if not self.count:
+            return None
+        if percentile >= 100:
+            return self.max
+        rank = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest_equivalent(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+__all__ = ["Histogram"]
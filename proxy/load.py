@@ -0,0 +1,215 @@
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_TARGETS = [
+    "http://train-service/trigger",
+    "http://ticket-service/trigger",
+    "http://passenger-service/trigger",
+    "http://train-management-service/trigger",
+]
+# Comma-separated "<url>" or "<url>=<rps>"; URLs without a rate use LOAD_RPS
+LOAD_TARGETS = os.getenv("LOAD_TARGETS", ",".join(DEFAULT_TARGETS))
+# Target requests/s per URL; the default roughly matches the old fixed loop
+LOAD_RPS = float(os.getenv("LOAD_RPS", "0.5"))
+# constant, poisson, ramp or step
+LOAD_PROFILE = os.getenv("LOAD_PROFILE", "constant")
+# Seconds to run; 0 runs until the process is stopped
+LOAD_DURATION = float(os.getenv("LOAD_DURATION", "0"))
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", "32"))
+# Requests waiting for a free worker before new arrivals are dropped (and counted) instead of queued
+LOAD_MAX_BACKLOG = int(os.getenv("LOAD_MAX_BACKLOG", "10000"))
+# ramp: seconds to rise from 0 to the target rate (default: the whole run, or 60 s when unbounded)
+LOAD_RAMP_SECONDS = float(os.getenv("LOAD_RAMP_SECONDS", "0"))
+# step: the target rate is reached in LOAD_STEPS equal steps of LOAD_STEP_SECONDS each
+LOAD_STEPS = int(os.getenv("LOAD_STEPS", "5"))
+LOAD_STEP_SECONDS = float(os.getenv("LOAD_STEP_SECONDS", "60"))
+LOAD_SEED = os.getenv("LOAD_SEED")
+# Synthetic messages POSTed per request (see synthetic.py); 0 sends plain GETs and the services make their own
+LOAD_PAYLOADS = int(os.getenv("LOAD_PAYLOADS", "0"))
+
+PROFILES = ("constant", "poisson", "ramp", "step")
+
+# What send() returns for a failure it simulated without sending anything
+INJECTED = "injected"
+
+
+def parse_targets(spec, default_rps):
+    targets = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        url, _, rps = entry.rpartition("=")
+        try:
+            targets[url] = float(rps)
+        except ValueError:
+            # No rate given (or an "=" that belongs to the query string)
+            targets[entry] = default_rps
+    return targets
+
+
+def _time_of(profile, rps, n, ramp_seconds, steps, step_seconds):
+    """Inverse of the expected request count: the time by which ``n`` requests are due."""
+    if profile == "ramp" and ramp_seconds > 0:
+        ramped = rps * ramp_seconds / 2
+        if n <= ramped:
+            return math.sqrt(2 * ramp_seconds * n / rps)
+        return ramp_seconds + (n - ramped) / rps
+    if profile == "step":
+        t = 0.0
+        for step in range(1, steps):
+            in_step = rps * step / steps * step_seconds
+            if n <= in_step:
+                return t + n / (rps * step / steps)
+            n -= in_step
+            t += step_seconds
+        return t + n / rps
+    return n / rps
+
+
+def arrivals(profile, rps, duration=0.0, rng=None, ramp_seconds=60.0, steps=5, step_seconds=60.0):
+    """Yield intended send times, in seconds from the start of the run.
+
+    Requests are due whenever the expected count under the profile's rate
+    curve passes the next whole number, so ``constant``, ``ramp`` and ``step``
+    are evenly paced at the current rate. ``poisson`` advances the count by
+    exponential increments instead, i.e. a Poisson process at ``rps``.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown LOAD_PROFILE {profile!r}; expected one of {PROFILES}")
+    if rps <= 0:
+        return
+    rng = rng or random.Random()
+    n = 0.0
+    while True:
+        n += rng.expovariate(1.0) if profile == "poisson" else 1.0
+        t = _time_of(profile, rps, n, ramp_seconds, steps, step_seconds)
+        if duration and t >= duration:
+            return
+        yield t
+
+
+class LoadGenerator:
+    """Open-loop load: requests are sent on a schedule, not after the previous one returns.
+
+    One scheduler thread per target walks that target's ``arrivals`` and hands
+    each request to a shared pool of ``concurrency`` workers at its intended
+    time, whether or not earlier requests have finished. With ``replay`` (an
+    iterable of ``(offset, url, payload)`` such as ``capture.read_capture``) a
+    single scheduler follows that instead, pulling one request at a time.
+    ``send(url, payload)`` performs one request and returns True on success,
+    False on failure, or INJECTED for a simulated failure that sent nothing;
+    for generated load, ``payload(url)``, if given, supplies the payload.
+    ``record`` receives ``(url, intended, started, finished, ok)`` perf_counter
+    timestamps, and ``capture``, if given, ``(unix_time, url, payload)`` for
+    every request as it is scheduled. Latency measured from ``intended``
+    includes any time spent waiting for a worker, so a slow system cannot hide
+    behind a slower request rate (coordinated omission). Arrivals that find
+    ``max_backlog`` requests already waiting are dropped and recorded as
+    failures with ``started``/``finished`` of None.
+    """
+
+    def __init__(self, targets, send, record=None, profile=LOAD_PROFILE, duration=LOAD_DURATION, concurrency=LOAD_CONCURRENCY,
+                 max_backlog=LOAD_MAX_BACKLOG, seed=LOAD_SEED, ramp_seconds=LOAD_RAMP_SECONDS, steps=LOAD_STEPS, step_seconds=LOAD_STEP_SECONDS,
+                 replay=None, capture=None, payload=None):
+        self.targets = dict(targets)
+        self.send = send
+        self.record = record or self._count
+        self.profile = profile
+        self.duration = duration
+        self.concurrency = concurrency
+        self.max_backlog = max_backlog
+        self.seed = seed
+        self.ramp_seconds = ramp_seconds or duration or 60.0
+        self.steps = steps
+        self.step_seconds = step_seconds
+        self.replay = replay
+        self.capture = capture
+        self.payload = payload
+        self.counts = defaultdict(lambda: {"sent": 0, "failed": 0, "dropped": 0, "injected": 0})
+        self._backlog = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _count(self, url, intended, started, finished, ok):
+        with self._lock:
+            counts = self.counts[url]
+            if started is None:
+                counts["dropped"] += 1
+            elif ok == INJECTED:
+                counts["injected"] += 1
+                return
+            else:
+                counts["sent"] += 1
+            if not ok:
+                counts["failed"] += 1
+
+    def _fire(self, url, payload, intended):
+        with self._lock:
+            self._backlog -= 1
+        started = time.perf_counter()
+        try:
+            ok = self.send(url, payload)
+        except Exception as e:
+            print(f"Error triggering {url}: {e}", flush=True, file=sys.stdout)
+            ok = False
+        self.record(url, intended, started, time.perf_counter(), ok)
+
+    def _target_schedule(self, url, rps, index):
+        # Seeded per target so that a run's arrival pattern is reproducible
+        rng = random.Random(f"{self.seed}:{index}") if self.seed is not None else random.Random()
+        for offset in arrivals(self.profile, rps, self.duration, rng, self.ramp_seconds, self.steps, self.step_seconds):
+            yield offset, url, self.payload(url) if self.payload is not None else None
+
+    def _schedule(self, executor, schedule, start):
+        for offset, url, payload in schedule:
+            if self.duration and offset >= self.duration:
+                return
+            intended = start + offset
+            delay = intended - time.perf_counter()
+            if delay > 0 and self._stop.wait(delay):
+                return
+            if self._stop.is_set():
+                return
+            if self.capture is not None:
+                self.capture(time.time() - (time.perf_counter() - intended), url, payload)
+            with self._lock:
+                dropped = self._backlog >= self.max_backlog
+                if not dropped:
+                    self._backlog += 1
+            if dropped:
+                self.record(url, intended, None, None, False)
+            else:
+                executor.submit(self._fire, url, payload, intended)
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """Run for ``duration`` seconds (or until ``stop``, or the end of ``replay``) and wait for in-flight requests."""
+        start = time.perf_counter()
+        if self.replay is not None:
+            schedules = [self.replay]
+        else:
+            schedules = [self._target_schedule(url, rps, index) for index, (url, rps) in enumerate(self.targets.items())]
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="load") as executor:
+            schedulers = [
+                threading.Thread(target=self._schedule, args=(executor, schedule, start), name=f"schedule-{index}", daemon=True)
+                for index, schedule in enumerate(schedules)
+            ]
+            for thread in schedulers:
+                thread.start()
+            try:
+                for thread in schedulers:
+                    while thread.is_alive():
+                        thread.join(timeout=1.0)
+            except KeyboardInterrupt:
+                self.stop()
+        return time.perf_counter() - start
+
+
+__all__ = ["INJECTED", "LoadGenerator", "arrivals", "parse_targets"]
@@ -0,0 +1,170 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from histogram import Histogram
+from load import INJECTED
+
+
+# Seconds per rolling interval line; 0 disables interval output
+LOAD_REPORT_INTERVAL = float(os.getenv("LOAD_REPORT_INTERVAL", "10"))
+# Where the end-of-run JSON report goes: a file path, or "-" for stdout
+LOAD_REPORT_PATH = os.getenv("LOAD_REPORT_PATH", "-")
+# Interval summaries kept for the final report
+LOAD_REPORT_KEEP_INTERVALS = int(os.getenv("LOAD_REPORT_KEEP_INTERVALS", "1000"))
+
+PERCENTILES = (("p50", 50), ("p90", 90), ("p99", 99), ("p99.9", 99.9))
+
+
+class _Window:
+    __slots__ = ("latency", "service", "succeeded", "failed", "dropped", "injected")
+
+    def __init__(self):
+        # Latency runs from the intended send time, service time from the actual one
+        self.latency = Histogram()
+        self.service = Histogram()
+        self.succeeded = 0
+        self.failed = 0
+        self.dropped = 0
+        # Simulated failures; they sent nothing, so they stay out of the latencies and the error rate
+        self.injected = 0
+
+    def summary(self, seconds):
+        completed = self.succeeded + self.failed
+        attempted = completed + self.dropped
+        return {
+            "requests": completed,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "injected": self.injected,
+            "throughput_rps": round(completed / seconds, 3) if seconds > 0 else None,
+            "error_rate": round((self.failed + self.dropped) / attempted, 5) if attempted else 0.0,
+            "latency_ms": _latencies(self.latency),
+            "service_time_ms": _latencies(self.service),
+        }
+
+
+def _latencies(histogram):
+    def ms(value):
+        return None if value is None else round(value / 1000, 3)
+    summary = {name: ms(histogram.percentile(p)) for name, p in PERCENTILES}
+    summary["max"] = ms(histogram.max)
+    summary["mean"] = ms(histogram.mean())
+    return summary
+
+
+class LoadReport:
+    """Per-URL latency histograms, throughput and error rate for a load run.
+
+    ``record`` is the LoadGenerator callback. Every ``interval`` seconds the
+    report prints one JSON line per URL for the interval just finished and
+    folds it into the run totals; ``finish`` writes the whole run as one JSON
+    document for comparing runs.
+    """
+
+    def __init__(self, config=None, interval=LOAD_REPORT_INTERVAL, path=LOAD_REPORT_PATH, keep_intervals=LOAD_REPORT_KEEP_INTERVALS, out=sys.stdout):
+        self.config = config or {}
+        self.interval = interval
+        self.path = path
+        self.out = out
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.totals = {}
+        self.intervals = deque(maxlen=keep_intervals)
+        self._current = {}
+        self._interval_started = self.started
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, url, intended, started, finished, ok):
+        with self._lock:
+            window = self._current.get(url)
+            if window is None:
+                window = self._current[url] = _Window()
+            if started is None:
+                window.dropped += 1
+                return
+            if ok == INJECTED:
+                window.injected += 1
+                return
+            window.latency.record((finished - intended) * 1e6)
+            window.service.record((finished - started) * 1e6)
+            if ok:
+                window.succeeded += 1
+            else:
+                window.failed += 1
+
+    def _roll(self, emit=True):
+        now = time.perf_counter()
+        with self._lock:
+            windows, self._current = self._current, {}
+            started, self._interval_started = self._interval_started, now
+        seconds = now - started
+        for url, window in sorted(windows.items()):
+            total = self.totals.get(url)
+            if total is None:
+                total = self.totals[url] = _Window()
+            total.latency.merge(window.latency)
+            total.service.merge(window.service)
+            total.succeeded += window.succeeded
+            total.failed += window.failed
+            total.dropped += window.dropped
+            total.injected += window.injected
+            line = {"type": "interval", "url": url, "start_s": round(started - self.started, 3), "seconds": round(seconds, 3), **window.summary(seconds)}
+            self.intervals.append(line)
+            if emit:
+                print(json.dumps(line), file=self.out, flush=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._roll()
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="load-report", daemon=True)
+            self._thread.start()
+        return self
+
+    def finish(self, extra=None):
+        """Stop interval output, fold in the last partial interval and write the run report.
+
+        ``extra`` adds top-level sections, e.g. load-generator connection statistics.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._roll(emit=self.interval > 0)
+        seconds = time.perf_counter() - self.started
+        overall = _Window()
+        for total in self.totals.values():
+            overall.latency.merge(total.latency)
+            overall.service.merge(total.service)
+            overall.succeeded += total.succeeded
+            overall.failed += total.failed
+            overall.dropped += total.dropped
+            overall.injected += total.injected
+        report = {
+            "type": "report",
+            "started_at": self.started_at,
+            "duration_s": round(seconds, 3),
+            "config": self.config,
+            "overall": overall.summary(seconds),
+            "urls": {url: total.summary(seconds) for url, total in sorted(self.totals.items())},
+            "intervals": list(self.intervals),
+            **(extra or {}),
+        }
+        if self.path == "-":
+            print(json.dumps(report), file=self.out, flush=True)
+        else:
+            with open(self.path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Proxy: Load report written to {self.path}", file=self.out, flush=True)
+        return report
+
+
+__all__ = ["LoadReport"]
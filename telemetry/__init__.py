@@ -0,0 +1,3 @@
+from .otel import PropagatingTracer, meter, serve_metrics, setup, tracer
+
+__all__ = ["PropagatingTracer", "meter", "serve_metrics", "setup", "tracer"]
@@ -0,0 +1,193 @@
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+from opentelemetry import metrics, trace
+
+
+# Defaults to the entry point's directory: train_service/app.py runs as "train-service"
+SERVICE_NAME = os.getenv("SERVICE_NAME") or os.path.basename(os.path.dirname(os.path.abspath(sys.argv[0]))).replace("_", "-")
+SERVICE_VERSION = os.getenv("SERVICE_VERSION", "1.0.0")
+ENVIRONMENT = os.getenv("DEPLOYMENT_ENV", "production")
+DT_ENDPOINT = os.getenv("DT_ENDPOINT")
+DT_API_TOKEN = os.getenv("DT_API_TOKEN")
+# OTLP metrics go next to the traces: ".../v1/traces" becomes ".../v1/metrics" unless set explicitly
+DT_METRICS_ENDPOINT = os.getenv("DT_METRICS_ENDPOINT") or (
+    DT_ENDPOINT[:-len("/v1/traces")] + "/v1/metrics" if DT_ENDPOINT and DT_ENDPOINT.endswith("/v1/traces") else None
+)
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "60"))
+# Prometheus scrape endpoint (http://<pod>:<port>/metrics); 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Where spans go: "otlp" to DT_ENDPOINT, "file" to local OTLP/JSON files (TRACE_FILE_DIR), or "none" to not record them at all
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "otlp" if DT_ENDPOINT else "none")
+# Content encoding of OTLP span and metric exports: "gzip" or "none"
+OTLP_COMPRESSION = os.getenv("OTLP_COMPRESSION", "gzip")
+
+EXPORTERS = ("otlp", "file", "none")
+if TRACE_EXPORTER not in EXPORTERS:
+    raise ValueError(f"Unknown TRACE_EXPORTER {TRACE_EXPORTER!r}; expected one of {EXPORTERS}")
+COMPRESSIONS = ("gzip", "none")
+if OTLP_COMPRESSION not in COMPRESSIONS:
+    raise ValueError(f"Unknown OTLP_COMPRESSION {OTLP_COMPRESSION!r}; expected one of {COMPRESSIONS}")
+
+ENRICHMENT_FILES = ("/var/lib/dynatrace/enrichment/dt_metadata.json", "/var/lib/dynatrace/enrichment/dt_host_metadata.json")
+
+
+class PropagatingTracer(trace.NoOpTracer):
+    """A tracer that records nothing but keeps incoming traces going.
+
+    The API's ``NoOpTracer`` returns the invalid span whatever the parent, so a
+    stage using it would send its messages without a ``traceparent`` and cut
+    every trace passing through it in two. This one hands back the parent's
+    span context in a ``NonRecordingSpan`` instead: messages sent under it
+    carry the trace unchanged, as if the stage were not there.
+    """
+
+    def start_span(self, name, context=None, *args, **kwargs):
+        parent = trace.get_current_span(context).get_span_context()
+        return trace.NonRecordingSpan(parent) if parent.is_valid else trace.INVALID_SPAN
+
+    @contextmanager
+    def start_as_current_span(self, name, context=None, kind=trace.SpanKind.INTERNAL, attributes=None, links=None,
+                              start_time=None, record_exception=True, set_status_on_exception=True, end_on_exit=True):
+        span = self.start_span(name, context)
+        if context is None:
+            # The current span already carries the same span context: nothing to attach
+            yield span
+            return
+        with trace.use_span(span, end_on_exit=end_on_exit, record_exception=record_exception,
+                            set_status_on_exception=set_status_on_exception):
+            yield span
+
+
+# With nothing to export, spans go straight to the propagating tracer: no SDK, no proxy lookup per span.
+# Otherwise the proxies delegate to the SDK providers once setup() installs them.
+tracer = PropagatingTracer() if TRACE_EXPORTER == "none" else trace.get_tracer(__name__)
+meter = metrics.get_meter(__name__)
+
+tracer_provider = None
+meter_provider = None
+_setup_done = False
+_setup_lock = threading.Lock()
+
+
+def resource_attributes():
+    """Dynatrace enrichment (when running under OneAgent) plus this service's identity."""
+    merged = {}
+    for name in ENRICHMENT_FILES:
+        try:
+            with open(name) as f:
+                merged.update(json.load(f))
+        except Exception:
+            pass
+    merged.update({
+        "service.name": SERVICE_NAME,
+        "service.version": SERVICE_VERSION,
+        "deployment.environment": ENVIRONMENT,
+    })
+    return merged
+
+
+def _tracer_provider(resource):
+    from opentelemetry.sdk.trace import TracerProvider
+    from .sampling import TRACE_TAIL_SAMPLING, TailSamplingProcessor, make_sampler
+    from .spool import MeteredBatchSpanProcessor, SpoolingSpanExporter, default_spool
+
+    # Head sampling decides whether a span is recorded at all; tail sampling whether a recorded one is exported
+    provider = TracerProvider(resource=resource, sampler=make_sampler())
+    if TRACE_EXPORTER == "file":
+        from .spanfile import FileSpanExporter
+        exporter = FileSpanExporter(SERVICE_NAME)
+    else:
+        # Batches that fail while the endpoint is unreachable wait in the spool and are resent once it is back
+        exporter = SpoolingSpanExporter(
+            endpoint=DT_ENDPOINT,
+            headers={"Authorization": f"Api-Token {DT_API_TOKEN}"},
+            compression=OTLP_COMPRESSION,
+            spool=default_spool(),
+        )
+    span_processor = MeteredBatchSpanProcessor(exporter)
+    if TRACE_TAIL_SAMPLING:
+        span_processor = TailSamplingProcessor(span_processor)
+    provider.add_span_processor(span_processor)
+    return provider
+
+
+def _meter_provider(resource):
+    from opentelemetry.sdk.metrics import MeterProvider
+
+    metric_readers = []
+    if METRICS_PORT:
+        from opentelemetry.exporter.prometheus import PrometheusMetricReader
+        # Collected from the meter provider on each scrape; served by serve_metrics()
+        metric_readers.append(PrometheusMetricReader())
+    if DT_METRICS_ENDPOINT:
+        from opentelemetry.exporter.otlp.proto.http import Compression
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+        from opentelemetry.sdk.metrics import Counter, Histogram, ObservableCounter, ObservableUpDownCounter, UpDownCounter
+        from opentelemetry.sdk.metrics.export import AggregationTemporality, PeriodicExportingMetricReader
+        # Dynatrace only ingests delta temporality for counters and histograms
+        delta = AggregationTemporality.DELTA
+        metric_readers.append(PeriodicExportingMetricReader(
+            OTLPMetricExporter(
+                endpoint=DT_METRICS_ENDPOINT,
+                headers={"Authorization": f"Api-Token {DT_API_TOKEN}"},
+                compression=Compression.Gzip if OTLP_COMPRESSION == "gzip" else Compression.NoCompression,
+                preferred_temporality={Counter: delta, Histogram: delta, ObservableCounter: delta,
+                                       UpDownCounter: AggregationTemporality.CUMULATIVE, ObservableUpDownCounter: AggregationTemporality.CUMULATIVE},
+            ),
+            export_interval_millis=METRICS_EXPORT_INTERVAL * 1000,
+        ))
+    if not metric_readers:
+        return None
+    return MeterProvider(resource=resource, metric_readers=metric_readers)
+
+
+def setup():
+    """Install the SDK tracer and meter providers for this process, on first call.
+
+    Importing this module only loads the OpenTelemetry API; the SDK, the
+    exporters and the enrichment files are loaded here, and only for what is
+    configured. Without an exporter, spans are not recorded, though trace
+    context still passes through; without a scrape port or OTLP metrics
+    endpoint, instruments are no-ops. serve_metrics() calls this, so entry
+    points rarely need to. Call it after forking: a provider built before
+    a fork keeps its export threads in the parent.
+    """
+    global tracer_provider, meter_provider, _setup_done
+    if _setup_done:
+        return
+    with _setup_lock:
+        if _setup_done:
+            return
+        resource = None
+        if TRACE_EXPORTER != "none" or METRICS_PORT or DT_METRICS_ENDPOINT:
+            from opentelemetry.sdk.resources import Resource
+            resource = Resource.create(resource_attributes())
+        if TRACE_EXPORTER != "none":
+            tracer_provider = _tracer_provider(resource)
+            trace.set_tracer_provider(tracer_provider)
+        if resource is not None:
+            meter_provider = _meter_provider(resource)
+            if meter_provider is not None:
+                metrics.set_meter_provider(meter_provider)
+        _setup_done = True
+
+
+_metrics_port = None
+
+
+def serve_metrics(port=METRICS_PORT):
+    """Set up telemetry and serve /metrics for Prometheus on ``port`` from a background thread, once per process."""
+    global _metrics_port
+    setup()
+    if not METRICS_PORT or _metrics_port is not None:
+        return
+    from prometheus_client import start_http_server
+    start_http_server(port)
+    _metrics_port = port
+    print(f"{SERVICE_NAME}: Serving metrics on :{port}/metrics", flush=True)
+
+__all__ = ["PropagatingTracer", "meter", "serve_metrics", "setup", "tracer"]
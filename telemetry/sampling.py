@@ -0,0 +1,186 @@
+import os
+import random
+import threading
+from collections import OrderedDict
+
+from opentelemetry import metrics
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, Sampler, TraceIdRatioBased
+from opentelemetry.trace import StatusCode
+
+
+# "parentbased" follows the sender's decision and samples new traces at TRACE_SAMPLE_RATIO;
+# "ratio" applies TRACE_SAMPLE_RATIO to every span by trace ID, which agrees across services anyway
+TRACE_SAMPLER = os.getenv("TRACE_SAMPLER", "parentbased")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+# Buffer each local trace until its root span ends, then keep errors, slow traces and a share of the rest
+TRACE_TAIL_SAMPLING = os.getenv("TRACE_TAIL_SAMPLING", "0") == "1"
+TRACE_TAIL_KEEP_RATIO = float(os.getenv("TRACE_TAIL_KEEP_RATIO", "0.1"))
+# A local root span this long, or a message this old end to end, makes its trace slow
+TRACE_TAIL_LATENCY_MS = float(os.getenv("TRACE_TAIL_LATENCY_MS", "1000"))
+# Spans buffered before the oldest undecided trace is decided early
+TRACE_TAIL_MAX_SPANS = int(os.getenv("TRACE_TAIL_MAX_SPANS", "20000"))
+
+SAMPLERS = ("parentbased", "ratio")
+if TRACE_SAMPLER not in SAMPLERS:
+    raise ValueError(f"Unknown TRACE_SAMPLER {TRACE_SAMPLER!r}; expected one of {SAMPLERS}")
+
+# Bound to the meter provider once otel.py sets it
+meter = metrics.get_meter(__name__)
+spans_kept = meter.create_counter("trace.spans.kept", unit="{span}", description="Spans passed on for export, by reason")
+spans_dropped = meter.create_counter("trace.spans.dropped", unit="{span}", description="Spans not exported, by sampling stage and reason")
+
+
+class CountingSampler(Sampler):
+    """Wraps a head sampler and counts the spans it drops (and, without tail sampling, keeps)."""
+
+    def __init__(self, delegate, count_kept=True):
+        self.delegate = delegate
+        self.count_kept = count_kept
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        result = self.delegate.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if not result.decision.is_sampled():
+            spans_dropped.add(1, {"stage": "head", "reason": "unsampled"})
+        elif self.count_kept:
+            spans_kept.add(1, {"reason": "sampled"})
+        return result
+
+    def get_description(self):
+        return f"Counting{{{self.delegate.get_description()}}}"
+
+
+def make_sampler(kind=TRACE_SAMPLER, ratio=TRACE_SAMPLE_RATIO, count_kept=not TRACE_TAIL_SAMPLING):
+    sampler = TraceIdRatioBased(ratio)
+    if kind == "parentbased":
+        sampler = ParentBased(sampler)
+    return CountingSampler(sampler, count_kept)
+
+
+class _LocalTrace:
+    __slots__ = ("spans", "error")
+
+    def __init__(self):
+        self.spans = []
+        self.error = False
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """Decides which recorded spans reach ``processor`` once each local trace is complete.
+
+    A local trace is a span whose parent is remote or absent (an HTTP request, a
+    delivery's receive span) plus everything started beneath it in this process.
+    Its spans are held until that root ends. The whole local trace is kept if
+    any span failed, if the root took ``latency_ms`` or longer, or if the root
+    reports a ``messaging.end_to_end_ms`` of ``latency_ms`` or more. Otherwise
+    it is kept with probability ``keep_ratio``. Spans that end after their
+    root follow its decision. When more than ``max_spans`` spans are buffered,
+    the oldest local traces are decided early, on what they hold so far.
+
+    Decisions are local, so an error in one service keeps that service's part
+    of a trace, not the whole distributed trace.
+    """
+
+    def __init__(self, processor, keep_ratio=TRACE_TAIL_KEEP_RATIO, latency_ms=TRACE_TAIL_LATENCY_MS, max_spans=TRACE_TAIL_MAX_SPANS):
+        self.processor = processor
+        self.keep_ratio = keep_ratio
+        self.latency_ns = latency_ms * 1e6
+        self.latency_ms = latency_ms
+        self.max_spans = max_spans
+        self._roots = {}  # span id -> span id of its local root, for spans still open
+        self._traces = OrderedDict()  # local root span id -> _LocalTrace, oldest first
+        self._decided = OrderedDict()  # local root span id -> kept, for spans ending after their root
+        self._buffered = 0
+        self._lock = threading.Lock()
+
+    def on_start(self, span, parent_context=None):
+        parent = span.parent
+        span_id = span.context.span_id
+        with self._lock:
+            if parent is None or parent.is_remote:
+                self._roots[span_id] = span_id
+                self._traces[span_id] = _LocalTrace()
+            else:
+                self._roots[span_id] = self._roots.get(parent.span_id, parent.span_id)
+        self.processor.on_start(span, parent_context)
+
+    def on_end(self, span):
+        span_id = span.context.span_id
+        with self._lock:
+            root = self._roots.pop(span_id, span_id)
+            trace = self._traces.get(root)
+            if trace is None:
+                late = self._decided.get(root)
+            else:
+                trace.spans.append(span)
+                trace.error = trace.error or span.status.status_code is StatusCode.ERROR
+                self._buffered += 1
+                if root == span_id:
+                    del self._traces[root]
+                    self._buffered -= len(trace.spans)
+                    ready = [(root, trace, self._reason(trace, span))]
+                else:
+                    ready = []
+                ready.extend(self._evict())
+        if trace is None:
+            # The root is already decided, or its decision was forgotten: export to be safe
+            self._emit(None, [span], True if late is None else late, "late")
+            return
+        for root, trace, reason in ready:
+            self._emit(root, trace.spans, reason is not None, reason or "healthy")
+
+    def _reason(self, trace, root_span):
+        """Why a local trace is kept, or None to drop it."""
+        if trace.error:
+            return "error"
+        if root_span is not None:
+            if root_span.end_time - root_span.start_time >= self.latency_ns:
+                return "slow"
+            age = (root_span.attributes or {}).get("messaging.end_to_end_ms")
+            if age is not None and age >= self.latency_ms:
+                return "slow"
+        if random.random() < self.keep_ratio:
+            return "sampled"
+        return None
+
+    def _evict(self):
+        # Called with the lock held
+        evicted = []
+        while self._buffered > self.max_spans and self._traces:
+            root, trace = self._traces.popitem(last=False)
+            self._buffered -= len(trace.spans)
+            evicted.append((root, trace, self._reason(trace, None)))
+        return evicted
+
+    def _emit(self, root, spans, keep, reason):
+        if root is not None:
+            with self._lock:
+                self._decided[root] = keep
+                while len(self._decided) > 10000:
+                    self._decided.popitem(last=False)
+        if not spans:
+            return
+        if keep:
+            spans_kept.add(len(spans), {"reason": reason})
+            for span in spans:
+                self.processor.on_end(span)
+        else:
+            spans_dropped.add(len(spans), {"stage": "tail", "reason": reason})
+
+    def _decide_all(self):
+        with self._lock:
+            pending = [(root, trace, self._reason(trace, None)) for root, trace in self._traces.items()]
+            self._traces.clear()
+            self._buffered = 0
+        for root, trace, reason in pending:
+            self._emit(root, trace.spans, reason is not None, reason or "healthy")
+
+    def force_flush(self, timeout_millis=30000):
+        return self.processor.force_flush(timeout_millis)
+
+    def shutdown(self):
+        self._decide_all()
+        self.processor.shutdown()
+
+
+__all__ = ["CountingSampler", "TailSamplingProcessor", "make_sampler"]
@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+from .spool import spans_exported
+
+
+# Where TRACE_EXPORTER=file writes: one file per process, rotated at TRACE_FILE_MAX_MB
+TRACE_FILE_DIR = os.getenv("TRACE_FILE_DIR", "/tmp/spans")
+TRACE_FILE_MAX_MB = float(os.getenv("TRACE_FILE_MAX_MB", "256"))
+# Files kept per process, oldest deleted first; 0 keeps them all
+TRACE_FILE_MAX_FILES = int(os.getenv("TRACE_FILE_MAX_FILES", "0"))
+
+SUFFIX = ".otlp.jsonl"
+
+
+def _value(value):
+    # OTLP/JSON AnyValue; 64-bit integers are strings, as in the protobuf JSON mapping
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def _attributes(attributes):
+    return [{"key": key, "value": _value(value)} for key, value in (attributes or {}).items()]
+
+
+def _span(span):
+    context = span.context
+    out = {
+        "traceId": f"{context.trace_id:032x}",
+        "spanId": f"{context.span_id:016x}",
+        "name": span.name,
+        # OTLP numbers span kinds from 1 (INTERNAL); the SDK from 0
+        "kind": span.kind.value + 1,
+        "startTimeUnixNano": str(span.start_time),
+        "endTimeUnixNano": str(span.end_time),
+        "attributes": _attributes(span.attributes),
+        "status": {"code": span.status.status_code.value},
+    }
+    if span.parent is not None:
+        out["parentSpanId"] = f"{span.parent.span_id:016x}"
+    if context.trace_state:
+        out["traceState"] = context.trace_state.to_header()
+    if span.status.description:
+        out["status"]["message"] = span.status.description
+    if span.events:
+        out["events"] = [{"timeUnixNano": str(event.timestamp), "name": event.name, "attributes": _attributes(event.attributes)}
+                         for event in span.events]
+    if span.links:
+        out["links"] = [{"traceId": f"{link.context.trace_id:032x}", "spanId": f"{link.context.span_id:016x}",
+                         "attributes": _attributes(link.attributes)} for link in span.links]
+    return out
+
+
+def encode(spans):
+    """``spans`` as one OTLP/JSON ExportTraceServiceRequest, grouped by resource and instrumentation scope."""
+    resources = {}
+    for span in spans:
+        resource, scopes = resources.setdefault(id(span.resource), (span.resource, {}))
+        scope = span.instrumentation_scope
+        key = (scope.name, scope.version or "") if scope is not None else ("", "")
+        scopes.setdefault(key, []).append(_span(span))
+    return {"resourceSpans": [
+        {
+            "resource": {"attributes": _attributes(resource.attributes)},
+            "scopeSpans": [{"scope": {"name": name, "version": version}, "spans": spans} for (name, version), spans in scopes.items()],
+        }
+        for resource, scopes in resources.values()
+    ]}
+
+
+class FileSpanExporter(SpanExporter):
+    """Writes span batches to local files as OTLP/JSON lines, for offline analysis.
+
+    Each line is one ExportTraceServiceRequest in the OTLP JSON encoding, the
+    layout the OpenTelemetry Collector's file exporter writes and its
+    ``otlpjsonfile`` receiver reads. Files are named
+    ``<service>-<pid>-<n>.otlp.jsonl``, so processes sharing a directory never
+    interleave lines. A file is closed once it reaches ``max_bytes`` and the
+    next ``n`` is opened. Lines are flushed per batch, so a reader sees whole
+    batches only.
+    """
+
+    def __init__(self, service, directory=TRACE_FILE_DIR, max_bytes=int(TRACE_FILE_MAX_MB * 1024 * 1024), max_files=TRACE_FILE_MAX_FILES):
+        self.service = service
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._file = None
+        self._pid = None
+        self._index = 0
+        self._written = []
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        if self._file is not None and self._pid == os.getpid() and self._file.tell() < self.max_bytes:
+            return self._file
+        if self._file is not None:
+            if self._pid == os.getpid():
+                self._file.close()
+            else:
+                # Inherited across a fork: the file is the parent's to finish
+                self._written = []
+                self._index = 0
+        self._pid = os.getpid()
+        self._index += 1
+        path = os.path.join(self.directory, f"{self.service}-{self._pid}-{self._index:04d}{SUFFIX}")
+        self._file = open(path, "a", encoding="utf-8")
+        self._written.append(path)
+        while self.max_files and len(self._written) > self.max_files:
+            try:
+                os.remove(self._written.pop(0))
+            except FileNotFoundError:
+                pass
+        return self._file
+
+    def export(self, spans):
+        line = json.dumps(encode(spans), separators=(",", ":")) + "\n"
+        with self._lock:
+            f = self._open()
+            f.write(line)
+            f.flush()
+        spans_exported.add(len(spans), {"source": "file"})
+        return SpanExportResult.SUCCESS
+
+    def force_flush(self, timeout_millis=30000):
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+
+
+__all__ = ["FileSpanExporter", "encode"]
@@ -0,0 +1,365 @@
+import gzip
+import os
+import sys
+import threading
+import time
+
+import requests
+from opentelemetry import metrics
+from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+from opentelemetry.metrics import Observation
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+
+from .sampling import spans_dropped
+
+
+# Spans per OTLP request, spans waiting for export (new spans are dropped beyond that), and ms between exports
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "512"))
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", "2048"))
+TRACE_EXPORT_INTERVAL_MS = float(os.getenv("TRACE_EXPORT_INTERVAL_MS", "5000"))
+# Seconds one OTLP request may take before the batch counts as failed
+TRACE_EXPORT_TIMEOUT = float(os.getenv("TRACE_EXPORT_TIMEOUT", "10"))
+# Batches that fail while the endpoint is down or overloaded wait here; empty disables the spool
+TRACE_SPOOL_DIR = os.getenv("TRACE_SPOOL_DIR", "/tmp/trace-spool")
+TRACE_SPOOL_MAX_MB = float(os.getenv("TRACE_SPOOL_MAX_MB", "64"))
+# Spooled batches resent after each successful export, so catching up never stalls live export for long
+TRACE_SPOOL_REPLAY_BATCHES = int(os.getenv("TRACE_SPOOL_REPLAY_BATCHES", "8"))
+# Seconds without an export after which the spool is drained anyway, so an idle service catches up too; 0 disables
+TRACE_SPOOL_REPLAY_INTERVAL = float(os.getenv("TRACE_SPOOL_REPLAY_INTERVAL", "30"))
+
+DEFAULT_ENDPOINT = "http://localhost:4318/v1/traces"
+
+# Outcomes of one OTLP request
+SENT = "sent"
+RETRYABLE = "retryable"
+REJECTED = "rejected"
+
+# Bound to the meter provider once otel.py sets it
+meter = metrics.get_meter(__name__)
+spans_exported = meter.create_counter(
+    "trace.spans.exported", unit="{span}", description="Spans exported, by source: sent live or replayed from the spool, or written to a file")
+spans_spooled = meter.create_counter(
+    "trace.spans.spooled", unit="{span}", description="Spans set aside on disk after a failed export")
+export_duration = meter.create_histogram(
+    "trace.export.duration", unit="ms", description="Time per OTLP span export request, by outcome")
+
+# What the gauges below observe; one of each per process
+_processors = []
+_spools = []
+
+
+class MeteredBatchSpanProcessor(BatchSpanProcessor):
+    """The SDK's batch span processor, sized from the environment, counting the spans it drops.
+
+    It keeps its own count of the spans it holds, raised in ``on_end`` and
+    lowered as the exporter is handed each batch, rather than reading the
+    SDK's queue, whose attributes are private and change between releases.
+    Once ``max_queue_size`` spans are waiting, new spans are dropped here and
+    counted in ``trace.spans.dropped``, so the SDK's own queue never fills
+    and never drops spans silently.
+    """
+
+    def __init__(self, exporter, max_queue_size=TRACE_EXPORT_QUEUE_SIZE, schedule_delay_millis=TRACE_EXPORT_INTERVAL_MS,
+                 max_export_batch_size=TRACE_EXPORT_BATCH_SIZE, export_timeout_millis=TRACE_EXPORT_TIMEOUT * 1000):
+        self.capacity = max_queue_size
+        # Spans handed to the SDK and not yet handed to the exporter
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._shut_down = False
+        super().__init__(_CountingExporter(exporter, self), max_queue_size=max_queue_size,
+                         schedule_delay_millis=schedule_delay_millis,
+                         max_export_batch_size=min(max_export_batch_size, max_queue_size),
+                         export_timeout_millis=export_timeout_millis)
+        _processors.append(self)
+
+    def on_end(self, span):
+        if self._shut_down or not span.context.trace_flags.sampled:
+            return
+        with self._pending_lock:
+            if self.pending >= self.capacity:
+                spans_dropped.add(1, {"stage": "export", "reason": "queue_full"})
+                return
+            self.pending += 1
+        super().on_end(span)
+
+    def exported(self, spans):
+        with self._pending_lock:
+            self.pending = max(0, self.pending - spans)
+
+    def shutdown(self):
+        self._shut_down = True
+        super().shutdown()
+
+
+class _CountingExporter(SpanExporter):
+    """Passes batches on to ``exporter``, telling ``processor`` how many spans left its queue."""
+
+    def __init__(self, exporter, processor):
+        self.exporter = exporter
+        self.processor = processor
+
+    def export(self, spans):
+        try:
+            return self.exporter.export(spans)
+        finally:
+            self.processor.exported(len(spans))
+
+    def shutdown(self):
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.exporter.force_flush(timeout_millis)
+
+
+class Spool:
+    """A bounded directory of OTLP request bodies that could not be sent yet.
+
+    Each failed batch is one file, named ``<ns>-<pid>-<seq>-<spans>.otlp[.gz]``:
+    a listing sorts oldest first and tells how many spans and which encoding
+    a file holds without reading it. Files are written under a temporary name
+    and renamed into place, so a reader never sees a partial one. Processes
+    may share a directory (processing workers do): replay claims a file by
+    renaming it, so each is sent once. When a new batch would take the
+    directory over ``max_bytes``, the oldest files are deleted to make room.
+    """
+
+    SENDING = ".sending"
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._seq = 0
+        os.makedirs(path, exist_ok=True)
+        self._recover()
+        _spools.append(self)
+
+    @staticmethod
+    def spans_in(name):
+        return int(name.split(".", 1)[0].rsplit("-", 1)[1])
+
+    def entries(self):
+        """(name, bytes) of every unclaimed batch, oldest first."""
+        entries = []
+        with os.scandir(self.path) as scan:
+            for entry in scan:
+                if entry.name.endswith((".otlp", ".otlp.gz")) and not entry.name.startswith("."):
+                    try:
+                        entries.append((entry.name, entry.stat().st_size))
+                    except FileNotFoundError:
+                        pass  # Claimed by another process meanwhile
+        entries.sort()
+        return entries
+
+    def put(self, body, spans, encoding):
+        """Store one batch; returns how many spans had to be dropped to stay under ``max_bytes``."""
+        if len(body) > self.max_bytes:
+            return spans
+        entries = self.entries()
+        total = sum(size for _, size in entries) + len(body)
+        dropped = 0
+        for name, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                dropped += self.spans_in(name)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._seq += 1
+        name = f"{time.time_ns():020d}-{os.getpid()}-{self._seq}-{spans}.otlp" + (".gz" if encoding == "gzip" else "")
+        temporary = os.path.join(self.path, f".{name}.tmp")
+        with open(temporary, "wb") as f:
+            f.write(body)
+        os.replace(temporary, os.path.join(self.path, name))
+        return dropped
+
+    def claim(self):
+        """The oldest unclaimed batch as ``(claim, body, spans, encoding)``, or None when the spool is empty."""
+        for name, _ in self.entries():
+            claim = os.path.join(self.path, f"{name}.{os.getpid()}{self.SENDING}")
+            try:
+                os.rename(os.path.join(self.path, name), claim)
+            except FileNotFoundError:
+                continue  # Another process claimed it first
+            with open(claim, "rb") as f:
+                body = f.read()
+            return claim, body, self.spans_in(name), "gzip" if name.endswith(".gz") else None
+        return None
+
+    def done(self, claim):
+        os.remove(claim)
+
+    def release(self, claim):
+        os.rename(claim, claim[:-len(self.SENDING)].rsplit(".", 1)[0])
+
+    def _recover(self):
+        # Put back batches claimed by processes that died before sending them
+        with os.scandir(self.path) as scan:
+            claims = [entry.name for entry in scan if entry.name.endswith(self.SENDING)]
+        for name in claims:
+            pid = int(name[:-len(self.SENDING)].rsplit(".", 1)[1])
+            if pid == os.getpid() or not _alive(pid):
+                try:
+                    self.release(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def default_spool():
+    return Spool(TRACE_SPOOL_DIR, int(TRACE_SPOOL_MAX_MB * 1024 * 1024)) if TRACE_SPOOL_DIR else None
+
+
+class SpoolingSpanExporter(SpanExporter):
+    """OTLP/HTTP span exporter that sets failed batches aside on disk and resends them later.
+
+    Each batch is encoded (and gzipped) once and posted once, without in-line
+    retries. A slow or unreachable endpoint therefore costs at most one timeout
+    per batch, and the batch processor's queue keeps draining instead of
+    backing up behind retries. A batch that fails with a connection error, a
+    timeout, 429 or 5xx goes to the spool. Any other status means the endpoint
+    rejected it, and it is dropped. After each successful export, up to
+    ``replay_batches`` spooled batches are resent, oldest first, stopping at
+    the first failure. A service that goes idle after an outage exports
+    nothing, so a background thread also drains the spool once no export has
+    run for ``replay_interval`` seconds. Only one replay runs at a time; an
+    export that finds one running leaves the spool to it.
+    """
+
+    def __init__(self, endpoint=None, headers=None, compression="gzip", timeout=TRACE_EXPORT_TIMEOUT, spool=None,
+                 replay_batches=TRACE_SPOOL_REPLAY_BATCHES, replay_interval=TRACE_SPOOL_REPLAY_INTERVAL):
+        self.endpoint = endpoint or DEFAULT_ENDPOINT
+        self.compression = compression if compression == "gzip" else None
+        self.timeout = timeout
+        self.spool = spool
+        self.replay_batches = replay_batches
+        self.replay_interval = replay_interval
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.session.headers["Content-Type"] = "application/x-protobuf"
+        self._failing = False
+        self._shutdown = False
+        self._last_export = time.monotonic()
+        self._replay_lock = threading.Lock()
+        self._stopped = threading.Event()
+        if spool is not None and replay_interval > 0:
+            threading.Thread(target=self._replay_when_idle, name="trace-spool-replay", daemon=True).start()
+
+    def _post(self, body, encoding):
+        started = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.endpoint, data=body, timeout=self.timeout, headers={"Content-Encoding": encoding} if encoding else None)
+        except requests.RequestException as exc:
+            outcome, detail = RETRYABLE, type(exc).__name__
+        else:
+            if response.ok:
+                outcome, detail = SENT, None
+            elif response.status_code == 429 or response.status_code >= 500:
+                outcome, detail = RETRYABLE, f"HTTP {response.status_code}"
+            else:
+                outcome, detail = REJECTED, f"HTTP {response.status_code}: {response.text[:200]}"
+        export_duration.record((time.perf_counter() - started) * 1000, {"outcome": outcome})
+        if outcome == SENT and self._failing:
+            print(f"SpoolingSpanExporter: {self.endpoint} is accepting spans again", flush=True, file=sys.stdout)
+        elif outcome != SENT and not self._failing:
+            print(f"SpoolingSpanExporter: export to {self.endpoint} failed ({detail})"
+                  f"{'; spooling' if outcome == RETRYABLE and self.spool is not None else ''}", flush=True, file=sys.stdout)
+        self._failing = outcome != SENT
+        return outcome
+
+    def export(self, spans):
+        if self._shutdown:
+            return SpanExportResult.FAILURE
+        self._last_export = time.monotonic()
+        body = encode_spans(spans).SerializeToString()
+        if self.compression:
+            body = gzip.compress(body, compresslevel=6)
+        outcome = self._post(body, self.compression)
+        if outcome == SENT:
+            spans_exported.add(len(spans), {"source": "live"})
+            self._replay()
+            return SpanExportResult.SUCCESS
+        if outcome == RETRYABLE and self.spool is not None:
+            dropped = self.spool.put(body, len(spans), self.compression)
+            spans_spooled.add(len(spans))
+            if dropped:
+                spans_dropped.add(dropped, {"stage": "export", "reason": "spool_full"})
+        else:
+            spans_dropped.add(len(spans), {"stage": "export", "reason": outcome})
+        return SpanExportResult.FAILURE
+
+    def _replay(self):
+        """Resend up to ``replay_batches`` spooled batches; True if all were resent and more may be waiting."""
+        if self.spool is None or not self._replay_lock.acquire(blocking=False):
+            return False
+        try:
+            for _ in range(self.replay_batches):
+                claimed = self.spool.claim()
+                if claimed is None:
+                    return False
+                claim, body, spans, encoding = claimed
+                outcome = self._post(body, encoding)
+                if outcome == RETRYABLE:
+                    self.spool.release(claim)
+                    return False
+                self.spool.done(claim)
+                if outcome == SENT:
+                    spans_exported.add(spans, {"source": "spool"})
+                else:
+                    spans_dropped.add(spans, {"stage": "export", "reason": outcome})
+            return True
+        finally:
+            self._replay_lock.release()
+
+    def _replay_when_idle(self):
+        while not self._stopped.wait(self.replay_interval):
+            # Live exports replay as they go; this only covers the time when none run
+            while (not self._shutdown and time.monotonic() - self._last_export >= self.replay_interval
+                   and self._replay()):
+                pass
+
+    def force_flush(self, timeout_millis=30000):
+        return True
+
+    def shutdown(self):
+        self._shutdown = True
+        self._stopped.set()
+        self.session.close()
+
+
+def _observe_spools(measure):
+    def callback(options):
+        observations = []
+        for spool in list(_spools):
+            try:
+                entries = spool.entries()
+            except OSError:
+                continue
+            observations.append(Observation(sum(measure(name, size) for name, size in entries), {"trace.spool.dir": spool.path}))
+        return observations
+    return callback
+
+
+meter.create_observable_gauge(
+    "trace.export.queue.size", callbacks=[lambda options: [Observation(p.pending) for p in list(_processors)]],
+    unit="{span}", description="Spans waiting in the batch processor for export")
+meter.create_observable_gauge(
+    "trace.spool.size", callbacks=[_observe_spools(lambda name, size: size)], unit="By",
+    description="Bytes of failed span batches waiting in the disk spool")
+meter.create_observable_gauge(
+    "trace.spool.spans", callbacks=[_observe_spools(lambda name, size: Spool.spans_in(name))], unit="{span}",
+    description="Spans waiting in the disk spool for replay")
+
+
+__all__ = ["MeteredBatchSpanProcessor", "Spool", "SpoolingSpanExporter", "default_spool"]
@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def run_service_code():
+    """Run ``code`` with a service's directory as its working directory and first on sys.path.
+
+    Services read their settings from the environment at import, so each check
+    runs in a fresh interpreter. The repository root is on the path, as in the
+    images, for the shared packages. ``data`` is passed as JSON on stdin; the
+    code's stdout is returned parsed as JSON.
+    """
+    def run(service, code, data=None, env=None):
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys; sys.path.insert(0, '.')\n" + code],
+            cwd=os.path.join(ROOT, service),
+            input=json.dumps(data),
+            capture_output=True,
+            text=True,
+            env={**os.environ, "PYTHONPATH": ROOT, "METRICS_PORT": "0", **(env or {})},
+            timeout=60,
+        )
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout)
+    return run
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+BUILD = """
+import json
+from app import build_message
+print(json.dumps(build_message("msg-1", "{conversation_id}")))
+"""
+
+WINDOWS = """
+import json, sys
+from app import INPUT_QUEUES, join_key, make_store
+store = make_store(False)
+for slot, message in enumerate(json.load(sys.stdin)):
+    store.add(join_key(message), slot, message)
+print(json.dumps({key: [part is not None for part in window.parts] for key, window in store.windows.items()}))
+"""
+
+
+@pytest.mark.parametrize("generator", ["fixed", "synthetic"])
+def test_batch_window_collects_a_trains_schedule_ticket_and_passenger(run_service_code, generator):
+    env = {"PAYLOAD_GENERATOR": generator, "PAYLOAD_SEED": "1", "PAYLOAD_TRAINS": "1", "AGGREGATION_MODE": "batch"}
+    # Each producer picks its own conversation, as independent triggers do
+    messages = [
+        run_service_code(producer, BUILD.format(conversation_id=f"conv-{n}"), env=env)
+        for n, producer in enumerate(["train_service", "ticket_service", "passenger_service"])
+    ]
+    windows = run_service_code("aggregation_service", WINDOWS, messages, env)
+    assert list(windows.values()) == [[True, True, True]], json.dumps(windows)
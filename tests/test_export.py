@@ -0,0 +1,66 @@
+HOLD_FULL_QUEUE = """
+import json, sys, threading
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+from telemetry.spool import MeteredBatchSpanProcessor
+
+class Blocked(SpanExporter):
+    def __init__(self):
+        self.release = threading.Event()
+        self.spans = 0
+    def export(self, spans):
+        self.release.wait()
+        self.spans += len(spans)
+        return SpanExportResult.SUCCESS
+
+exporter = Blocked()
+processor = MeteredBatchSpanProcessor(exporter, max_queue_size=8, max_export_batch_size=4, schedule_delay_millis=10)
+provider = TracerProvider()
+provider.add_span_processor(processor)
+tracer = provider.get_tracer("test")
+for n in range(20):
+    tracer.start_span(str(n)).end()
+held = processor.pending
+exporter.release.set()
+processor.force_flush()
+print(json.dumps({"held": held, "exported": exporter.spans, "pending": processor.pending}))
+provider.shutdown()
+"""
+
+
+def test_full_export_queue_drops_new_spans(run_service_code):
+    result = run_service_code("processing_service", HOLD_FULL_QUEUE)
+    assert result == {"held": 8, "exported": 8, "pending": 0}
+
+
+IDLE_REPLAY = """
+import json, tempfile, time
+from types import SimpleNamespace
+from telemetry.spool import Spool, SpoolingSpanExporter
+
+class Session:
+    def __init__(self):
+        self.headers = {}
+        self.posted = 0
+    def post(self, endpoint, data, timeout, headers=None):
+        self.posted += 1
+        return SimpleNamespace(ok=True, status_code=200)
+    def close(self):
+        pass
+
+spool = Spool(tempfile.mkdtemp(), 1 << 20)
+for n in range(5):
+    spool.put(b"batch", 2, None)
+exporter = SpoolingSpanExporter(spool=spool, replay_batches=2, replay_interval=0.05)
+exporter.session = session = Session()
+deadline = time.monotonic() + 5
+while spool.entries() and time.monotonic() < deadline:
+    time.sleep(0.01)
+exporter.shutdown()
+print(json.dumps({"left": len(spool.entries()), "posted": session.posted}))
+"""
+
+
+def test_idle_exporter_drains_its_spool(run_service_code):
+    # No span is exported, yet every spooled batch is resent
+    assert run_service_code("processing_service", IDLE_REPLAY) == {"left": 0, "posted": 5}
@@ -0,0 +1,37 @@
+CONVERSATIONS = """
+import json
+from app import new_conversation_id
+print(json.dumps(sorted({new_conversation_id() for _ in range(200)})))
+"""
+
+INTERLEAVED = """
+import json, sys, threading
+from payloads.synthetic import PayloadGenerator
+
+expected = PayloadGenerator(seed=7, trains=50, passengers=500)
+expected = [expected.ticket() for _ in range(8 * 500)]
+shared = PayloadGenerator(seed=7, trains=50, passengers=500)
+drawn = []
+
+def draw():
+    drawn.extend([shared.ticket() for _ in range(500)])
+
+sys.setswitchinterval(1e-6)
+threads = [threading.Thread(target=draw) for _ in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+key = lambda ticket: ticket["ticket_id"]
+print(json.dumps(sorted(drawn, key=key) == sorted(expected, key=key)))
+"""
+
+
+def test_synthetic_conversation_ids_come_from_the_population(run_service_code):
+    env = {"PAYLOAD_GENERATOR": "synthetic", "PAYLOAD_SEED": "1", "PAYLOAD_CONVERSATIONS": "3"}
+    assert run_service_code("ticket_service", CONVERSATIONS, env=env) == ["conv-000000", "conv-000001", "conv-000002"]
+
+
+def test_seeded_tickets_do_not_depend_on_thread_interleaving(run_service_code):
+    # Which thread gets which ticket may vary, but every ticket is one of the seeded sequence
+    assert run_service_code("ticket_service", INTERLEAVED) is True
@@ -0,0 +1,68 @@
+ABANDON = """
+import json
+from types import SimpleNamespace
+from pika.spec import Basic
+from messaging.rabbit import BatchPublisher
+
+class Channel:
+    def __init__(self):
+        self.published = []
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.published.append(body.decode())
+
+publisher = BatchPublisher(batch_size=2)
+publisher._channel = channel = Channel()
+abandoned = publisher.submit([("q", b"a1"), ("q", b"a2"), ("q", b"a3")])
+kept = publisher.submit([("q", b"b1")])
+publisher._drain()
+abandoned.cancel()
+publisher._on_confirm(SimpleNamespace(method=Basic.Ack(delivery_tag=2, multiple=True)))
+print(json.dumps({"published": channel.published, "abandoned": abandoned.cancelled(), "kept": kept.done()}))
+"""
+
+
+def test_abandoned_submission_is_not_published_later(run_service_code):
+    result = run_service_code("train_service", ABANDON)
+    # a1 and a2 were already sent; a3 is withdrawn and b1 goes out in the next batch
+    assert result == {"published": ["a1", "a2", "b1"], "abandoned": True, "kept": False}
+
+
+OUTBOX = """
+import contextlib
+import io
+import json
+from types import SimpleNamespace
+import redis
+from pika.spec import Basic
+import app
+from messaging import outbox as outbox_module
+from messaging.outbox import Outbox
+
+class Channel:
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        pass
+
+def unavailable():
+    raise redis.ConnectionError("Redis is down")
+
+sent = []
+outbox_module.record_sent = app.record_sent = lambda queue, count=1, elapsed_ms=None, operation="publish": sent.append(queue)
+app.random.random = lambda: 0.5
+app.get_redis = unavailable
+outbox = Outbox()
+outbox._channel = Channel()
+outbox._connection = SimpleNamespace(ioloop=SimpleNamespace(add_callback_threadsafe=lambda callback: None))
+app.get_outbox = lambda name, queues=(): outbox
+with contextlib.redirect_stdout(io.StringIO()) as log:
+    app.publish_message()
+queued = list(sent)
+outbox._flush()
+outbox._on_confirm(SimpleNamespace(method=Basic.Ack(delivery_tag=1, multiple=False)))
+print(json.dumps({"logged": "Redis is down" in log.getvalue(), "queued": queued, "confirmed": sent, "stats": {k: outbox.stats()[k] for k in ("submitted", "confirmed")}}))
+"""
+
+
+def test_outbox_counts_sent_on_confirm_and_survives_redis_failure(run_service_code):
+    result = run_service_code("train_service", OUTBOX, env={"OUTBOX_ENABLED": "1"})
+    # The failed Redis write does not refuse the publish, and nothing counts as sent before the ack
+    assert result == {"logged": True, "queued": [], "confirmed": ["ScheduleQueue"], "stats": {"submitted": 1, "confirmed": 1}}
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+SHARDS = "8"
+
+SHARD_OF = """
+import json, sys
+from messaging.rabbit import shard_index
+print(json.dumps([shard_index(message) for message in json.load(sys.stdin)]))
+"""
+
+JOIN_KEY_OF = """
+import json, sys
+from app import join_key
+print(json.dumps([join_key(message) for message in json.load(sys.stdin)]))
+"""
+
+CLAIM_SHORT_LOCK = """
+import json, time
+import fakeredis
+from sharding import ShardMembership
+client = fakeredis.FakeRedis()
+owner = ShardMembership(client, shards=1, ttl=0.2, member_id="a")
+other = ShardMembership(client, shards=1, ttl=0.2, member_id="b")
+claims = [owner.claim(0), other.claim(0)]
+time.sleep(0.3)
+claims.append(other.claim(0))
+print(json.dumps(claims))
+"""
+
+
+def join_parts(count):
+    """Schedule, ticket and passenger messages for ``count`` conversations, shaped like the producers' messages."""
+    rng = random.Random(7)
+    messages = []
+    for n in range(count):
+        conversation_id = f"conv-{n}"
+        train_id = str(rng.randint(1, 50))
+        messages.append({"train_id": train_id, "departure_time": "2025-04-15T10:00:00", "conversation_id": conversation_id})
+        messages.append({"ticket_id": str(n), "train_id": train_id, "passenger_id": str(n), "conversation_id": conversation_id})
+        messages.append({"passenger_id": str(n), "train_id": train_id, "name": "John Doe", "conversation_id": conversation_id})
+    return messages
+
+
+@pytest.mark.parametrize("mode", ["join", "batch"])
+@pytest.mark.parametrize("producer", ["train_service", "ticket_service", "passenger_service", "train_management_service"])
+def test_parts_of_a_join_key_share_a_shard(run_service_code, mode, producer):
+    env = {"AGGREGATION_SHARDS": SHARDS, "AGGREGATION_MODE": mode}
+    messages = join_parts(300)
+    keys = run_service_code("aggregation_service", JOIN_KEY_OF, messages, env)
+    shards = run_service_code(producer, SHARD_OF, messages, env)
+    shards_by_key = {}
+    for key, shard in zip(keys, shards):
+        shards_by_key.setdefault(key, set()).add(shard)
+    assert all(len(found) == 1 for found in shards_by_key.values()), {
+        key: found for key, found in shards_by_key.items() if len(found) > 1}
+    # Sharding actually spreads the keys
+    assert len({shard for found in shards_by_key.values() for shard in found}) > 1
+
+
+def test_sub_second_shard_lock_expires(run_service_code):
+    pytest.importorskip("fakeredis")
+    assert run_service_code("aggregation_service", CLAIM_SHORT_LOCK) == [True, False, True]
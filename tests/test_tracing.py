@@ -0,0 +1,24 @@
+import pytest
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+FORWARD = """
+import json, sys
+from telemetry import tracer
+from messaging.tracing import context_of, message_headers
+inherited = json.load(sys.stdin)
+with tracer.start_as_current_span("receive", context=context_of(inherited)):
+    with tracer.start_as_current_span("process"):
+        print(json.dumps(message_headers().get("traceparent")))
+"""
+
+
+@pytest.mark.parametrize("service", ["processing_service", "aggregation_service"])
+def test_traceparent_survives_a_stage_without_an_exporter(run_service_code, service):
+    env = {"TRACE_EXPORTER": "none", "DT_ENDPOINT": ""}
+    assert run_service_code(service, FORWARD, {"traceparent": TRACEPARENT}, env) == TRACEPARENT
+
+
+def test_stage_without_an_exporter_starts_no_trace(run_service_code):
+    env = {"TRACE_EXPORTER": "none", "DT_ENDPOINT": ""}
+    assert run_service_code("processing_service", FORWARD, {}, env) is None
@@ -1,22 +1,42 @@
 import os
-import json
-import pika
 import redis
 import random
 import sys
+import queue
+import time
 from flask import Flask, jsonify, request
-from otel import tracer
+from werkzeug.exceptions import BadRequest
+from telemetry import serve_metrics, tracer
+from messaging.rabbit import get_pool, get_publisher, shard_queue, shard_queues
+from messaging.outbox import OUTBOX_ENABLED, get_outbox
+from messaging.store import discard_last_message, get_redis, set_last_message
+from messaging.codec import CONTENT_TYPE, encode
+from payloads.synthetic import PAYLOAD_GENERATOR, get_generator, new_conversation_id
+from messaging.tracing import message_headers, publish_properties
+from messaging.metrics import elapsed_ms, record_sent
 from opentelemetry.trace import SpanKind, Status, StatusCode
 
 app = Flask(__name__)
 
+TRIGGER_MAX_BATCH = int(os.getenv("TRIGGER_MAX_BATCH", "100000"))
+
+def build_message(message_id, conversation_id):
+    if PAYLOAD_GENERATOR == "synthetic":
+        return {**get_generator().ticket(), "message_id": message_id, "conversation_id": conversation_id}
+    return {
+        "ticket_id": "456",
+        "train_id": "123",
+        "passenger_id": "789",
+        "seat_number": "12A",
+        "departure_time": "2025-04-15T10:00:00",
+        "message_id": message_id,
+        "conversation_id": conversation_id
+    }
+
 def publish_message():
     rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
-    rabbit_port = int(os.getenv("RABBITMQ_PORT", "5672"))
-    redis_host = os.getenv("REDIS_HOST", "redis")
-    redis_port = int(os.getenv("REDIS_PORT", "6379"))
     message_id = f"msg-{random.randint(1000,9999)}"
-    conversation_id = f"conv-{random.randint(100,999)}"
+    conversation_id = new_conversation_id()
 
     with tracer.start_as_current_span(
         "publish_ticket_message",
@@ -30,22 +50,28 @@ def publish_message():
         },
     ) as msg_span:
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host, port=rabbit_port, credentials=pika.PlainCredentials("admin", "password")))
-            channel = connection.channel()
-            channel.queue_declare(queue='TicketQueue', durable=True)
-            message = {
-                "ticket_id": "456",
-                "train_id": "123",
-                "passenger_id": "789",
-                "seat_number": "12A",
-                "departure_time": "2025-04-15T10:00:00",
-                "message_id": message_id,
-                "conversation_id": conversation_id
-            }
+            message = build_message(message_id, conversation_id)
             # Random error injection for messaging
             if random.random() < 0.001:
                 raise RuntimeError("Simulated messaging failure")
-            channel.basic_publish(exchange='', routing_key='TicketQueue', body=json.dumps(message))
+            started = time.perf_counter()
+            body = encode(message)
+            routing_key = shard_queue('TicketQueue', message)
+            if OUTBOX_ENABLED:
+                # Returns once the message is recorded; the outbox publishes and confirms it in the background
+                outbox = get_outbox('ticket_service', queues=shard_queues('TicketQueue'))
+                entry = outbox.entry(routing_key, body, CONTENT_TYPE, headers=message_headers(), correlation_id=conversation_id, destination='TicketQueue')
+                try:
+                    save_last_message(body, outbox, entry)
+                except redis.RedisError:
+                    # Degrade rather than refuse: the entry is held in memory only, so it is lost
+                    # if this process dies before the broker confirms it
+                    pass
+                # Counted as sent by the outbox once the broker confirms it
+                outbox.submit(entry)
+            else:
+                get_pool(queues=shard_queues('TicketQueue')).publish(routing_key, body, properties=publish_properties(CONTENT_TYPE, message_id=message_id, correlation_id=conversation_id))
+                record_sent('TicketQueue', 1, elapsed_ms(started))
             # otel_logger.info("TicketService: Sent ticket booking message", attributes={"messaging.message.id": message_id})
             msg_span.set_status(Status(StatusCode.OK))
         except Exception as exc:
@@ -55,10 +81,11 @@ def publish_message():
             print(f"[TicketService] Error sending message: {exc}", file=sys.stdout)
             traceback.print_exc()
             raise
-        finally:
-            if 'connection' in locals():
-                connection.close()
-    # Redis operation
+    if not OUTBOX_ENABLED:
+        save_last_message(body)
+
+def save_last_message(body, outbox=None, entry=None):
+    redis_host = os.getenv("REDIS_HOST", "redis")
     with tracer.start_as_current_span(
         "redis_set_last_message",
         kind=SpanKind.CLIENT,
@@ -71,11 +98,20 @@ def publish_message():
         },
     ) as db_span:
         try:
-            r = redis.Redis(host=redis_host, port=redis_port, password="password")
             # Random error injection for Redis
             if random.random() < 0.001:
                 raise redis.RedisError("Simulated Redis failure")
-            r.set("ticket_service_last_message", json.dumps(message))
+            if entry is None:
+                # Coalesced with other writes and flushed in one pipeline, unless LAST_MESSAGE_WRITES=sync
+                set_last_message("ticket_service_last_message", body)
+            else:
+                # The last-message write and the outbox record commit in one MULTI/EXEC;
+                # a buffered older value must not land after it
+                discard_last_message("ticket_service_last_message")
+                pipe = get_redis().pipeline(transaction=True)
+                pipe.set("ticket_service_last_message", body)
+                outbox.stage(pipe, entry)
+                pipe.execute()
             db_span.set_status(Status(StatusCode.OK))
         except Exception as exc:
             import traceback
@@ -85,7 +121,70 @@ def publish_message():
             traceback.print_exc()
             raise
 
-@app.route('/trigger', methods=['GET'])
+def batch_payloads():
+    # Returns None for a plain single-message trigger.
+    if request.method == 'POST':
+        payloads = request.get_json(silent=True)
+        if not isinstance(payloads, list) or not all(isinstance(p, dict) for p in payloads):
+            raise BadRequest("POST /trigger expects a JSON array of message objects")
+    else:
+        count = request.args.get("count", default=1, type=int)
+        if count <= 1:
+            return None
+        payloads = [{}] * count
+    if len(payloads) > TRIGGER_MAX_BATCH:
+        raise BadRequest(f"Batch of {len(payloads)} exceeds TRIGGER_MAX_BATCH={TRIGGER_MAX_BATCH}")
+    return payloads
+
+def publish_batch(payloads):
+    rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
+    with tracer.start_as_current_span(
+        "publish_ticket_batch",
+        kind=SpanKind.PRODUCER,
+        attributes={
+            "messaging.operation": "send",
+            "messaging.destination.name": "TicketQueue",
+            "messaging.batch.message_count": len(payloads),
+            "server.address": rabbit_host,
+        },
+    ) as batch_span:
+        try:
+            messages = []
+            injected = 0
+            # Every message of the batch continues the batch span's trace
+            headers = message_headers()
+            last_body = None
+            for payload in payloads:
+                message_id = f"msg-{random.randint(1000,9999)}"
+                conversation_id = new_conversation_id()
+                message = {**build_message(message_id, conversation_id), **payload}
+                # Random error injection for messaging, counted as a failed message
+                if random.random() < 0.001:
+                    injected += 1
+                    continue
+                messages.append((shard_queue('TicketQueue', message), encode(message), publish_properties(CONTENT_TYPE, headers, message_id=message_id, correlation_id=conversation_id)))
+                last_body = messages[-1][1]
+            result = get_publisher(queues=shard_queues('TicketQueue')).publish_batch(messages)
+            record_sent('TicketQueue', result["published"], result["elapsed_ms"], "publish_batch")
+            result["failed"] += injected
+            batch_span.set_attribute("messaging.batch.failed_count", result["failed"])
+            batch_span.set_status(Status(StatusCode.OK))
+        except Exception as exc:
+            batch_span.set_status(Status(StatusCode.ERROR, str(exc)))
+            batch_span.set_attribute("error.type", type(exc).__name__)
+            print(f"[TicketService] Error sending batch: {exc}", file=sys.stdout)
+            raise
+    if last_body is not None:
+        save_last_message(last_body)
+    return result
+
+@app.route('/stats')
+def stats():
+    if not OUTBOX_ENABLED:
+        return jsonify({"outbox": None}), 200
+    return jsonify({"outbox": get_outbox('ticket_service', queues=shard_queues('TicketQueue')).stats()}), 200
+
+@app.route('/trigger', methods=['GET', 'POST'])
 def trigger():
     with tracer.start_as_current_span(
         "http_trigger",
@@ -103,9 +202,23 @@ def trigger():
             # Random error injection for HTTP
             if random.random() < 0.001:
                 raise ValueError("Simulated HTTP error")
-            publish_message()
+            payloads = batch_payloads()
+            if payloads is None:
+                publish_message()
+                route_span.set_status(Status(StatusCode.OK))
+                return jsonify({"status": "TicketService triggered"}), 200
+            result = publish_batch(payloads)
+            route_span.set_attribute("messaging.batch.message_count", len(payloads))
             route_span.set_status(Status(StatusCode.OK))
-            return jsonify({"status": "TicketService triggered"}), 200
+            return jsonify({"status": "TicketService triggered", **result}), 200
+        except BadRequest as e:
+            route_span.set_status(Status(StatusCode.ERROR, e.description))
+            route_span.set_attribute("error.type", type(e).__name__)
+            return jsonify({"error": e.description}), 400
+        except queue.Full as e:
+            route_span.set_status(Status(StatusCode.ERROR, str(e)))
+            route_span.set_attribute("error.type", "queue.Full")
+            return jsonify({"error": str(e)}), 503
         except Exception as e:
             import traceback
             route_span.set_status(Status(StatusCode.ERROR, str(e)))
@@ -115,4 +228,5 @@ def trigger():
             return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
+    serve_metrics()
     app.run(host="0.0.0.0", port=5000)
@@ -1,123 +1,192 @@
 import os
-import json
-import pika
-import redis
-import threading
 import random
 import sys
+import queue
+import time
 from flask import Flask, jsonify, request
-from otel import tracer
+from werkzeug.exceptions import BadRequest
+from telemetry import serve_metrics, tracer
+from io_thread import IOThread
+from topology import FanoutTopology
+from messaging.codec import CONTENT_TYPE, content_type_of, decode, encode
+from payloads.synthetic import PAYLOAD_GENERATOR, get_generator, new_conversation_id
+from messaging.tracing import PRODUCED_AT, carried, context_of, message_headers, publish_properties, receive_attributes
+from messaging.metrics import elapsed_ms, process_duration, record_received, record_sent, watch_queues
+from messaging.store import set_last_message
 from opentelemetry.trace import SpanKind, Status, StatusCode
 
 app = Flask(__name__)
 
-import time
+TRIGGER_MAX_BATCH = int(os.getenv("TRIGGER_MAX_BATCH", "100000"))
+# Unacked TrainManagementQueue deliveries the consumer may hold
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "200"))
+# Built at import so that a bad FANOUT_* setting fails at startup
+topology = FanoutTopology()
 
-def consumer():
+def start_consumer(channel):
+    # Runs on the I/O thread for every (re)connection
     rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
-    rabbit_port = int(os.getenv("RABBITMQ_PORT", "5672"))
     redis_host = os.getenv("REDIS_HOST", "redis")
-    redis_port = int(os.getenv("REDIS_PORT", "6379"))
-    while True:
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host, port=rabbit_port, credentials=pika.PlainCredentials("admin", "password")))
-            channel = connection.channel()
-            channel.queue_declare(queue='TrainManagementQueue', durable=True)
-            for q in ['ScheduleQueue', 'TicketQueue', 'PassengerQueue']:
-                channel.queue_declare(queue=q, durable=True)
+    channel.queue_declare(queue='TrainManagementQueue', durable=True)
+    topology.declare(channel)
 
-            def callback(ch, method, properties, body):
+    def handle(ch, method, properties, body):
+        started = time.perf_counter()
+        record_received('TrainManagementQueue', properties)
+        inherited = carried(properties)
+        # Continues the producer's trace; queue wait goes on the receive span, processing is the process span
+        with tracer.start_as_current_span(
+            "receive_train_management_message",
+            context=context_of(inherited),
+            kind=SpanKind.CLIENT,
+            attributes={
+                "messaging.operation": "receive",
+                "messaging.destination.name": "TrainManagementQueue",
+                "messaging.message.id": getattr(properties, "message_id", None) or "unknown",
+                "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
+                "server.address": rabbit_host,
+                **receive_attributes(properties),
+            },
+        ) as recv_span:
+            try:
                 with tracer.start_as_current_span(
-                    "receive_train_management_message",
-                    kind=SpanKind.CLIENT,
+                    "process_train_management_message",
+                    kind=SpanKind.CONSUMER,
                     attributes={
-                        "messaging.operation": "receive",
+                        "messaging.operation": "process",
                         "messaging.destination.name": "TrainManagementQueue",
                         "messaging.message.id": getattr(properties, "message_id", None) or "unknown",
                         "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
                         "server.address": rabbit_host,
                     },
-                ) as recv_span:
-                    try:
+                ) as process_span:
+                    content_type = content_type_of(properties)
+                    message = decode(body, content_type)
+                    # otel_logger.info("TrainManagementService: Received management message", attributes={"messaging.message.id": getattr(properties, "message_id", None) or "unknown",})
+                    # Random error injection for message processing
+                    if random.random() < 0.001:
+                        raise RuntimeError("Simulated message processing error")
+                    # Serialized once for all fan-out destinations and Redis
+                    out_body = body if content_type == CONTENT_TYPE else encode(message)
+                    destinations = topology.destinations(message)
+                    if topology.mode == "queues":
+                        for queue, destination in destinations:
+                            fanout_id = f"fanout-{random.randint(1000,9999)}"
+                            with tracer.start_as_current_span(
+                                f"send_fanout_{queue}",
+                                kind=SpanKind.PRODUCER,
+                                attributes={
+                                    "messaging.operation": "send",
+                                    "messaging.destination.name": queue,
+                                    "messaging.message.id": fanout_id,
+                                    "server.address": rabbit_host,
+                                    "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
+                                },
+                            ) as send_span:
+                                out_properties = publish_properties(
+                                    CONTENT_TYPE, message_headers(inherited.get(PRODUCED_AT)),
+                                    message_id=fanout_id, correlation_id=getattr(properties, "correlation_id", None),
+                                )
+                                publish_started = time.perf_counter()
+                                channel.basic_publish(exchange='', routing_key=destination, body=out_body, properties=out_properties)
+                                record_sent(queue, 1, elapsed_ms(publish_started))
+                                # otel_logger.info(f"TrainManagementService: Fanned out message to {queue}")
+                                send_span.set_status(Status(StatusCode.OK))
+                    else:
+                        # One publish; the exchange copies it to every bound queue
+                        routing_key = topology.routing_key(message)
+                        fanout_id = f"fanout-{random.randint(1000,9999)}"
                         with tracer.start_as_current_span(
-                            "process_train_management_message",
-                            kind=SpanKind.CONSUMER,
+                            "send_fanout",
+                            kind=SpanKind.PRODUCER,
                             attributes={
-                                "messaging.operation": "process",
-                                "messaging.destination.name": "TrainManagementQueue",
-                                "messaging.message.id": getattr(properties, "message_id", None) or "unknown",
-                                "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
+                                "messaging.operation": "send",
+                                "messaging.destination.name": topology.exchange,
+                                "messaging.rabbitmq.destination.routing_key": routing_key,
+                                "messaging.fanout.destinations": [destination for _, destination in destinations],
+                                "messaging.message.id": fanout_id,
                                 "server.address": rabbit_host,
+                                "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
                             },
-                        ) as process_span:
-                            message = json.loads(body)
-                            # otel_logger.info("TrainManagementService: Received management message", attributes={"messaging.message.id": getattr(properties, "message_id", None) or "unknown",})
-                            # Random error injection for message processing
-                            if random.random() < 0.001:
-                                raise RuntimeError("Simulated message processing error")
-                            for queue in ['ScheduleQueue', 'TicketQueue', 'PassengerQueue']:
-                                with tracer.start_as_current_span(
-                                    f"send_fanout_{queue}",
-                                    kind=SpanKind.PRODUCER,
-                                    attributes={
-                                        "messaging.operation": "send",
-                                        "messaging.destination.name": queue,
-                                        "messaging.message.id": f"fanout-{random.randint(1000,9999)}",
-                                        "server.address": rabbit_host,
-                                        "messaging.message.conversation_id": getattr(properties, "correlation_id", None) or "unknown",
-                                    },
-                                ) as send_span:
-                                    channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(message))
-                                    # otel_logger.info(f"TrainManagementService: Fanned out message to {queue}")
-                                    send_span.set_status(Status(StatusCode.OK))
-                            ch.basic_ack(delivery_tag=method.delivery_tag)
-                            # Redis operation
-                            with tracer.start_as_current_span(
-                                "redis_set_last_message",
-                                kind=SpanKind.CLIENT,
-                                attributes={
-                                    "db.system": "redis",
-                                    "db.operation.name": "SET",
-                                    "db.query.text": "SET train_management_last_message ...",
-                                    "network.peer.address": redis_host,
-                                    "db.namespace": "0"
-                                },
-                            ) as db_span:
-                                try:
-                                    r = redis.Redis(host=redis_host, port=redis_port, password="password")
-                                    r.set("train_management_last_message", json.dumps(message))
-                                    db_span.set_status(Status(StatusCode.OK))
-                                except Exception as exc:
-                                    db_span.set_status(Status(StatusCode.ERROR, str(exc)))
-                                    db_span.set_attribute("error.type", type(exc).__name__)
-                                    # otel_logger.error(f"Error saving to Redis: {exc}", attributes={"error.type": type(exc).__name__})
-                                    raise
-                            process_span.set_status(Status(StatusCode.OK))
-                        recv_span.set_status(Status(StatusCode.OK))
-                    except Exception as exc:
-                        recv_span.set_status(Status(StatusCode.ERROR, str(exc)))
-                        recv_span.set_attribute("error.type", type(exc).__name__)
-                        # otel_logger.error(f"Error processing management message: {exc}", attributes={"error.type": type(exc).__name__})
-                        raise
+                        ) as send_span:
+                            out_properties = publish_properties(
+                                CONTENT_TYPE, message_headers(inherited.get(PRODUCED_AT)),
+                                message_id=fanout_id, correlation_id=getattr(properties, "correlation_id", None),
+                            )
+                            publish_started = time.perf_counter()
+                            channel.basic_publish(exchange=topology.exchange, routing_key=routing_key, body=out_body, properties=out_properties)
+                            for queue, _ in destinations:
+                                record_sent(queue, 1, elapsed_ms(publish_started))
+                            send_span.set_status(Status(StatusCode.OK))
+                    topology.record(destinations, len(out_body))
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    # Redis operation
+                    with tracer.start_as_current_span(
+                        "redis_set_last_message",
+                        kind=SpanKind.CLIENT,
+                        attributes={
+                            "db.system": "redis",
+                            "db.operation.name": "SET",
+                            "db.query.text": "SET train_management_last_message ...",
+                            "network.peer.address": redis_host,
+                            "db.namespace": "0"
+                        },
+                    ) as db_span:
+                        try:
+                            set_last_message("train_management_last_message", out_body)
+                            db_span.set_status(Status(StatusCode.OK))
+                        except Exception as exc:
+                            db_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                            db_span.set_attribute("error.type", type(exc).__name__)
+                            # otel_logger.error(f"Error saving to Redis: {exc}", attributes={"error.type": type(exc).__name__})
+                            # The message is fanned out and acked; only the last-message key is stale
+                            print(f"TrainManagementService: Error saving to Redis: {exc}", flush=True, file=sys.stdout)
+                    process_span.set_status(Status(StatusCode.OK))
+                recv_span.set_status(Status(StatusCode.OK))
+                process_duration.record(elapsed_ms(started), {"messaging.destination.name": 'TrainManagementQueue'})
+            except Exception as exc:
+                recv_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                recv_span.set_attribute("error.type", type(exc).__name__)
+                # otel_logger.error(f"Error processing management message: {exc}", attributes={"error.type": type(exc).__name__})
+                raise
 
-            channel.basic_consume(queue='TrainManagementQueue', on_message_callback=callback)
-            print("TrainManagementService: Consumer started, waiting for messages...", flush=True)
-            channel.start_consuming()
-        except KeyboardInterrupt:
-            print("TrainManagementService: Shutting down...", flush=True)
-            break
-        except Exception as e:
-            print(f"TrainManagementService: Error occurred: {e}", flush=True, file=sys.stdout)
-            time.sleep(5)  # Sleep before retrying after error
+    def callback(ch, method, properties, body):
+        # Errors stay with their delivery: one escaping to the I/O thread's loop would close the
+        # connection and fail every HTTP publish waiting on it. handle() acks only once nothing can fail.
+        try:
+            handle(ch, method, properties, body)
+        except Exception as exc:
+            print(f"TrainManagementService: Error processing message: {exc}", flush=True, file=sys.stdout)
+            if ch.is_open:
+                # A body that cannot be decoded would fail the same way on every redelivery
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=not isinstance(exc, ValueError))
+
+    channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+    channel.basic_consume(queue='TrainManagementQueue', on_message_callback=callback)
+    print("TrainManagementService: Consumer started, waiting for messages...", flush=True)
+
+# Owns the process's only RabbitMQ connection: consumes and publishes for the HTTP handlers
+io_thread = IOThread(start_consumer, queues=['TrainManagementQueue'])
 
 
+def build_message(message_id, conversation_id):
+    if PAYLOAD_GENERATOR == "synthetic":
+        return {"operation": "update_schedule", **get_generator().schedule(), "message_id": message_id, "conversation_id": conversation_id}
+    return {
+        "operation": "update_schedule",
+        "train_id": "123",
+        "departure_time": "2025-04-15T10:00:00",
+        "arrival_time": "2025-04-15T14:00:00",
+        "route": ["StationA", "StationB", "StationC"],
+        "message_id": message_id,
+        "conversation_id": conversation_id
+    }
 
 def publish_message():
     # For load testing, send a message to TrainManagementQueue
     rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
-    rabbit_port = int(os.getenv("RABBITMQ_PORT", "5672"))
     message_id = f"msg-{random.randint(1000,9999)}"
-    conversation_id = f"conv-{random.randint(100,999)}"
+    conversation_id = new_conversation_id()
     with tracer.start_as_current_span(
         "publish_train_management_message",
         kind=SpanKind.PRODUCER,
@@ -130,22 +199,16 @@ def publish_message():
         },
     ) as msg_span:
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host, port=rabbit_port, credentials=pika.PlainCredentials("admin", "password")))
-            channel = connection.channel()
-            channel.queue_declare(queue='TrainManagementQueue', durable=True)
-            message = {
-                "operation": "update_schedule",
-                "train_id": "123",
-                "departure_time": "2025-04-15T10:00:00",
-                "arrival_time": "2025-04-15T14:00:00",
-                "route": ["StationA", "StationB", "StationC"],
-                "message_id": message_id,
-                "conversation_id": conversation_id
-            }
+            message = build_message(message_id, conversation_id)
             # Random error injection for messaging
             if random.random() < 0.001:
                 raise RuntimeError("Simulated messaging failure")
-            channel.basic_publish(exchange='', routing_key='TrainManagementQueue', body=json.dumps(message))
+            started = time.perf_counter()
+            properties = publish_properties(CONTENT_TYPE, message_id=message_id, correlation_id=conversation_id)
+            result = io_thread.publish_batch([('TrainManagementQueue', encode(message))], properties)
+            if result["failed"]:
+                raise RuntimeError("Publish to TrainManagementQueue was not confirmed")
+            record_sent('TrainManagementQueue', 1, elapsed_ms(started))
             # otel_logger.info("TrainManagementService: Sent message to TrainManagementQueue", attributes={"messaging.message.id": message_id})
             msg_span.set_status(Status(StatusCode.OK))
         except Exception as exc:
@@ -153,11 +216,65 @@ def publish_message():
             msg_span.set_attribute("error.type", type(exc).__name__)
             # otel_logger.error(f"Error sending message: {exc}", attributes={"error.type": type(exc).__name__})
             raise
-        finally:
-            if 'connection' in locals():
-                connection.close()
 
-@app.route('/trigger', methods=['GET'])
+def batch_payloads():
+    # Returns None for a plain single-message trigger.
+    if request.method == 'POST':
+        payloads = request.get_json(silent=True)
+        if not isinstance(payloads, list) or not all(isinstance(p, dict) for p in payloads):
+            raise BadRequest("POST /trigger expects a JSON array of message objects")
+    else:
+        count = request.args.get("count", default=1, type=int)
+        if count <= 1:
+            return None
+        payloads = [{}] * count
+    if len(payloads) > TRIGGER_MAX_BATCH:
+        raise BadRequest(f"Batch of {len(payloads)} exceeds TRIGGER_MAX_BATCH={TRIGGER_MAX_BATCH}")
+    return payloads
+
+def publish_batch(payloads):
+    rabbit_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
+    with tracer.start_as_current_span(
+        "publish_train_management_batch",
+        kind=SpanKind.PRODUCER,
+        attributes={
+            "messaging.operation": "send",
+            "messaging.destination.name": "TrainManagementQueue",
+            "messaging.batch.message_count": len(payloads),
+            "server.address": rabbit_host,
+        },
+    ) as batch_span:
+        try:
+            messages = []
+            injected = 0
+            # Every message of the batch continues the batch span's trace
+            headers = message_headers()
+            for payload in payloads:
+                message_id = f"msg-{random.randint(1000,9999)}"
+                conversation_id = new_conversation_id()
+                message = {**build_message(message_id, conversation_id), **payload}
+                # Random error injection for messaging, counted as a failed message
+                if random.random() < 0.001:
+                    injected += 1
+                    continue
+                messages.append(('TrainManagementQueue', encode(message), publish_properties(CONTENT_TYPE, headers, message_id=message_id, correlation_id=conversation_id)))
+            result = io_thread.publish_batch(messages)
+            record_sent('TrainManagementQueue', result["published"], result["elapsed_ms"], "publish_batch")
+            result["failed"] += injected
+            batch_span.set_attribute("messaging.batch.failed_count", result["failed"])
+            batch_span.set_status(Status(StatusCode.OK))
+        except Exception as exc:
+            batch_span.set_status(Status(StatusCode.ERROR, str(exc)))
+            batch_span.set_attribute("error.type", type(exc).__name__)
+            print(f"[TrainManagementService] Error sending batch: {exc}", file=sys.stdout)
+            raise
+    return result
+
+@app.route('/stats')
+def stats():
+    return jsonify({"mode": topology.mode, "exchange": topology.exchange, "publish_queue_depth": io_thread.depth(), **topology.stats.snapshot()}), 200
+
+@app.route('/trigger', methods=['GET', 'POST'])
 def trigger():
     with tracer.start_as_current_span(
         "http_trigger",
@@ -175,9 +292,23 @@ def trigger():
             # Random error injection for HTTP
             if random.random() < 0.001:
                 raise ValueError("Simulated HTTP error")
-            publish_message()
+            payloads = batch_payloads()
+            if payloads is None:
+                publish_message()
+                route_span.set_status(Status(StatusCode.OK))
+                return jsonify({"status": "TrainManagementService triggered"}), 200
+            result = publish_batch(payloads)
+            route_span.set_attribute("messaging.batch.message_count", len(payloads))
             route_span.set_status(Status(StatusCode.OK))
-            return jsonify({"status": "TrainManagementService triggered"}), 200
+            return jsonify({"status": "TrainManagementService triggered", **result}), 200
+        except BadRequest as e:
+            route_span.set_status(Status(StatusCode.ERROR, e.description))
+            route_span.set_attribute("error.type", type(e).__name__)
+            return jsonify({"error": e.description}), 400
+        except queue.Full:
+            route_span.set_status(Status(StatusCode.ERROR, "publish queue full"))
+            route_span.set_attribute("error.type", "queue.Full")
+            return jsonify({"error": "Publish queue is full, retry later"}), 503
         except Exception as e:
             route_span.set_status(Status(StatusCode.ERROR, str(e)))
             route_span.set_attribute("error.type", type(e).__name__)
@@ -185,6 +316,7 @@ def trigger():
             return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
-    t = threading.Thread(target=consumer, daemon=True)
-    t.start()
+    serve_metrics()
+    watch_queues(['TrainManagementQueue'])
+    io_thread.start()
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+from messaging.rabbit import BatchPublisher
+
+
+# Seconds before a consumer channel closed by the broker is reopened
+CONSUMER_REOPEN_DELAY = float(os.getenv("CONSUMER_REOPEN_DELAY", "5"))
+
+
+class IOThread(BatchPublisher):
+    """The one thread that owns this process's RabbitMQ connection.
+
+    It runs the consumer set up by ``on_connect(channel)`` on one channel and
+    publishes what other threads ``submit`` on a second one, in confirm mode.
+    pika connections are not thread-safe, so HTTP handlers never touch the
+    connection: they put their messages on a bounded queue, wake the thread
+    with ``add_callback_threadsafe`` and wait on the returned future. The
+    thread publishes at most ``PUBLISH_BATCH_SIZE`` queued messages at a time
+    and goes back to the consumer while the broker confirms them, so neither
+    side starves the other. A future resolves once its messages are confirmed,
+    with the same summary ``BatchPublisher.publish_batch`` returns. If the
+    broker closes the consumer channel, a new one is opened and set up again
+    after ``CONSUMER_REOPEN_DELAY`` seconds.
+    """
+
+    def __init__(self, on_connect, name="TrainManagementService", **kwargs):
+        super().__init__(name=f"{name}-io", **kwargs)
+        self.on_connect = on_connect
+
+    def _on_connection_open(self, connection):
+        self._open_consumer(connection)
+        super()._on_connection_open(connection)
+
+    def _open_consumer(self, connection):
+        if connection.is_open:
+            connection.channel(on_open_callback=self._on_consumer_open)
+
+    def _on_consumer_open(self, channel):
+        channel.add_on_close_callback(self._on_consumer_closed)
+        self.on_connect(channel)
+
+    def _on_consumer_closed(self, channel, reason):
+        # The broker closes a channel on errors such as a failed declare or bind; without a new
+        # one, consumption would stop silently while publishing carries on
+        print(f"{self.name}: consumer channel closed: {reason}", flush=True, file=sys.stdout)
+        connection = channel.connection
+        if connection.is_open:
+            connection.ioloop.call_later(CONSUMER_REOPEN_DELAY, lambda: self._open_consumer(connection))
+
+
+__all__ = ["IOThread"]
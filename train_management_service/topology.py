@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import defaultdict
+
+from messaging.rabbit import AGGREGATION_SHARDS, shard_index
+
+
+FANOUT_QUEUES = ['ScheduleQueue', 'TicketQueue', 'PassengerQueue']
+# "queues" publishes once per destination queue; "fanout" and "topic" publish once to an exchange bound to them
+FANOUT_MODE = os.getenv("FANOUT_MODE", "queues")
+FANOUT_EXCHANGE = os.getenv("FANOUT_EXCHANGE", f"train_management.{FANOUT_MODE}")
+# Comma-separated queue:pattern bindings on the operation, e.g. "ScheduleQueue:#,TicketQueue:book_ticket".
+# Queues without a binding receive every operation.
+FANOUT_BINDINGS = os.getenv("FANOUT_BINDINGS", "")
+
+
+def parse_bindings(spec, queues=FANOUT_QUEUES):
+    bindings = defaultdict(list)
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        queue, sep, pattern = entry.partition(":")
+        if not sep or queue not in queues or not pattern:
+            raise ValueError(f"Invalid FANOUT_BINDINGS entry {entry!r}; expected <queue>:<pattern> with queue in {queues}")
+        bindings[queue].append(pattern)
+    return {queue: bindings.get(queue, ["#"]) for queue in queues}
+
+
+def topic_match(pattern, routing_key):
+    """AMQP topic matching: ``*`` is exactly one word, ``#`` zero or more."""
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == "#":
+            return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+        return bool(k) and p[0] in ("*", k[0]) and match(p[1:], k[1:])
+    return match(pattern.split("."), routing_key.split("."))
+
+
+def operation_of(message):
+    # Routing keys are dot-separated words, so dots in the operation name would add words
+    return str(message.get("operation") or "unknown").replace(".", "_")
+
+
+class FanoutTopology:
+    """Where TrainManagementService fans a management message out to.
+
+    In ``queues`` mode every destination queue gets its own ``basic_publish``. In
+    ``fanout`` and ``topic`` mode the message is published once to an exchange
+    and the broker copies it to the bound queues. ``topic`` routes on the
+    message's operation (plus ``.<shard>`` when aggregation is sharded), so
+    ``bindings`` can send an operation to only some of the queues; ``queues``
+    mode applies the same bindings client-side. A ``fanout`` exchange ignores
+    routing keys and cannot shard or filter.
+    """
+
+    def __init__(self, mode=FANOUT_MODE, exchange=FANOUT_EXCHANGE, bindings=None, shards=AGGREGATION_SHARDS):
+        if mode not in ("queues", "fanout", "topic"):
+            raise ValueError(f"Unknown FANOUT_MODE {mode!r}; expected queues, fanout or topic")
+        self.mode = mode
+        self.exchange = exchange if mode != "queues" else ""
+        self.shards = shards
+        self.bindings = parse_bindings(FANOUT_BINDINGS) if bindings is None else bindings
+        if mode == "fanout" and (shards > 0 or any(patterns != ["#"] for patterns in self.bindings.values())):
+            raise ValueError("FANOUT_MODE=fanout cannot shard or filter; use FANOUT_MODE=topic")
+        self.stats = FanoutStats()
+
+    def _shards(self):
+        return [None] if self.shards <= 0 else list(range(self.shards))
+
+    @staticmethod
+    def _queue(queue, shard):
+        return queue if shard is None else f"{queue}.{shard}"
+
+    def declare(self, channel):
+        for queue in FANOUT_QUEUES:
+            for shard in self._shards():
+                channel.queue_declare(queue=self._queue(queue, shard), durable=True)
+        if self.mode == "queues":
+            return
+        channel.exchange_declare(exchange=self.exchange, exchange_type=self.mode, durable=True)
+        # Bindings are only ever added; remove stale ones with rabbitmqctl/the management UI
+        for queue, patterns in self.bindings.items():
+            for shard in self._shards():
+                for pattern in patterns:
+                    routing_key = pattern if shard is None else f"{pattern}.{shard}"
+                    channel.queue_bind(queue=self._queue(queue, shard), exchange=self.exchange, routing_key=routing_key)
+
+    def routing_key(self, message):
+        shard = shard_index(message)
+        operation = operation_of(message)
+        return operation if shard is None else f"{operation}.{shard}"
+
+    def destinations(self, message):
+        """``(queue, destination)`` pairs the message reaches, as the broker would route it.
+
+        ``destination`` is the shard queue when aggregation is sharded.
+        """
+        operation = operation_of(message)
+        shard = shard_index(message)
+        return [
+            (queue, self._queue(queue, shard)) for queue, patterns in self.bindings.items()
+            if any(topic_match(pattern, operation) for pattern in patterns)
+        ]
+
+    def record(self, destinations, size):
+        self.stats.record([destination for _, destination in destinations], size, 1 if self.exchange else len(destinations))
+
+
+class FanoutStats:
+    """Per-destination publish counters; the broker copies exchange fan-outs, so they are derived from the bindings."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fanouts = 0
+        self.publishes = 0
+        self.destinations = defaultdict(lambda: {"messages": 0, "bytes": 0})
+
+    def record(self, destinations, size, publishes):
+        with self._lock:
+            self.fanouts += 1
+            self.publishes += publishes
+            for queue in destinations:
+                counts = self.destinations[queue]
+                counts["messages"] += 1
+                counts["bytes"] += size
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "fanouts": self.fanouts,
+                "publishes": self.publishes,
+                "destinations": {queue: dict(counts) for queue, counts in sorted(self.destinations.items())},
+            }
+
+
+__all__ = ["FANOUT_QUEUES", "FanoutTopology", "topic_match"]